@@ -1,6 +1,23 @@
-from django.contrib import admin
-from .models import FloorPlan, InteriorDesign
+from django.contrib import admin, messages
+from .models import FloorPlan, InteriorDesign, DesignStyle
+from . import style_catalog
 
 # Register your models here.
 admin.site.register(FloorPlan)
-admin.site.register(InteriorDesign)
\ No newline at end of file
+admin.site.register(InteriorDesign)
+
+
+@admin.register(DesignStyle)
+class DesignStyleAdmin(admin.ModelAdmin):
+    list_display = ['name', 'description']
+    actions = ['refresh_style_catalog']
+
+    @admin.action(description='Refresh the cached style list')
+    def refresh_style_catalog(self, request, queryset):
+        # Reloads this process's copy; other workers reload within STYLE_CATALOG_TTL
+        style_catalog.invalidate()
+        catalog = style_catalog.get()
+        self.message_user(
+            request, f"Style list refreshed: {len(catalog.styles)} styles, ETag {catalog.etag}",
+            messages.SUCCESS
+        )
@@ -0,0 +1,467 @@
+import os
+import math
+import time
+import random
+import asyncio
+import hashlib
+import itertools
+import threading
+import contextvars
+from collections import deque, namedtuple
+from contextlib import contextmanager, asynccontextmanager
+from . import cancellation, metrics
+
+
+# Admission control for Replicate predictions. Each process runs at most
+# PREDICTION_CONCURRENCY predictions at once; up to PREDICTION_QUEUE_SIZE
+# more wait for a slot, for at most PREDICTION_QUEUE_TIMEOUT seconds.
+# Anything beyond that is turned away with a Retry-After estimate instead
+# of piling up on Replicate's queue.
+PREDICTION_CONCURRENCY = int(os.getenv("PREDICTION_CONCURRENCY", "8"))
+PREDICTION_QUEUE_SIZE = int(os.getenv("PREDICTION_QUEUE_SIZE", "16"))
+PREDICTION_QUEUE_TIMEOUT = float(os.getenv("PREDICTION_QUEUE_TIMEOUT", "30"))
+# Assumed prediction time until some have finished, for Retry-After
+PREDICTION_EXPECTED_SECONDS = float(os.getenv("PREDICTION_EXPECTED_SECONDS", "15"))
+
+# Slots are shared fairly between clients (API key, session or IP): freed
+# slots go to the waiting client that has used the least slot time for
+# its weight, and no client holds more than PREDICTION_CLIENT_CONCURRENCY
+# slots or PREDICTION_CLIENT_QUEUE_SIZE places in the queue.
+PREDICTION_CLIENT_CONCURRENCY = int(os.getenv("PREDICTION_CLIENT_CONCURRENCY", "2"))
+PREDICTION_CLIENT_QUEUE_SIZE = int(os.getenv("PREDICTION_CLIENT_QUEUE_SIZE", "4"))
+# Token bucket per client: sustained generations per minute (0, the default,
+# turns it off) and how many may be started at once on top
+PREDICTION_CLIENT_RATE = float(os.getenv("PREDICTION_CLIENT_RATE", "0"))
+PREDICTION_CLIENT_BURST = int(os.getenv("PREDICTION_CLIENT_BURST", "10"))
+# Known API keys (X-API-Key) and their weights, e.g. "partner-key=4,batch-key=0.5"
+PREDICTION_CLIENT_WEIGHTS = {
+    key.strip(): float(weight)
+    for key, _, weight in (
+        entry.partition('=') for entry in os.getenv("PREDICTION_CLIENT_WEIGHTS", "").split(',') if entry.strip()
+    )
+}
+# Keep the token buckets in the database, so every worker process sees the same ones
+PREDICTION_SHARED_BUCKETS = os.getenv("PREDICTION_SHARED_BUCKETS") == "1"
+# Take the client IP from X-Forwarded-For; only behind a proxy that sets it
+TRUST_X_FORWARDED_FOR = os.getenv("TRUST_X_FORWARDED_FOR") == "1"
+
+
+class Overloaded(Exception):
+    """
+    The request can't be admitted: its client is over its rate limit
+    (rate_limited), the wait queue is full (queue_full) or the wait for
+    a slot timed out (timeout).
+    """
+
+    def __init__(self, retry_after, queued, reason='queue_full'):
+        super().__init__(f"Too many generations in progress; retry in {retry_after}s")
+        self.retry_after = retry_after
+        self.queued = queued
+        self.reason = reason
+
+
+# Who a request is from. key is hashed so API keys and sessions don't end
+# up in the database or in memory dumps.
+Client = namedtuple('Client', ['key', 'weight'])
+
+ANONYMOUS = Client('anonymous', 1.0)
+
+_client = contextvars.ContextVar('admission_client', default=ANONYMOUS)
+
+
+def _hashed(kind, value):
+    return f"{kind}:{hashlib.sha256(value.encode()).hexdigest()[:32]}"
+
+
+def identify(request):
+    """The Client a request is from: a known API key, else its session, else its IP."""
+    from django.conf import settings
+
+    api_key = request.headers.get('X-API-Key')
+    if api_key and api_key in PREDICTION_CLIENT_WEIGHTS:
+        return Client(_hashed('key', api_key), PREDICTION_CLIENT_WEIGHTS[api_key])
+
+    # Only sessions that exist count; a made-up cookie would be a free new identity
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    session = getattr(request, 'session', None)
+    if session_key and session is not None and session.exists(session_key):
+        return Client(_hashed('session', session_key), 1.0)
+
+    ip = request.META.get('REMOTE_ADDR') or 'unknown'
+    if TRUST_X_FORWARDED_FOR and request.headers.get('X-Forwarded-For'):
+        ip = request.headers['X-Forwarded-For'].split(',')[0].strip()
+    return Client(f"ip:{ip}", 1.0)
+
+
+@contextmanager
+def client(value):
+    token = _client.set(value)
+    try:
+        yield
+    finally:
+        _client.reset(token)
+
+
+# Background jobs wait for a slot however long the queue is; the worker
+# pool already bounds how many of them there are
+_unbounded = contextvars.ContextVar('admission_unbounded', default=False)
+
+
+@contextmanager
+def background():
+    token = _unbounded.set(True)
+    try:
+        yield
+    finally:
+        _unbounded.reset(token)
+
+
+class TokenBuckets:
+    """Per-client token buckets, in process memory."""
+
+    # Buckets are forgotten once this many exist and they have refilled
+    MAX_BUCKETS = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate / 60
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def refill(self, tokens, elapsed):
+        return min(self.burst, tokens + elapsed * self.rate)
+
+    def take(self, key, consume=True):
+        """0 if a token was available (and taken), else seconds until there is one."""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = self.refill(tokens, now - updated)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self.buckets[key] = (tokens - 1 if consume else tokens, now)
+            if len(self.buckets) > self.MAX_BUCKETS:
+                self._prune(now)
+        return 0
+
+    def _prune(self, now):
+        full = self.burst / self.rate
+        for key, (tokens, updated) in list(self.buckets.items()):
+            if now - updated >= full:
+                del self.buckets[key]
+
+
+class SharedTokenBuckets(TokenBuckets):
+    """TokenBuckets kept in the database, shared by every worker process."""
+
+    def take(self, key, consume=True):
+        from datetime import timedelta
+        from django.db import IntegrityError, transaction
+        from django.utils import timezone
+        from .models import ClientRateBucket
+
+        if self.rate <= 0:
+            return 0
+        now = timezone.now()
+        if random.random() < 0.01:
+            # Buckets idle long enough to have refilled are the same as no bucket
+            ClientRateBucket.objects.filter(
+                updated_at__lt=now - timedelta(seconds=self.burst / self.rate)
+            ).delete()
+
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    bucket = ClientRateBucket.objects.select_for_update().filter(client=key).first()
+                    if bucket is None:
+                        bucket = ClientRateBucket.objects.create(client=key, tokens=self.burst, updated_at=now)
+                    tokens = self.refill(bucket.tokens, (now - bucket.updated_at).total_seconds())
+                    if tokens >= 1 and consume:
+                        bucket.tokens = tokens - 1
+                    else:
+                        bucket.tokens = tokens
+                    bucket.updated_at = now
+                    bucket.save(update_fields=['tokens', 'updated_at'])
+                break
+            except IntegrityError:
+                # Another worker created the bucket first; use theirs
+                if attempt:
+                    raise
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+
+class _Waiter:
+    """A queued request, woken from another thread when a slot is handed to it."""
+
+    def __init__(self, client, order, loop=None):
+        self.client = client
+        self.order = order
+        self.event = threading.Event()
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self):
+        self.event.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _ClientState:
+    def __init__(self, weight, virtual_time):
+        self.weight = weight
+        self.active = 0
+        self.waiters = deque()
+        # Slot seconds used, divided by weight; the lowest goes next
+        self.virtual_time = virtual_time
+
+
+class Limiter:
+    """
+    A counting semaphore with a bounded wait queue, shared fairly between
+    clients by weight and usable from threads and event loops.
+    """
+
+    def __init__(self, limit, queue_size, timeout, client_limit=None, client_queue_size=None, buckets=None):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.client_limit = client_limit if client_limit is not None else limit
+        self.client_queue_size = client_queue_size if client_queue_size is not None else queue_size
+        self.buckets = buckets or TokenBuckets(0, 0)
+        self.active = 0
+        self.queued = 0
+        self.clients = {}
+        # Virtual time of the last slot handed out; clients that were idle start from here
+        self.virtual_clock = 0.0
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        # Recent prediction times, for estimating how long the queue takes to drain
+        self.durations = deque(maxlen=50)
+
+    def expected_seconds(self):
+        return sum(self.durations) / len(self.durations) if self.durations else PREDICTION_EXPECTED_SECONDS
+
+    def retry_after(self):
+        """Seconds until a request arriving now would likely get a slot."""
+        rounds = self.queued // max(self.limit, 1) + 1
+        return max(1, math.ceil(self.expected_seconds() * rounds))
+
+    def _state(self, client):
+        state = self.clients.get(client.key)
+        if state is None:
+            state = self.clients[client.key] = _ClientState(client.weight, self.virtual_clock)
+        return state
+
+    def _forget_idle(self, client_key):
+        state = self.clients.get(client_key)
+        if state is not None and not state.active and not state.waiters:
+            del self.clients[client_key]
+
+    def _reject(self, reason, retry_after=None):
+        metrics.shed(reason)
+        raise Overloaded(retry_after or self.retry_after(), self.queued, reason)
+
+    def _queue_full(self, client):
+        if _unbounded.get():
+            return False
+        state = self.clients.get(client.key)
+        waiting = len(state.waiters) if state is not None else 0
+        return self.queued >= self.queue_size or waiting >= self.client_queue_size
+
+    def _slot_free(self, client):
+        state = self.clients.get(client.key)
+        if state is None:
+            return self.active < self.limit and self.client_limit > 0
+        return self.active < self.limit and state.active < self.client_limit and not state.waiters
+
+    def check(self, consume=False):
+        """
+        Fail fast, before any work is done for a request, if it would be
+        turned away. consume takes a token from the client's rate limit.
+        """
+        client = _client.get()
+        wait = self.buckets.take(client.key, consume=consume)
+        if wait:
+            self._reject('rate_limited', math.ceil(wait))
+        with self.lock:
+            if not self._slot_free(client) and self._queue_full(client):
+                self._reject('queue_full')
+
+    def _enqueue(self, loop=None):
+        """None if a slot was free, else the _Waiter to wait on."""
+        client = _client.get()
+        with self.lock:
+            if self._slot_free(client):
+                self._state(client).active += 1
+                self.active += 1
+                metrics.PREDICTION_SLOTS.inc()
+                return None
+            if self._queue_full(client):
+                self._reject('queue_full')
+            waiter = _Waiter(client, next(self.order), loop)
+            state = self._state(client)
+            if not state.active and not state.waiters:
+                # No credit for time spent idle
+                state.virtual_time = max(state.virtual_time, self.virtual_clock)
+            state.waiters.append(waiter)
+            self.queued += 1
+            metrics.PREDICTION_QUEUE.inc()
+            return waiter
+
+    def _dequeue(self, waiter):
+        """After waiting: True if the slot was handed over, else leave the queue."""
+        with self.lock:
+            if waiter.event.is_set():
+                return True
+            self.clients[waiter.client.key].waiters.remove(waiter)
+            self.queued -= 1
+            metrics.PREDICTION_QUEUE.dec()
+            self._forget_idle(waiter.client.key)
+            return False
+
+    def _timeout(self):
+        timeout = None if _unbounded.get() else self.timeout
+        # No longer than the client will wait
+        remaining = cancellation.remaining()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def acquire(self):
+        started = time.perf_counter()
+        waiter = self._enqueue()
+        if waiter is not None:
+            waiter.event.wait(self._timeout())
+            if not self._dequeue(waiter):
+                cancellation.check()
+                self._reject('timeout')
+        metrics.observe('admission_queue', time.perf_counter() - started)
+        return _client.get()
+
+    async def aacquire(self):
+        started = time.perf_counter()
+        waiter = self._enqueue(asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self._timeout())
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                # Give back a slot handed over as the request was cancelled
+                if self._dequeue(waiter):
+                    self.release(waiter.client)
+                raise
+            if not self._dequeue(waiter):
+                cancellation.check()
+                self._reject('timeout')
+        metrics.observe('admission_queue', time.perf_counter() - started)
+        return _client.get()
+
+    def _next_waiter(self):
+        """The head waiter of the eligible client with the least weighted slot time."""
+        best = None
+        for state in self.clients.values():
+            if state.waiters and state.active < self.client_limit:
+                key = (state.virtual_time, state.waiters[0].order)
+                if best is None or key < best[0]:
+                    best = (key, state)
+        return best[1] if best is not None else None
+
+    def release(self, client, duration=None):
+        with self.lock:
+            state = self.clients[client.key]
+            state.active -= 1
+            self.active -= 1
+            if duration is not None:
+                self.durations.append(duration)
+                state.virtual_time += duration / state.weight
+
+            # The slot passes straight to the next in line
+            following = self._next_waiter()
+            if following is not None:
+                waiter = following.waiters.popleft()
+                following.active += 1
+                self.active += 1
+                self.queued -= 1
+                self.virtual_clock = max(self.virtual_clock, following.virtual_time)
+                metrics.PREDICTION_QUEUE.dec()
+                waiter.grant()
+            else:
+                metrics.PREDICTION_SLOTS.dec()
+            self._forget_idle(client.key)
+
+    @contextmanager
+    def slot(self):
+        client = self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(client, time.monotonic() - started)
+
+    @asynccontextmanager
+    async def aslot(self):
+        client = await self.aacquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(client, time.monotonic() - started)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'queued': self.queued,
+                'queue_size': self.queue_size,
+                'clients': len(self.clients),
+                'retry_after': self.retry_after(),
+            }
+
+
+limiter = Limiter(
+    PREDICTION_CONCURRENCY, PREDICTION_QUEUE_SIZE, PREDICTION_QUEUE_TIMEOUT,
+    client_limit=PREDICTION_CLIENT_CONCURRENCY, client_queue_size=PREDICTION_CLIENT_QUEUE_SIZE,
+    buckets=(SharedTokenBuckets if PREDICTION_SHARED_BUCKETS else TokenBuckets)(
+        PREDICTION_CLIENT_RATE, PREDICTION_CLIENT_BURST
+    )
+)
+
+
+def check():
+    """Turn the request away now if it would be anyway, without using up its rate limit."""
+    limiter.check()
+
+
+def admit():
+    """Take one generation from the client's rate limit, failing fast if it would be turned away."""
+    limiter.check(consume=True)
+
+
+async def aadmit():
+    if isinstance(limiter.buckets, SharedTokenBuckets):
+        from asgiref.sync import sync_to_async
+        # Copies the context, so the request's client goes along
+        return await sync_to_async(admit)()
+    admit()
+
+
+def prediction_slot():
+    return limiter.slot()
+
+
+def aprediction_slot():
+    return limiter.aslot()
+
+
+def stats():
+    return limiter.stats()
@@ -1,6 +1,16 @@
+import os
 from django.apps import AppConfig
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Connects the signals that keep the cached style list current
+        from . import style_catalog  # noqa: F401
+
+        # Off by default so management commands and tests don't start it
+        if os.getenv('WARM_UP_ON_START') == '1':
+            from .warmup import warm_up_in_background
+            warm_up_in_background()
@@ -0,0 +1,200 @@
+import time
+import asyncio
+import hashlib
+import logging
+from asgiref.sync import sync_to_async
+from . import admission, async_storage, cancellation, metrics, prediction_cache, single_flight, variants
+from .clients import async_replicate_client
+from .generation import (
+    GenerationResult, UploadError, OUTPUT_UPLOAD_WORKERS, normalized_input, outcome_fields, record_design
+)
+from .models import UploadedImage
+from .storage import s3_url
+
+logger = logging.getLogger(__name__)
+
+
+async def aimage_digest(url):
+    """Async counterpart of generation.image_digest."""
+    bucket_prefix = s3_url('')
+    try:
+        if url.startswith(bucket_prefix):
+            key = url[len(bucket_prefix):]
+            uploaded = await UploadedImage.objects.filter(key=key).afirst()
+            if uploaded is not None:
+                return f"sha256:{uploaded.sha256}"
+            headers = await async_storage.head_object(key)
+            etag = headers['ETag'].strip('"')
+            return f"etag:{etag}"
+
+        digest = hashlib.sha256()
+        async with async_storage.http_client().stream('GET', url, timeout=10) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(64 * 1024):
+                digest.update(chunk)
+        return f"sha256:{digest.hexdigest()}"
+    except Exception as e:
+        logger.warning(f"Could not hash input image {url[:100]}: {str(e)}")
+        return None
+
+
+async def arun_prediction(model, input_data):
+    """
+    Async counterpart of generation.run_prediction. The prediction is
+    always polled, so it can be cancelled if the client disconnects.
+    """
+    from replicate.exceptions import ModelError
+    from replicate.helpers import transform_output
+
+    client = async_replicate_client()
+    async with admission.aprediction_slot():
+        cancellation.check()
+        started = time.perf_counter()
+        prediction = await client.predictions.async_create(version=model.split(':', 1)[1], input=input_data)
+        try:
+            while prediction.status not in ('succeeded', 'failed', 'canceled'):
+                cancellation.check()
+                remaining = cancellation.remaining()
+                await asyncio.sleep(client.poll_interval if remaining is None else min(client.poll_interval, remaining))
+                await prediction.async_reload()
+        except (asyncio.CancelledError, cancellation.Cancelled):
+            await cancellation.acancel_prediction(client, prediction.id)
+            raise
+    metrics.observe_prediction(prediction, time.perf_counter() - started)
+
+    if prediction.status != 'succeeded':
+        raise ModelError(prediction)
+    return transform_output(prediction.output, client)
+
+
+async def aas_outputs(output):
+    if hasattr(output, 'read'):
+        return [output]
+    if hasattr(output, '__aiter__'):
+        return [item async for item in output]
+    return list(output)
+
+
+async def aoutput_chunks(item):
+    from replicate.helpers import FileOutput
+
+    if isinstance(item, str):
+        item = FileOutput(item, async_replicate_client())
+    if isinstance(item, FileOutput):
+        async for chunk in item:
+            yield chunk
+    else:
+        yield item.read()
+
+
+async def aupload_output(item, key):
+    spool = variants.Spool()
+    download = metrics.AsyncTimedIterator(aoutput_chunks(item))
+    started = time.perf_counter()
+    try:
+        await async_storage.upload_stream(
+            spool.atee(download), key, 'image/png',
+            cache_control=variants.IMMUTABLE_CACHE_CONTROL
+        )
+    except BaseException:
+        spool.discard()
+        raise
+    finally:
+        metrics.observe('output_download', download.seconds)
+        metrics.observe('upload', time.perf_counter() - started - download.seconds)
+    variants.schedule(key, spool)
+    return s3_url(key)
+
+
+async def aupload_outputs(items, key_func):
+    """Async counterpart of generation.upload_outputs."""
+    slots = asyncio.Semaphore(OUTPUT_UPLOAD_WORKERS)
+
+    async def upload(item, key):
+        async with slots:
+            return await aupload_output(item, key)
+
+    results = await asyncio.gather(
+        *(upload(item, key_func()) for item in items),
+        return_exceptions=True
+    )
+    urls = [result for result in results if not isinstance(result, BaseException)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    for error in errors:
+        logger.error(f"Error uploading to S3: {str(error)}")
+
+    if errors and not urls:
+        raise UploadError(str(errors[0])) from errors[0]
+    return urls, len(errors)
+
+
+async def agenerate(model, input_data, key_func, admit=False):
+    """
+    Async counterpart of generation.generate(), with the same caching,
+    coalescing and admission. Waiting on Replicate and S3 doesn't hold a thread.
+    """
+    digest = await aimage_digest(input_data['image'])
+    cache_key = prediction_cache.prediction_key(model, input_data, digest) if digest else None
+
+    with metrics.stage('cache_lookup'):
+        cached_urls = await sync_to_async(prediction_cache.lookup)(cache_key)
+    if cached_urls is not None:
+        metrics.cache_result('hit')
+        return GenerationResult(cached_urls, 'hit')
+
+    async def predict():
+        if admit:
+            await admission.aadmit()
+        with metrics.stage('normalize'):
+            model_input = await sync_to_async(normalized_input)(model, input_data, digest)
+        output = await arun_prediction(model, model_input)
+        cancellation.check()
+        urls, failed = await aupload_outputs(await aas_outputs(output), key_func)
+
+        # A partial batch is returned but not cached
+        if not failed:
+            await sync_to_async(prediction_cache.store)(cache_key, model, urls)
+        return GenerationResult(urls, 'miss', failed)
+
+    async def recheck():
+        urls = await sync_to_async(prediction_cache.lookup)(cache_key)
+        return GenerationResult(urls, 'coalesced') if urls is not None else None
+
+    led = []
+
+    async def lead():
+        led.append(True)
+        return await predict()
+
+    try:
+        result, shared = await single_flight.arun(single_flight.flight_key(model, input_data), lead, recheck)
+    except cancellation.Cancelled:
+        if led:
+            raise
+        # The request this one waited on was cancelled for its own client; run it for this one
+        result, shared = await single_flight.arun(single_flight.flight_key(model, input_data), predict, recheck)
+    if shared:
+        result = result._replace(cache='coalesced')
+    metrics.cache_result(result.cache)
+    return result
+
+
+async def agenerate_recorded(model, input_data, key_func, room_type=None, timeout=None):
+    """
+    Async counterpart of generation.generate_recorded. When the client
+    disconnects, the view is cancelled and so is the prediction.
+    """
+    started = time.monotonic()
+    try:
+        with cancellation.scope(timeout=timeout):
+            result = await agenerate(model, input_data, key_func, admit=True)
+    except admission.Overloaded:
+        raise
+    except asyncio.CancelledError:
+        metrics.cancelled('disconnect')
+        raise
+    except Exception as e:
+        await sync_to_async(record_design)(input_data, room_type, outcome_fields(model, started, error=e))
+        raise
+    await sync_to_async(record_design)(input_data, room_type, outcome_fields(model, started, result))
+    return result
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import xml.etree.ElementTree as ET
+from .clients import async_http_client as http_client
+from .storage import s3_client, AWS_BUCKET_NAME
+from .s3_multipart import S3_MULTIPART_PART_SIZE, S3_MULTIPART_MAX_INFLIGHT
+
+logger = logging.getLogger(__name__)
+
+
+# S3 requests made by the async views are signed locally by boto3 and sent
+# with httpx, so waiting on S3 never holds a thread.
+PRESIGN_EXPIRES = 300
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+def presign(operation, **params):
+    return s3_client.generate_presigned_url(
+        operation,
+        Params=dict(params, Bucket=AWS_BUCKET_NAME),
+        ExpiresIn=PRESIGN_EXPIRES
+    )
+
+
+def _cache_params(cache_control):
+    """Presign parameters and the matching request headers for an optional Cache-Control."""
+    if not cache_control:
+        return {}, {}
+    return {'CacheControl': cache_control}, {'Cache-Control': cache_control}
+
+
+async def put_object(key, body, content_type, cache_control=None):
+    params, headers = _cache_params(cache_control)
+    response = await http_client().put(
+        presign('put_object', Key=key, ContentType=content_type, **params),
+        content=body,
+        headers=dict(headers, **{'Content-Type': content_type})
+    )
+    response.raise_for_status()
+
+
+async def head_object(key):
+    """Return the object's headers (ETag, Content-Length, ...)."""
+    response = await http_client().head(presign('head_object', Key=key))
+    response.raise_for_status()
+    return response.headers
+
+
+class AsyncMultipartUpload:
+    """
+    Non-blocking counterpart of s3_multipart.MultipartUpload: parts upload as
+    tasks while the caller keeps producing data, with the same memory bound.
+    """
+
+    def __init__(self, key, content_type, cache_control=None):
+        self.key = key
+        self.content_type = content_type or 'application/octet-stream'
+        self.cache_control = cache_control
+        self.upload_id = None
+        self.buffer = bytearray()
+        self.parts = []
+        self.pending = []
+        self.size = 0
+
+    async def start(self):
+        params, headers = _cache_params(self.cache_control)
+        response = await http_client().post(
+            presign('create_multipart_upload', Key=self.key, ContentType=self.content_type, **params),
+            headers=dict(headers, **{'Content-Type': self.content_type})
+        )
+        response.raise_for_status()
+        self.upload_id = ET.fromstring(response.content).findtext(f'{S3_NAMESPACE}UploadId')
+
+    async def write(self, data):
+        self.buffer.extend(data)
+        self.size += len(data)
+        if len(self.buffer) >= S3_MULTIPART_PART_SIZE:
+            await self._send_part()
+
+    async def complete(self):
+        if self.buffer or not (self.parts or self.pending):
+            await self._send_part()
+        self.parts.extend(await asyncio.gather(*self.pending))
+        self.pending = []
+        self.parts.sort(key=lambda part: part['PartNumber'])
+
+        body = ''.join(
+            f"<Part><PartNumber>{part['PartNumber']}</PartNumber><ETag>{part['ETag']}</ETag></Part>"
+            for part in self.parts
+        )
+        response = await http_client().post(
+            presign('complete_multipart_upload', Key=self.key, UploadId=self.upload_id),
+            content=f'<CompleteMultipartUpload>{body}</CompleteMultipartUpload>'
+        )
+        response.raise_for_status()
+        # S3 can report a failed completion inside a 200 response
+        if b'<Error>' in response.content:
+            raise IOError(f"Completing multipart upload of {self.key} failed: {response.text[:200]}")
+
+    async def abort(self):
+        for task in self.pending:
+            task.cancel()
+        self.pending = []
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        try:
+            response = await http_client().delete(
+                presign('abort_multipart_upload', Key=self.key, UploadId=self.upload_id)
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.error(f"Error aborting multipart upload of {self.key}: {str(e)}")
+
+    async def _send_part(self):
+        # Bound the number of buffered parts before queueing another one
+        while len(self.pending) >= S3_MULTIPART_MAX_INFLIGHT:
+            self.parts.append(await self.pending.pop(0))
+
+        part_number = len(self.parts) + len(self.pending) + 1
+        body = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.pending.append(asyncio.ensure_future(self._upload_part(part_number, body)))
+
+    async def _upload_part(self, part_number, body):
+        response = await http_client().put(
+            presign('upload_part', Key=self.key, UploadId=self.upload_id, PartNumber=part_number),
+            content=body
+        )
+        response.raise_for_status()
+        return {'PartNumber': part_number, 'ETag': response.headers['ETag']}
+
+
+async def upload_stream(chunks, key, content_type, cache_control=None):
+    """
+    Store an async iterable of byte chunks in S3, like s3_multipart.upload_stream.
+    Returns the number of bytes stored.
+    """
+    buffer = bytearray()
+    upload = None
+    try:
+        async for chunk in chunks:
+            if upload is not None:
+                await upload.write(chunk)
+                continue
+            buffer.extend(chunk)
+            if len(buffer) >= S3_MULTIPART_PART_SIZE:
+                upload = AsyncMultipartUpload(key, content_type, cache_control)
+                await upload.start()
+                await upload.write(bytes(buffer))
+                buffer = bytearray()
+
+        if upload is None:
+            await put_object(key, bytes(buffer), content_type, cache_control)
+            return len(buffer)
+
+        await upload.complete()
+        return upload.size
+    except BaseException:
+        if upload is not None:
+            await upload.abort()
+        raise
@@ -0,0 +1,267 @@
+import json
+import hashlib
+import logging
+from asgiref.sync import sync_to_async
+from PIL import Image
+from django.http import JsonResponse
+from django.urls import reverse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from . import admission, async_storage, cancellation, metrics, uploads, variants
+from .async_generation import agenerate_recorded
+from .generation import (
+    INTERIOR_DESIGN_MODEL, CONTROLNET_MODEL,
+    build_design_input, build_room_design_input, build_layout_input,
+    roomdesign_key, layout_key, UploadError, submit_generation
+)
+from .serializers import (
+    DesignGenerationRequestSerializer, RoomDesignRequestSerializer, Generate3DLayoutRequestSerializer
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Native async versions of the generation and upload endpoints, for serving
+# under ASGI. They answer exactly like their counterparts in views.py.
+
+def request_data(request):
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+    return request.POST
+
+
+def wants_async(request):
+    if request.GET.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+async def job_accepted(request, model, input_data, key_func, room_type=None, timeout=None):
+    design = await sync_to_async(submit_generation)(
+        model, input_data, key_func, room_type=room_type, timeout=timeout
+    )
+    status_url = request.build_absolute_uri(
+        reverse('interiordesign-job-status', args=[design.pk])
+    )
+    response = JsonResponse({
+        'job_id': design.pk,
+        'status': design.status,
+        'status_url': status_url,
+        'events_url': request.build_absolute_uri(reverse('interiordesign-events', args=[design.pk])),
+        'message': 'Generation job accepted'
+    }, status=202)
+    response['Location'] = status_url
+    return response
+
+
+def overloaded(error):
+    response = JsonResponse({
+        'error': 'Too many generations in progress, try again later',
+        'reason': error.reason,
+        'retry_after': error.retry_after,
+        'queued': error.queued
+    }, status=429)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def deadline_exceeded(error):
+    return JsonResponse({'error': str(error), 'reason': error.reason}, status=504)
+
+
+def generated(payload, result):
+    response = JsonResponse(dict(payload, cache=result.cache))
+    response['X-Cache'] = result.cache.upper()
+    return response
+
+
+class AsyncAPIView(View):
+    """Base for the async endpoints; CSRF exempt like DRF's APIView."""
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+
+class AsyncUploadImageView(AsyncAPIView):
+    async def post(self, request):
+        try:
+            existing = await uploads.afind(request.headers.get('X-Content-SHA256'))
+            if existing is not None:
+                return JsonResponse(uploads.upload_payload(existing, deduplicated=True))
+
+            # The body is already spooled by the ASGI handler; parse and hash it off the event loop
+            image = await sync_to_async(read_image_upload, thread_sensitive=False)(request)
+            if image is None:
+                return JsonResponse({'error': 'No image file provided'}, status=400)
+
+            image_file, sha256, width, height = image
+            existing = await uploads.afind(sha256)
+            if existing is not None:
+                return JsonResponse(uploads.upload_payload(existing, deduplicated=True))
+
+            # The hash is known before the transfer, so the upload goes straight to its content key
+            key = uploads.content_key(sha256, image_file.name)
+            try:
+                size = await async_storage.upload_stream(
+                    file_chunks(image_file), key, image_file.content_type or 'application/octet-stream'
+                )
+            except Exception as e:
+                logger.error(f"Error uploading to S3: {str(e)}")
+                return JsonResponse({'error': 'Failed to upload image'}, status=500)
+
+            record = await sync_to_async(uploads.index)(
+                sha256, key, size, width, height, image_file.content_type
+            )
+            return JsonResponse(uploads.upload_payload(record, deduplicated=False))
+
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+
+
+def read_image_upload(request):
+    """Return (file, sha256, width, height) for the image field, or None."""
+    if 'image' not in request.FILES:
+        return None
+
+    image_file = request.FILES['image']
+    digest = hashlib.sha256()
+    for chunk in image_file.chunks():
+        digest.update(chunk)
+
+    width = height = None
+    try:
+        image_file.seek(0)
+        # Opening only reads the header
+        width, height = Image.open(image_file).size
+    except Exception:
+        pass
+    image_file.seek(0)
+    return image_file, digest.hexdigest(), width, height
+
+
+async def file_chunks(image_file):
+    # Reads come from the local spool, not the network
+    for chunk in image_file.chunks():
+        yield chunk
+
+
+class AsyncRoomDesignView(AsyncAPIView):
+    @metrics.instrumented('room-design-async', INTERIOR_DESIGN_MODEL)
+    async def post(self, request):
+        try:
+            serializer = RoomDesignRequestSerializer(data=request_data(request))
+            with metrics.stage('validation'):
+                valid = serializer.is_valid()
+            if not valid:
+                return JsonResponse(serializer.errors, status=400)
+
+            input_data = build_room_design_input(serializer.validated_data)
+            timeout = cancellation.request_timeout(request, serializer.validated_data)
+            if wants_async(request):
+                return await job_accepted(
+                    request, INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                    room_type=serializer.validated_data['room_type'], timeout=timeout
+                )
+
+            try:
+                result = await agenerate_recorded(
+                    INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                    room_type=serializer.validated_data['room_type'], timeout=timeout
+                )
+            except UploadError as e:
+                logger.error(f"Error uploading to S3: {str(e)}")
+                return JsonResponse({'error': 'Failed to upload generated image'}, status=500)
+
+            return generated({
+                'url': result.urls[0],
+                'srcset': variants.srcset(result.urls[0]),
+                'message': 'Room design generated successfully'
+            }, result)
+
+        except admission.Overloaded as e:
+            return overloaded(e)
+        except cancellation.DeadlineExceeded as e:
+            return deadline_exceeded(e)
+        except Exception as e:
+            logger.error(f"Error in room design generation: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+
+
+class AsyncGenerate3DLayoutView(AsyncAPIView):
+    @metrics.instrumented('generate-3d-layout-async', CONTROLNET_MODEL)
+    async def post(self, request):
+        serializer = Generate3DLayoutRequestSerializer(data=request_data(request))
+        with metrics.stage('validation'):
+            valid = serializer.is_valid()
+        if not valid:
+            return JsonResponse(serializer.errors, status=400)
+
+        input_data = build_layout_input(serializer.validated_data)
+        timeout = cancellation.request_timeout(request, serializer.validated_data)
+        try:
+            if wants_async(request):
+                return await job_accepted(request, CONTROLNET_MODEL, input_data, layout_key, timeout=timeout)
+
+            result = await agenerate_recorded(CONTROLNET_MODEL, input_data, layout_key, timeout=timeout)
+            return generated({
+                'message': '3D layout generated successfully',
+                'image_urls': result.urls,
+                'srcsets': [variants.srcset(url) for url in result.urls],
+                'failed_outputs': result.failed
+            }, result)
+
+        except admission.Overloaded as e:
+            return overloaded(e)
+        except cancellation.DeadlineExceeded as e:
+            return deadline_exceeded(e)
+        except Exception as e:
+            logger.error(f"Error generating 3D layout: {str(e)}")
+            return JsonResponse({'error': 'Failed to generate 3D layout'}, status=500)
+
+
+@csrf_exempt
+@require_POST
+@metrics.instrumented('generate-async', INTERIOR_DESIGN_MODEL)
+async def generate_design_async(request):
+    try:
+        serializer = DesignGenerationRequestSerializer(data=request_data(request))
+        with metrics.stage('validation'):
+            valid = serializer.is_valid()
+        if not valid:
+            return JsonResponse(serializer.errors, status=400)
+
+        input_data = build_design_input(serializer.validated_data)
+        timeout = cancellation.request_timeout(request, serializer.validated_data)
+        if wants_async(request):
+            return await job_accepted(
+                request, INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                room_type=serializer.validated_data['room_type'], timeout=timeout
+            )
+
+        try:
+            result = await agenerate_recorded(
+                INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                room_type=serializer.validated_data['room_type'], timeout=timeout
+            )
+        except UploadError as e:
+            logger.error(f"Error uploading to S3: {str(e)}")
+            return JsonResponse({'error': 'Failed to upload generated image'}, status=500)
+
+        return generated({
+            'url': result.urls[0],
+            'srcset': variants.srcset(result.urls[0]),
+            'message': 'Room design generated successfully'
+        }, result)
+
+    except admission.Overloaded as e:
+        return overloaded(e)
+    except cancellation.DeadlineExceeded as e:
+        return deadline_exceeded(e)
+    except Exception as e:
+        logger.error(f"Error in room design generation: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
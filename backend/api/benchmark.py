@@ -0,0 +1,458 @@
+import io
+import os
+import hmac
+import json
+import math
+import time
+import uuid
+import base64
+import random
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Local stand-ins for Replicate and S3, and the load generator used by
+# `manage.py benchmark`. The stand-ins speak just enough of each API for
+# the endpoints under test, and add latency and errors on request.
+
+# latency: mean seconds added to each request; jitter: standard deviation
+# of that latency; error_rate: fraction of requests that fail
+Faults = namedtuple('Faults', ['latency', 'jitter', 'error_rate'], defaults=[0.0, 0.0, 0.0])
+
+
+def _delay(faults):
+    if faults.latency or faults.jitter:
+        time.sleep(max(random.gauss(faults.latency, faults.jitter), 0))
+
+
+def _fails(faults):
+    return random.random() < faults.error_rate
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real services
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = _read_chunks(self.rfile)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            body = _read_chunks(io.BytesIO(body))
+        return body
+
+    def respond(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+def _read_chunks(stream):
+    """Decode a chunked body (HTTP chunked or S3 aws-chunked); trailers are dropped."""
+    body = bytearray()
+    while True:
+        size = int(stream.readline().split(b';')[0].strip() or b'0', 16)
+        if size == 0:
+            # Trailers, up to the blank line
+            while stream.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            return bytes(body)
+        body += stream.read(size)
+        stream.readline()
+
+
+class _Server:
+    handler = None
+
+    def __init__(self, faults=None, host='127.0.0.1', port=0):
+        self.faults = faults or Faults()
+        self.httpd = ThreadingHTTPServer((host, port), self.handler)
+        self.httpd.daemon_threads = True
+        self.httpd.service = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def sample_png(width=512, height=512):
+    """A noisy PNG, so it compresses about as badly as a real render."""
+    from PIL import Image
+
+    out = io.BytesIO()
+    Image.frombytes('RGB', (width, height), os.urandom(width * height * 3)).save(out, 'PNG')
+    return out.getvalue()
+
+
+class _ReplicateHandler(_Handler):
+    def do_POST(self):
+        service = self.server.service
+        if self.path.rstrip('/') != '/v1/predictions':
+            return self.respond(404, b'{"detail": "Not found"}')
+        payload = json.loads(self.read_body() or b'{}')
+
+        created_at = _now()
+        prediction_id = uuid.uuid4().hex
+        if payload.get('webhook'):
+            # Answer right away, and report the outcome to the webhook later
+            prediction = service.prediction(prediction_id, payload, created_at, status='starting')
+            self.respond(201, json.dumps(prediction).encode())
+            threading.Thread(
+                target=service.complete_with_webhook, args=(prediction_id, payload, created_at), daemon=True
+            ).start()
+            return
+
+        started = time.monotonic()
+        _delay(service.faults)
+        if _fails(service.faults):
+            return self.respond(500, b'{"detail": "Internal server error"}')
+        self.respond(201, json.dumps(service.prediction(
+            prediction_id, payload, created_at, predict_time=time.monotonic() - started
+        )).encode())
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path.startswith('/files/'):
+            return self.respond(200, service.output, content_type='image/png')
+        if self.path.rstrip('/') == '/v1/webhooks/default/secret':
+            return self.respond(200, json.dumps({'key': service.webhook_secret}).encode())
+        self.respond(404, b'{"detail": "Not found"}')
+
+
+class FakeReplicate(_Server):
+    """
+    Predictions succeed right away, after the configured latency, and every
+    output is the same PNG. Point REPLICATE_API_BASE_URL at url.
+
+    Predictions created with a webhook are answered at once as starting;
+    the completed prediction is then delivered to the webhook, signed with
+    webhook_secret like Replicate signs them. Deliveries are recorded in
+    webhook_deliveries as (url, HTTP status).
+    """
+    handler = _ReplicateHandler
+
+    def __init__(self, faults=None, output=None, webhook_secret=None, **kwargs):
+        super().__init__(faults, **kwargs)
+        self.output = output or sample_png()
+        self.webhook_secret = webhook_secret or 'whsec_' + base64.b64encode(os.urandom(24)).decode()
+        self.webhook_deliveries = []
+
+    def prediction(self, prediction_id, payload, created_at, status='succeeded', predict_time=None):
+        outputs = [
+            f"{self.url}/files/{prediction_id}-{index}.png"
+            for index in range(int(payload['input'].get('num_outputs', 1)))
+        ]
+        done = status in ('succeeded', 'failed')
+        return {
+            'id': prediction_id,
+            'model': 'benchmark/fake',
+            'version': payload.get('version'),
+            'status': status,
+            'input': payload['input'],
+            'output': outputs if status == 'succeeded' else None,
+            'logs': '',
+            'error': 'Fake prediction failed' if status == 'failed' else None,
+            'metrics': {'predict_time': predict_time} if predict_time is not None else {},
+            'created_at': created_at,
+            'started_at': created_at if done else None,
+            'completed_at': _now() if done else None,
+            'webhook': payload.get('webhook'),
+            'urls': {
+                'get': f"{self.url}/v1/predictions/{prediction_id}",
+                'cancel': f"{self.url}/v1/predictions/{prediction_id}/cancel",
+            },
+        }
+
+    def sign(self, webhook_id, timestamp, body):
+        secret = base64.b64decode(self.webhook_secret.split('_', 1)[1])
+        digest = hmac.new(secret, f"{webhook_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()
+        return f"v1,{base64.b64encode(digest).decode()}"
+
+    def complete_with_webhook(self, prediction_id, payload, created_at):
+        started = time.monotonic()
+        _delay(self.faults)
+        status = 'failed' if _fails(self.faults) else 'succeeded'
+        body = json.dumps(self.prediction(
+            prediction_id, payload, created_at, status=status, predict_time=time.monotonic() - started
+        )).encode()
+
+        webhook_id, timestamp = f"msg_{uuid.uuid4().hex}", str(int(time.time()))
+        request = urllib.request.Request(payload['webhook'], data=body, method='POST', headers={
+            'Content-Type': 'application/json',
+            'webhook-id': webhook_id,
+            'webhook-timestamp': timestamp,
+            'webhook-signature': self.sign(webhook_id, timestamp, body),
+        })
+        # Replicate retries failed deliveries; a few quick attempts will do here
+        for attempt in range(3):
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    self.webhook_deliveries.append((payload['webhook'], response.status))
+                    return
+            except urllib.error.HTTPError as e:
+                self.webhook_deliveries.append((payload['webhook'], e.code))
+                if e.code < 500:
+                    return
+            except OSError:
+                self.webhook_deliveries.append((payload['webhook'], None))
+            time.sleep(0.1 * 2 ** attempt)
+
+
+class _S3Handler(_Handler):
+    def parse(self):
+        parts = urlsplit(self.path)
+        # Path-style addressing: /<bucket>/<key>
+        bucket, _, key = unquote(parts.path).lstrip('/').partition('/')
+        return bucket, key, {name: values[0] for name, values in parse_qs(parts.query, keep_blank_values=True).items()}
+
+    def faulty(self):
+        service = self.server.service
+        _delay(service.faults)
+        if _fails(service.faults):
+            self.respond(503, _error('SlowDown', 'Please reduce your request rate.'), content_type='application/xml')
+            return True
+        return False
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        body = self.read_body()
+        if self.faulty():
+            return
+        service = self.server.service
+        etag = f'"{uuid.uuid4().hex}"'
+
+        if 'uploadId' in query:
+            with service.lock:
+                service.uploads[query['uploadId']][int(query['partNumber'])] = body
+            return self.respond(200, headers={'ETag': etag})
+
+        source = self.headers.get('x-amz-copy-source')
+        if source:
+            source_key = unquote(source).lstrip('/').partition('/')[2]
+            with service.lock:
+                if source_key not in service.objects:
+                    return self.respond(404, _error('NoSuchKey', source_key), content_type='application/xml')
+                service.objects[key] = service.objects[source_key]
+            return self.respond(200, (
+                '<?xml version="1.0" encoding="UTF-8"?><CopyObjectResult>'
+                f'<LastModified>{_now()}</LastModified><ETag>{etag}</ETag></CopyObjectResult>'
+            ).encode(), content_type='application/xml')
+
+        with service.lock:
+            service.objects[key] = (body, self.headers.get('Content-Type', 'binary/octet-stream'))
+        self.respond(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        body = self.read_body()
+        if self.faulty():
+            return
+        service = self.server.service
+
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with service.lock:
+                service.uploads[upload_id] = {}
+                service.upload_types[upload_id] = self.headers.get('Content-Type', 'binary/octet-stream')
+            return self.respond(200, (
+                '<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                f'<Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId>'
+                '</InitiateMultipartUploadResult>'
+            ).encode(), content_type='application/xml')
+
+        if 'uploadId' in query:
+            with service.lock:
+                parts = service.uploads.pop(query['uploadId'], None)
+                content_type = service.upload_types.pop(query['uploadId'], None)
+                if parts is None:
+                    return self.respond(404, _error('NoSuchUpload', key), content_type='application/xml')
+                service.objects[key] = (b''.join(parts[number] for number in sorted(parts)), content_type)
+            return self.respond(200, (
+                '<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                f'<Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>"{uuid.uuid4().hex}"</ETag>'
+                '</CompleteMultipartUploadResult>'
+            ).encode(), content_type='application/xml')
+
+        self.respond(400, _error('InvalidRequest', 'Unsupported request'), content_type='application/xml')
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        if self.faulty():
+            return
+        with self.server.service.lock:
+            stored = self.server.service.objects.get(key)
+        if stored is None:
+            return self.respond(404, _error('NoSuchKey', key), content_type='application/xml')
+        body, content_type = stored
+        self.respond(200, body, content_type=content_type, headers={'ETag': f'"{hash(body) & 0xffffffff:x}"'})
+
+    do_HEAD = do_GET
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        if self.faulty():
+            return
+        service = self.server.service
+        with service.lock:
+            if 'uploadId' in query:
+                service.uploads.pop(query['uploadId'], None)
+                service.upload_types.pop(query['uploadId'], None)
+            else:
+                service.objects.pop(key, None)
+        self.respond(204)
+
+
+def _error(code, message):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<Error><Code>{code}</Code><Message>{message}</Message></Error>'
+    ).encode()
+
+
+class FakeS3(_Server):
+    """
+    An in-memory bucket serving the S3 calls the app makes: objects,
+    multipart uploads and copies. Point AWS_S3_ENDPOINT_URL at url.
+    """
+    handler = _S3Handler
+
+    def __init__(self, faults=None, **kwargs):
+        super().__init__(faults, **kwargs)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.upload_types = {}
+
+
+# Load generation
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values; None when there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(max(math.ceil(fraction * len(ordered)) - 1, 0), len(ordered) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    """Stats of one load run; latencies are of successful requests, in seconds."""
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'max_ms': ms(max(latencies) if latencies else None),
+    }
+
+
+def run_load(send, concurrency, requests):
+    """
+    Call send(index) requests times, concurrency at a time. send returns
+    True on success. Returns summarize() of the run.
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(index):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            ok = send(index)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(requests)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def peak_rss(pid):
+    """
+    Peak resident set size in MiB of a process and its descendants, summed.
+    Read from /proc, so None on platforms without it.
+    """
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f'/proc/{current}/status') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as children:
+                    pending.extend(int(child) for child in children.read().split())
+    except (OSError, ValueError):
+        if not total:
+            return None
+    return round(total / 1024, 1)
+
+
+def compare(current, previous):
+    """
+    Rows of (scenario, concurrency, metric, before, after, change %) for
+    the runs two benchmark results have in common.
+    """
+    before = {(run['scenario'], run['concurrency']): run for run in previous['runs']}
+    rows = []
+    for run in current['runs']:
+        old = before.get((run['scenario'], run['concurrency']))
+        if old is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'rps', 'peak_rss_mb'):
+            if run.get(metric) is None or old.get(metric) is None:
+                continue
+            change = (run[metric] - old[metric]) / old[metric] * 100 if old[metric] else None
+            rows.append((run['scenario'], run['concurrency'], metric, old[metric], run[metric], change))
+    return rows
@@ -0,0 +1,182 @@
+import os
+import time
+import logging
+import contextvars
+from datetime import timedelta
+from collections import namedtuple
+from contextlib import contextmanager
+from django.utils import timezone
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Generations stop once nobody waits for them: when the deadline their
+# client sent passes, or when the client goes away. Their prediction is
+# cancelled on Replicate and nothing is stored in S3.
+# Clients send how many seconds they'll wait in this header or a timeout field
+TIMEOUT_HEADER = 'X-Request-Timeout'
+# Longest timeout accepted; longer ones are cut to it
+GENERATION_MAX_TIMEOUT = float(os.getenv("GENERATION_MAX_TIMEOUT", "600"))
+# A job whose event stream closed is cancelled unless a stream reopens within
+# this many seconds; EventSource reconnects after a few
+ABANDONED_JOB_GRACE = float(os.getenv("ABANDONED_JOB_GRACE", "15"))
+# How often a running job checks whether it was abandoned
+ABANDONED_CHECK_INTERVAL = 1.0
+
+
+class Cancelled(Exception):
+    """The client went away; nobody wants the generation anymore."""
+    reason = 'disconnect'
+
+
+class DeadlineExceeded(Cancelled):
+    """The client's deadline passed before the generation finished."""
+    reason = 'deadline'
+
+
+# deadline: time.monotonic() by which to be done, or None;
+# gone: callable telling whether the client went away, or None
+Scope = namedtuple('Scope', ['deadline', 'gone'])
+
+_scope = contextvars.ContextVar('cancellation_scope', default=None)
+
+
+def request_timeout(request, data=None):
+    """
+    Seconds the client will wait for a generation, from the timeout header
+    or the (validated) timeout field, whichever is shorter; None if neither
+    is given. Malformed headers are ignored.
+    """
+    timeouts = []
+    header = request.headers.get(TIMEOUT_HEADER)
+    if header:
+        try:
+            timeouts.append(float(header))
+        except ValueError:
+            pass
+    if data and data.get('timeout') is not None:
+        timeouts.append(data['timeout'])
+    timeouts = [timeout for timeout in timeouts if timeout > 0]
+    return min(min(timeouts), GENERATION_MAX_TIMEOUT) if timeouts else None
+
+
+@contextmanager
+def scope(timeout=None, deadline=None, gone=None):
+    """
+    Run a generation that stops when timeout seconds pass (or at the
+    monotonic deadline), or when gone() says the client went away.
+    """
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    if deadline is None and gone is None:
+        yield
+        return
+    token = _scope.set(Scope(deadline, gone))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def active():
+    return _scope.get() is not None
+
+
+def remaining():
+    """Seconds left until the current deadline, or None if there is none."""
+    current = _scope.get()
+    if current is None or current.deadline is None:
+        return None
+    return max(0.0, current.deadline - time.monotonic())
+
+
+def check():
+    """Raise (and count) Cancelled if the current generation should stop."""
+    current = _scope.get()
+    if current is None:
+        return
+    error = None
+    if current.deadline is not None and time.monotonic() >= current.deadline:
+        error = DeadlineExceeded("Deadline exceeded")
+    elif current.gone is not None and current.gone():
+        error = Cancelled("Client went away")
+    if error is not None:
+        metrics.cancelled(error.reason)
+        raise error
+
+
+def cancel_prediction(client, prediction_id):
+    """Cancel a prediction nobody waits for anymore, so it stops running (and billing)."""
+    try:
+        client.predictions.cancel(prediction_id)
+    except Exception as e:
+        logger.warning(f"Could not cancel prediction {prediction_id}: {str(e)}")
+
+
+async def acancel_prediction(client, prediction_id):
+    """Async counterpart of cancel_prediction."""
+    try:
+        await client.predictions.async_cancel(prediction_id)
+    except Exception as e:
+        logger.warning(f"Could not cancel prediction {prediction_id}: {str(e)}")
+
+
+# Jobs outlive their request, so they stop on their stored deadline, or
+# once the client that followed their event stream is gone.
+
+def job_deadline(timeout):
+    """InteriorDesign.deadline for a job submitted with timeout."""
+    return timezone.now() + timedelta(seconds=timeout) if timeout is not None else None
+
+
+class _Abandoned:
+    """gone() for a job: its event stream closed and didn't reopen in time."""
+
+    def __init__(self, design_id):
+        self.design_id = design_id
+        self.checked = 0.0
+
+    def __call__(self):
+        from .models import InteriorDesign
+
+        now = time.monotonic()
+        if now - self.checked < ABANDONED_CHECK_INTERVAL:
+            return False
+        self.checked = now
+        abandoned_at = InteriorDesign.objects.filter(pk=self.design_id).values_list('abandoned_at', flat=True).first()
+        return abandoned(abandoned_at)
+
+
+def abandoned(abandoned_at):
+    return abandoned_at is not None and timezone.now() - abandoned_at >= timedelta(seconds=ABANDONED_JOB_GRACE)
+
+
+def stopped(design):
+    """The Cancelled error for a job whose client stopped waiting, else None."""
+    if design.deadline is not None and timezone.now() >= design.deadline:
+        return DeadlineExceeded("Deadline exceeded")
+    if abandoned(design.abandoned_at):
+        return Cancelled("Client went away")
+    return None
+
+
+def job_scope(design_id, deadline=None):
+    """scope() for a generation job with the stored deadline (a datetime)."""
+    if deadline is not None:
+        deadline = time.monotonic() + (deadline - timezone.now()).total_seconds()
+    return scope(deadline=deadline, gone=_Abandoned(design_id))
+
+
+def attached(design_id):
+    """An event stream of the job opened."""
+    from .models import InteriorDesign
+
+    InteriorDesign.objects.filter(pk=design_id, abandoned_at__isnull=False).update(abandoned_at=None)
+
+
+def detached(design_id):
+    """The client closed an event stream of the job before it finished."""
+    from .models import InteriorDesign
+
+    InteriorDesign.objects.filter(pk=design_id, status='processing').update(abandoned_at=timezone.now())
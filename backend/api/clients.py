@@ -0,0 +1,192 @@
+import os
+import random
+import asyncio
+import weakref
+import logging
+import threading
+from collections import Counter, defaultdict
+from django.utils.functional import empty
+
+logger = logging.getLogger(__name__)
+
+
+# Long-lived, shared Replicate and S3 clients. Connections are kept alive
+# between requests so TLS handshakes stay off the request path. The SDKs
+# are imported on first use to keep them out of cold starts.
+
+# Connections kept open per client (per host for S3)
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "32"))
+# How long an idle connection is kept for reuse, in seconds
+CLIENT_KEEPALIVE_EXPIRY = float(os.getenv("CLIENT_KEEPALIVE_EXPIRY", "60"))
+CLIENT_CONNECT_TIMEOUT = float(os.getenv("CLIENT_CONNECT_TIMEOUT", "5"))
+CLIENT_READ_TIMEOUT = float(os.getenv("CLIENT_READ_TIMEOUT", "60"))
+# Retries on connection errors and throttling
+CLIENT_MAX_RETRIES = int(os.getenv("CLIENT_MAX_RETRIES", "3"))
+# Replicate API to use instead of api.replicate.com, e.g. the benchmark's local stand-in
+REPLICATE_API_BASE_URL = os.getenv("REPLICATE_API_BASE_URL")
+
+
+_stats = defaultdict(Counter)
+_stats_lock = threading.Lock()
+
+# httpcore trace events that mean a new connection was opened
+_TRACE_EVENTS = {
+    'connection.connect_tcp.complete': 'connections',
+    'connection.start_tls.complete': 'tls_handshakes',
+}
+
+
+def _record(name, counter):
+    with _stats_lock:
+        _stats[name][counter] += 1
+
+
+def connection_stats():
+    """
+    Requests sent and connections opened per client since the process
+    started. reused is the number of requests that found an open connection.
+    """
+    with _stats_lock:
+        stats = {name: dict(counts) for name, counts in _stats.items()}
+
+    from .storage import s3_client
+    # Don't create the S3 client just to report that it's unused
+    stats['s3'] = _urllib3_stats(s3_client) if s3_client._wrapped is not empty else {}
+
+    for counts in stats.values():
+        for counter in ('requests', 'connections', 'tls_handshakes'):
+            counts.setdefault(counter, 0)
+        counts['reused'] = max(counts['requests'] - counts['connections'], 0)
+    return stats
+
+
+def _urllib3_stats(client):
+    # botocore doesn't expose its urllib3 pools; read their counters directly
+    counts = Counter()
+    try:
+        pools = client._endpoint.http_session._manager.pools
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            counts['requests'] += pool.num_requests
+            counts['connections'] += pool.num_connections
+            if pool.scheme == 'https':
+                counts['tls_handshakes'] += pool.num_connections
+    except Exception as e:
+        logger.warning(f"Could not read S3 connection pool stats: {str(e)}")
+    return dict(counts)
+
+
+def _retry_delay(response, attempt):
+    """Honor Retry-After when the server sends one, else back off exponentially with jitter."""
+    try:
+        return min(float(response.headers['Retry-After']), 60.0)
+    except (KeyError, ValueError):
+        return min(0.5 * 2 ** attempt, 8.0) * (1 + random.random() * 0.1)
+
+
+def _should_retry(request, response, attempt):
+    # Replicate's own transport retries throttled idempotent requests; a
+    # throttled POST was never processed, so it is safe to send again too
+    return (
+        request.method == 'POST'
+        and response.status_code == 429
+        and attempt < CLIENT_MAX_RETRIES
+    )
+
+
+def _limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=CLIENT_POOL_SIZE,
+        max_keepalive_connections=CLIENT_POOL_SIZE,
+        keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY
+    )
+
+
+def _timeout():
+    import httpx
+    return httpx.Timeout(CLIENT_READ_TIMEOUT, connect=CLIENT_CONNECT_TIMEOUT)
+
+
+def build_s3_client(**kwargs):
+    """A boto3 S3 client; boto3 clients are safe to share between threads."""
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        "s3",
+        config=Config(
+            max_pool_connections=CLIENT_POOL_SIZE,
+            connect_timeout=CLIENT_CONNECT_TIMEOUT,
+            read_timeout=CLIENT_READ_TIMEOUT,
+            # Adaptive mode also rate limits the client when S3 throttles it
+            retries={'max_attempts': CLIENT_MAX_RETRIES, 'mode': 'adaptive'},
+            tcp_keepalive=True,
+        ),
+        **kwargs
+    )
+
+
+_replicate_client = None
+_replicate_client_lock = threading.Lock()
+
+
+def replicate_client():
+    """The process-wide Replicate client, also used to download prediction outputs."""
+    global _replicate_client
+    with _replicate_client_lock:
+        if _replicate_client is None:
+            import httpx
+            import replicate
+            from .transports import TracedTransport
+
+            _replicate_client = replicate.Client(
+                api_token=os.getenv('REPLICATE_API_TOKEN'),
+                base_url=REPLICATE_API_BASE_URL,
+                timeout=_timeout(),
+                transport=TracedTransport(
+                    'replicate', httpx.HTTPTransport(limits=_limits(), retries=CLIENT_MAX_RETRIES)
+                )
+            )
+        return _replicate_client
+
+
+# Async clients are bound to the event loop they were first used on
+_async_replicate_clients = weakref.WeakKeyDictionary()
+_async_http_clients = weakref.WeakKeyDictionary()
+
+
+def async_replicate_client():
+    loop = asyncio.get_running_loop()
+    client = _async_replicate_clients.get(loop)
+    if client is None:
+        import httpx
+        import replicate
+        from .transports import AsyncTracedTransport
+
+        client = _async_replicate_clients[loop] = replicate.Client(
+            api_token=os.getenv('REPLICATE_API_TOKEN'),
+            base_url=REPLICATE_API_BASE_URL,
+            timeout=_timeout(),
+            transport=AsyncTracedTransport(
+                'replicate_async', httpx.AsyncHTTPTransport(limits=_limits(), retries=CLIENT_MAX_RETRIES)
+            )
+        )
+    return client
+
+
+def async_http_client():
+    """Client for the presigned S3 requests made by the async views."""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        import httpx
+        from .transports import AsyncTracedTransport
+
+        client = _async_http_clients[loop] = httpx.AsyncClient(
+            timeout=_timeout(),
+            transport=AsyncTracedTransport(
+                's3_async', httpx.AsyncHTTPTransport(limits=_limits(), retries=CLIENT_MAX_RETRIES)
+            )
+        )
+    return client
@@ -0,0 +1,18 @@
+from contextlib import contextmanager
+from django.db import close_old_connections
+
+
+@contextmanager
+def worker_connection():
+    """
+    Connection handling for database work on a worker thread, as Django
+    does around each request: a connection that is broken or older than
+    CONN_MAX_AGE is closed before and after, and a reused one is health
+    checked before its first query. With pooling, the connection goes back
+    to the pool afterwards.
+    """
+    close_old_connections()
+    try:
+        yield
+    finally:
+        close_old_connections()
@@ -0,0 +1,258 @@
+import io
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .models import InteriorDesign, UploadedImage
+from .storage import s3_client, AWS_BUCKET_NAME, s3_url
+from .db import worker_connection
+
+logger = logging.getLogger(__name__)
+
+
+# Set to 1 to send layouts of uploaded floor plans a precomputed edge map instead
+# of having ControlNet run HED on the plan every time. Off by default: the map
+# goes in as a scribble, which changes what the model draws.
+PRECOMPUTE_EDGE_MAPS = os.getenv("PRECOMPUTE_EDGE_MAPS", "0") == "1"
+# 'hed' for soft, multi-scale edges like HED's; 'canny' for thin, binary ones
+EDGE_MAP_DETECTOR = os.getenv("EDGE_MAP_DETECTOR", "hed")
+# ControlNet structure a precomputed map is sent as; scribble uses the image as the map
+EDGE_MAP_STRUCTURE = 'scribble'
+
+CANNY_LOW_THRESHOLD = 0.1
+CANNY_HIGH_THRESHOLD = 0.3
+
+
+def edge_map_key(digest, size, detector=None):
+    """Key of the edge map of an image, by its image_digest()."""
+    detector = detector or EDGE_MAP_DETECTOR
+    return f"edge_maps/{digest.replace(':', '-')}-{detector}-{size}.png"
+
+
+# Gray-scale filters on float arrays, vectorized over the whole image
+
+def grayscale(data, size):
+    """Decode an image to a float array in [0, 1], its longest edge at most size."""
+    from PIL import Image, ImageOps
+    import numpy as np
+
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', (size, size))
+    image = ImageOps.exif_transpose(image).convert('L')
+    image.thumbnail((size, size), Image.LANCZOS)
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def gaussian_blur(array, sigma):
+    import numpy as np
+
+    radius = max(1, int(3 * sigma))
+    offsets = np.arange(-radius, radius + 1)
+    kernel = np.exp(-(offsets ** 2) / (2 * sigma ** 2))
+    kernel /= kernel.sum()
+
+    # Separable: one pass along each axis
+    height, width = array.shape
+    padded = np.pad(array, ((0, 0), (radius, radius)), mode='edge')
+    rows = sum(weight * padded[:, i:i + width] for i, weight in enumerate(kernel))
+    padded = np.pad(rows, ((radius, radius), (0, 0)), mode='edge')
+    return sum(weight * padded[i:i + height, :] for i, weight in enumerate(kernel))
+
+
+def sobel(array):
+    """Horizontal and vertical gradients of an array."""
+    import numpy as np
+
+    p = np.pad(array, 1, mode='edge')
+    gx = (p[:-2, 2:] + 2 * p[1:-1, 2:] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[1:-1, :-2] + p[2:, :-2])
+    gy = (p[2:, :-2] + 2 * p[2:, 1:-1] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[:-2, 1:-1] + p[:-2, 2:])
+    return gx, gy
+
+
+def soft_edges(gray, sigmas=(1.0, 2.0, 4.0)):
+    """
+    HED-style soft edges: gradient magnitudes at several scales, averaged,
+    so strong outlines like walls stand out over texture. Values in [0, 1].
+    """
+    import numpy as np
+
+    fused = np.zeros_like(gray)
+    for sigma in sigmas:
+        gx, gy = sobel(gaussian_blur(gray, sigma))
+        magnitude = np.hypot(gx, gy)
+        peak = magnitude.max()
+        if peak > 0:
+            fused += magnitude / peak
+    fused /= len(sigmas)
+    peak = fused.max()
+    return np.sqrt(fused / peak) if peak > 0 else fused
+
+
+def canny_edges(gray, low=CANNY_LOW_THRESHOLD, high=CANNY_HIGH_THRESHOLD, sigma=1.4):
+    """
+    Canny edges: blur, gradients, non-maximum suppression along the gradient
+    direction and hysteresis between low and high (fractions of the strongest
+    gradient). Returns a boolean array.
+    """
+    import numpy as np
+
+    gx, gy = sobel(gaussian_blur(gray, sigma))
+    magnitude = np.hypot(gx, gy)
+    angle = np.rad2deg(np.arctan2(gy, gx)) % 180
+
+    # Neighbours on either side along the gradient, for each of 4 directions
+    p = np.pad(magnitude, 1)
+    neighbours = {
+        0: (p[1:-1, 2:], p[1:-1, :-2]),
+        45: (p[2:, 2:], p[:-2, :-2]),
+        90: (p[2:, 1:-1], p[:-2, 1:-1]),
+        135: (p[2:, :-2], p[:-2, 2:]),
+    }
+    direction = (np.round(angle / 45) % 4) * 45
+    thin = np.zeros(magnitude.shape, dtype=bool)
+    for degrees, (before, after) in neighbours.items():
+        mask = direction == degrees
+        thin |= mask & (magnitude >= before) & (magnitude >= after)
+    magnitude = np.where(thin, magnitude, 0)
+
+    peak = magnitude.max()
+    if peak == 0:
+        return np.zeros(magnitude.shape, dtype=bool)
+    strong = magnitude >= high * peak
+    weak = magnitude >= low * peak
+
+    # Hysteresis: grow the strong edges into connected weak ones
+    edges = strong
+    while True:
+        p = np.pad(edges, 1)
+        grown = weak & (
+            p[:-2, :-2] | p[:-2, 1:-1] | p[:-2, 2:] | p[1:-1, :-2] | p[1:-1, 1:-1] |
+            p[1:-1, 2:] | p[2:, :-2] | p[2:, 1:-1] | p[2:, 2:]
+        )
+        if (grown == edges).all():
+            return edges
+        edges = grown
+
+
+def render_edge_map(data, size, detector=None):
+    """
+    PNG edge map of an image, sized to the layout model's resolution. Edges
+    are dark on white, which is how ControlNet's scribble preprocessor reads them.
+    """
+    from PIL import Image
+    import numpy as np
+
+    gray = grayscale(data, size)
+    if (detector or EDGE_MAP_DETECTOR) == 'canny':
+        edges = canny_edges(gray).astype(np.float32)
+    else:
+        edges = soft_edges(gray)
+
+    out = io.BytesIO()
+    Image.fromarray((255 - edges * 255).astype(np.uint8), 'L').save(out, 'PNG', optimize=True)
+    return out.getvalue()
+
+
+# Keys of edge maps this process has stored or seen, least recently used first;
+# only the most recent EDGE_MAP_KEYS_REMEMBERED are kept
+EDGE_MAP_KEYS_REMEMBERED = 1024
+_stored_keys = OrderedDict()
+_stored_keys_lock = threading.Lock()
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='edge-maps')
+
+
+def _remember(key):
+    with _stored_keys_lock:
+        _stored_keys[key] = True
+        _stored_keys.move_to_end(key)
+        while len(_stored_keys) > EDGE_MAP_KEYS_REMEMBERED:
+            _stored_keys.popitem(last=False)
+
+
+def stored_key(digest, size):
+    """Key of an image's edge map if this process has stored or seen it."""
+    key = edge_map_key(digest, size)
+    return key if key in _stored_keys else None
+
+
+def edge_map(url, digest, size):
+    """
+    Key of the edge map of an image in our bucket, if it has been made.
+    Returns None for other images, or when there's no map yet, so ControlNet
+    detects edges itself; a missing map is made in the background for the
+    next layout, never in the request.
+    """
+    bucket_prefix = s3_url('')
+    if not PRECOMPUTE_EDGE_MAPS or not digest or not url.startswith(bucket_prefix):
+        return None
+
+    key = edge_map_key(digest, size)
+    if key in _stored_keys:
+        _remember(key)
+        return key
+
+    try:
+        if InteriorDesign.objects.filter(edge_map=key).exists() or _exists(key):
+            _remember(key)
+            return key
+    except Exception as e:
+        logger.warning(f"Could not look up the edge map of {url[:100]}: {str(e)}")
+        return None
+
+    # Uploaded before edge maps were turned on, or still being made
+    _executor.submit(_store_in_worker, url[len(bucket_prefix):], digest, size)
+    return None
+
+
+def store_edge_map(source_key, digest, size):
+    """Compute and store the edge map of an object in our bucket, unless it exists. Returns its key."""
+    key = edge_map_key(digest, size)
+    if key in _stored_keys or _exists(key):
+        _remember(key)
+        return key
+
+    original = s3_client.get_object(Bucket=AWS_BUCKET_NAME, Key=source_key)['Body'].read()
+    s3_client.put_object(
+        Bucket=AWS_BUCKET_NAME,
+        Key=key,
+        Body=render_edge_map(original, size),
+        ContentType='image/png'
+    )
+    _remember(key)
+    return key
+
+
+def schedule(upload_id):
+    """Make a new upload's edge map in the background, ready for its first layout."""
+    if PRECOMPUTE_EDGE_MAPS:
+        _executor.submit(_store_upload_in_worker, upload_id)
+
+
+def _store_upload_in_worker(upload_id):
+    from .generation import LAYOUT_IMAGE_RESOLUTION
+
+    with worker_connection():
+        try:
+            upload = UploadedImage.objects.get(pk=upload_id)
+            store_edge_map(upload.key, f"sha256:{upload.sha256}", LAYOUT_IMAGE_RESOLUTION)
+        except Exception as e:
+            logger.warning(f"Could not make an edge map of upload {upload_id}: {str(e)}")
+
+
+def _store_in_worker(source_key, digest, size):
+    try:
+        store_edge_map(source_key, digest, size)
+    except Exception as e:
+        logger.warning(f"Could not make an edge map of {source_key[:100]}: {str(e)}")
+
+
+def _exists(key):
+    from botocore.exceptions import ClientError
+
+    try:
+        s3_client.head_object(Bucket=AWS_BUCKET_NAME, Key=key)
+        return True
+    except ClientError:
+        return False
@@ -0,0 +1,554 @@
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .clients import replicate_client
+from django.conf import settings
+from . import admission, cancellation, edges, metrics, normalize, prediction_cache, progress, single_flight, variants
+from .storage import s3_client, AWS_BUCKET_NAME, s3_url
+from .s3_multipart import upload_stream
+from .db import worker_connection
+from .models import FloorPlan, InteriorDesign, UploadedImage
+
+logger = logging.getLogger(__name__)
+
+
+INTERIOR_DESIGN_MODEL = "adirik/interior-design:76604baddc85b1b4616e1c6475eca080da339c8875bd4996705440484a6eac38"
+CONTROLNET_MODEL = "rossjillian/controlnet:795433b19458d0f4fa172a7ccf93178d2adb1cb8ab2ad6c8fdc33fdbcd49f477"
+
+LAYOUT_BASE_PROMPT = "Use this exact floor plan of **THE GIVEN ROOM** to generate a realistic 3D interior layout **ONLY FOR ONE GIVEN ROOM. DON'T ADD ANY OTHER ROOM**"
+
+# The layout model renders at this resolution
+LAYOUT_IMAGE_RESOLUTION = 512
+# Longest edge of the input image each model is sent; uploads are downscaled to it
+MODEL_INPUT_SIZES = {
+    INTERIOR_DESIGN_MODEL: int(os.getenv("INTERIOR_DESIGN_INPUT_SIZE", "1024")),
+    CONTROLNET_MODEL: LAYOUT_IMAGE_RESOLUTION,
+}
+
+# Size of the local worker pool that runs submitted (async) generation jobs
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+# Outputs of one prediction that are downloaded and uploaded concurrently
+OUTPUT_UPLOAD_WORKERS = int(os.getenv("OUTPUT_UPLOAD_WORKERS", "4"))
+# Variants of batch requests that run at the same time
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+# Most variants accepted in one batch request
+BATCH_MAX_VARIANTS = int(os.getenv("BATCH_MAX_VARIANTS", "10"))
+
+
+def build_design_input(data):
+    """Replicate input for the /api/generate/ endpoint."""
+    prompt = f"""A high quality resolution image of a {data['theme']}-themed {data['room_type']} with a {data['color']} 
+                    color design with the following instructions: {data['additional_notes']}"""
+    return {
+        "image": data['image'],
+        "prompt": prompt,
+    }
+
+
+def build_room_design_input(data):
+    """Replicate input for the /api/room-design/ endpoint."""
+    prompt = f"""Generate a high quality resolution image of a {data['theme']}-themed {data['room_type']} with a {data['color']} 
+                        color design with {data['accessories']}. With these furniture {data['furniture']}. Soft rugs, {data['walls']} walls, and 
+                        {data['lights']} create warmth, making it {data['realistic']}."""
+    return {
+        "image": data['image'],
+        "prompt": prompt,
+    }
+
+
+def build_layout_input(data):
+    """Replicate input for the /api/generate-3d-layout/ endpoint."""
+    return {
+        "image": data['image'],
+        "prompt": data['prompt'] + LAYOUT_BASE_PROMPT,
+        "structure": "hed",
+        "image_resolution": LAYOUT_IMAGE_RESOLUTION,
+        "num_outputs": data.get('num_outputs', 1),
+        "scale": 15,
+        "steps": 20,
+        "negative_prompt": "empty room, no furniture, missing objects, blank space, extra rooms",
+    }
+
+
+def normalized_input(model, input_data, digest=None):
+    """
+    Swap an uploaded input image for its copy normalized to the model's input
+    size. Layouts of an uploaded floor plan are sent its precomputed edge map
+    instead, so ControlNet doesn't run HED on the same plan every time.
+    """
+    if model == CONTROLNET_MODEL and input_data.get('structure') == 'hed':
+        key = edges.edge_map(input_data['image'], digest, LAYOUT_IMAGE_RESOLUTION)
+        if key is not None:
+            return dict(input_data, image=s3_url(key), structure=edges.EDGE_MAP_STRUCTURE)
+
+    max_size = MODEL_INPUT_SIZES.get(model)
+    if max_size is None:
+        return input_data
+    return dict(input_data, image=normalize.normalized_url(input_data['image'], max_size))
+
+
+def roomdesign_key():
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    unique_id = uuid.uuid4().hex[:8]
+    filename = f"roomdesign_{timestamp}_{unique_id}.png"
+    return os.path.join('roomdesign', filename)
+
+
+def layout_key():
+    return f"generated_layouts/{uuid.uuid4()}.png"
+
+
+class UploadError(Exception):
+    """A prediction succeeded but its output could not be stored in S3."""
+
+
+# urls: S3 URLs of the stored outputs; cache: 'hit', 'miss' or 'coalesced';
+# failed: number of outputs that could not be stored
+GenerationResult = namedtuple('GenerationResult', ['urls', 'cache', 'failed'], defaults=[0])
+
+
+def image_digest(url):
+    """
+    Identify the content behind an input image URL.
+
+    Uploads in the local index are identified by their content hash, other
+    objects in our bucket by their S3 ETag and anything else is downloaded
+    and hashed. Returns None when the image can't be read, which makes the
+    request uncacheable rather than failing it.
+    """
+    bucket_prefix = s3_url('')
+    try:
+        if url.startswith(bucket_prefix):
+            key = url[len(bucket_prefix):]
+            uploaded = UploadedImage.objects.filter(key=key).first()
+            if uploaded is not None:
+                return f"sha256:{uploaded.sha256}"
+            head = s3_client.head_object(Bucket=AWS_BUCKET_NAME, Key=key)
+            etag = head['ETag'].strip('"')
+            return f"etag:{etag}"
+
+        import requests
+
+        digest = hashlib.sha256()
+        with requests.get(url, stream=True, timeout=10) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                digest.update(chunk)
+        return f"sha256:{digest.hexdigest()}"
+    except Exception as e:
+        logger.warning(f"Could not hash input image {url[:100]}: {str(e)}")
+        return None
+
+
+def run_prediction(model, input_data):
+    """
+    Run a prediction and wait for its output. Unlike replicate.run(), this
+    keeps the prediction, so its queueing and inference time are recorded.
+    Inside a generation job, or with a deadline, the prediction is polled
+    instead, reporting its step progress as it runs, and cancelled when
+    nobody waits for it anymore.
+    """
+    from replicate.exceptions import ModelError
+    from replicate.helpers import transform_output
+
+    client = replicate_client()
+    with admission.prediction_slot():
+        # The deadline may have passed while waiting for the slot
+        cancellation.check()
+        progress.report(progress.RUNNING)
+        started = time.perf_counter()
+        if progress.tracking() or cancellation.active():
+            prediction = client.predictions.create(version=model.split(':', 1)[1], input=input_data)
+            try:
+                while prediction.status not in ('succeeded', 'failed', 'canceled'):
+                    cancellation.check()
+                    remaining = cancellation.remaining()
+                    time.sleep(client.poll_interval if remaining is None else min(client.poll_interval, remaining))
+                    prediction.reload()
+                    step = prediction.progress
+                    progress.report(progress.RUNNING, step.percentage if step else None)
+            except cancellation.Cancelled:
+                cancellation.cancel_prediction(client, prediction.id)
+                raise
+        else:
+            prediction = client.predictions.create(version=model.split(':', 1)[1], input=input_data, wait=True)
+            if prediction.status not in ('succeeded', 'failed', 'canceled'):
+                prediction.wait()
+    metrics.observe_prediction(prediction, time.perf_counter() - started)
+
+    if prediction.status != 'succeeded':
+        raise ModelError(prediction)
+    return transform_output(prediction.output, client)
+
+
+def as_outputs(output):
+    """Normalize a prediction result to a list of file outputs."""
+    if hasattr(output, 'read'):
+        return [output]
+    return list(output)
+
+
+def output_chunks(item):
+    """Yield a prediction output in chunks as it downloads from Replicate."""
+    from replicate.helpers import FileOutput
+
+    if isinstance(item, str):
+        # The SDK only wraps https URLs; download plain ones the same way
+        item = FileOutput(item, replicate_client())
+    if isinstance(item, FileOutput):
+        yield from item
+    else:
+        yield item.read()
+
+
+def upload_output(item, key):
+    """
+    Stream a single prediction output to S3 and return its public URL.
+    Its smaller WebP/AVIF variants are rendered in the background.
+    """
+    spool = variants.Spool()
+    download = metrics.TimedIterator(output_chunks(item))
+    started = time.perf_counter()
+    try:
+        upload_stream(
+            spool.tee(download), key, 'image/png',
+            cache_control=variants.IMMUTABLE_CACHE_CONTROL
+        )
+    except Exception:
+        spool.discard()
+        raise
+    finally:
+        # Downloading and uploading overlap; time waiting on Replicate counts as download
+        metrics.observe('output_download', download.seconds)
+        metrics.observe('upload', time.perf_counter() - started - download.seconds)
+    variants.schedule(key, spool)
+    return s3_url(key)
+
+
+_output_executor = ThreadPoolExecutor(
+    max_workers=OUTPUT_UPLOAD_WORKERS,
+    thread_name_prefix='output-upload'
+)
+
+
+def upload_outputs(items, key_func):
+    """
+    Store prediction outputs in S3, several at a time.
+
+    Returns (urls, failed): the URLs of the outputs that were stored, in
+    output order, and how many could not be. Raises UploadError only when
+    none of them could be stored.
+    """
+    keys = [key_func() for _ in items]
+    if len(items) == 1:
+        futures = None
+        attempts = [lambda: upload_output(items[0], keys[0])]
+    else:
+        futures = [
+            _output_executor.submit(metrics.in_context(upload_output), item, key)
+            for item, key in zip(items, keys)
+        ]
+        attempts = [future.result for future in futures]
+
+    urls = []
+    errors = []
+    for attempt in attempts:
+        try:
+            urls.append(attempt())
+        except Exception as e:
+            logger.error(f"Error uploading to S3: {str(e)}")
+            errors.append(e)
+
+    if errors and not urls:
+        raise UploadError(str(errors[0])) from errors[0]
+    return urls, len(errors)
+
+
+def generate(model, input_data, key_func, digest=None, admit=False):
+    """
+    Run a prediction and store its outputs in S3, serving repeated requests
+    for the same model, image content and inputs from the prediction cache
+    and coalescing identical requests that are still in flight.
+
+    digest is the input image's image_digest(), when the caller already has it.
+    admit takes from the client's rate limit, only when a prediction is run.
+    """
+    if digest is None:
+        digest = image_digest(input_data['image'])
+    cache_key = prediction_cache.prediction_key(model, input_data, digest) if digest else None
+
+    with metrics.stage('cache_lookup'):
+        cached_urls = prediction_cache.lookup(cache_key)
+    if cached_urls is not None:
+        metrics.cache_result('hit')
+        return GenerationResult(cached_urls, 'hit')
+
+    def predict():
+        if admit:
+            admission.admit()
+        with metrics.stage('normalize'):
+            model_input = normalized_input(model, input_data, digest)
+        output = run_prediction(model, model_input)
+        # Nothing is stored for a client that stopped waiting
+        cancellation.check()
+        progress.report(progress.UPLOADING)
+        urls, failed = upload_outputs(as_outputs(output), key_func)
+
+        # A partial batch is returned but not cached
+        if not failed:
+            prediction_cache.store(cache_key, model, urls)
+        return GenerationResult(urls, 'miss', failed)
+
+    def recheck():
+        # Another worker ran the same prediction; its outputs are in the cache
+        urls = prediction_cache.lookup(cache_key)
+        return GenerationResult(urls, 'coalesced') if urls is not None else None
+
+    led = []
+
+    def lead():
+        led.append(True)
+        return predict()
+
+    # Identical requests already in flight share one prediction and upload
+    try:
+        result, shared = single_flight.run(single_flight.flight_key(model, input_data), lead, recheck)
+    except cancellation.Cancelled:
+        if led:
+            raise
+        # The request this one waited on was cancelled for its own client; run it for this one
+        result, shared = single_flight.run(single_flight.flight_key(model, input_data), predict, recheck)
+    if shared:
+        result = result._replace(cache='coalesced')
+    metrics.cache_result(result.cache)
+    return result
+
+
+# Batch generation
+
+_batch_executor = None
+
+
+def _get_batch_executor():
+    global _batch_executor
+    if _batch_executor is None:
+        _batch_executor = ThreadPoolExecutor(
+            max_workers=BATCH_WORKERS,
+            thread_name_prefix='batch'
+        )
+    return _batch_executor
+
+
+def _run_variant(model, input_data, key_func, digest, deadline, gone):
+    with worker_connection(), cancellation.scope(deadline=deadline, gone=gone):
+        return generate_recorded(model, input_data, key_func, digest=digest)
+
+
+def generate_batch(model, inputs, key_func, timeout=None):
+    """
+    Run generate() for several inputs sharing one image, BATCH_WORKERS at a
+    time. Yields (index, result, error) in completion order. The image is
+    hashed once for the whole batch.
+
+    Variants stop after timeout seconds, or once the caller stops
+    iterating (the client went away).
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    closed = threading.Event()
+    digest = image_digest(inputs[0]['image'])
+    # Normalize the shared image once rather than in every variant
+    prepared = normalized_input(model, inputs[0], digest)
+    shared = {field: prepared[field] for field in ('image', 'structure') if field in prepared}
+    inputs = [dict(input_data, **shared) for input_data in inputs]
+
+    if getattr(settings, 'GENERATION_JOBS_EAGER', False):
+        for index, input_data in enumerate(inputs):
+            try:
+                with cancellation.scope(deadline=deadline, gone=closed.is_set):
+                    result = generate_recorded(model, input_data, key_func, digest=digest)
+            except Exception as e:
+                yield index, None, e
+            else:
+                yield index, result, None
+        return
+
+    futures = {
+        _get_batch_executor().submit(
+            metrics.in_context(_run_variant), model, input_data, key_func, digest, deadline, closed.is_set
+        ): index
+        for index, input_data in enumerate(inputs)
+    }
+    try:
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], None if error else future.result(), error
+    finally:
+        # The client went away: don't start the variants still queued, and
+        # cancel the predictions of those running
+        closed.set()
+        for future in futures:
+            future.cancel()
+
+
+# Async generation jobs
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=GENERATION_WORKERS,
+            thread_name_prefix='generation'
+        )
+    return _executor
+
+
+def _room_type(value):
+    choices = dict(FloorPlan._meta.get_field('room_type').choices)
+    return value if value in choices else 'living_room'
+
+
+def create_design(input_data, room_type=None, **fields):
+    """Record a generation request as an InteriorDesign of a new FloorPlan."""
+    floor_plan = FloorPlan.objects.create(
+        image=input_data['image'],
+        room_type=_room_type(room_type)
+    )
+    return InteriorDesign.objects.create(
+        floor_plan=floor_plan,
+        prompt_used=input_data.get('prompt'),
+        **fields
+    )
+
+
+def outcome_fields(model, started, result=None, error=None, digest=None):
+    """InteriorDesign fields for a finished generation that began at started (time.monotonic())."""
+    if error is not None:
+        return {
+            'status': 'failed', 'stage': progress.FAILED, 'error': str(error),
+            'processing_time': time.monotonic() - started
+        }
+
+    fields = {
+        'status': 'completed',
+        'stage': progress.DONE,
+        'progress': 1.0,
+        'output_urls': result.urls,
+        # The first output, for clients that read a single image
+        'generated_image': result.urls[0] if result.urls else '',
+        'error': f"{result.failed} output(s) could not be stored" if result.failed else '',
+        'processing_time': time.monotonic() - started,
+    }
+    # Layouts record the edge map of their floor plan, if one was made
+    if model == CONTROLNET_MODEL and digest:
+        edge_map = edges.stored_key(digest, LAYOUT_IMAGE_RESOLUTION)
+        if edge_map:
+            fields['edge_map'] = edge_map
+    return fields
+
+
+def generate_recorded(model, input_data, key_func, room_type=None, digest=None, timeout=None):
+    """
+    generate() for a request answered right away, recording it as an
+    InteriorDesign with its processing time like submitted jobs are.
+    Raises cancellation.DeadlineExceeded after timeout seconds, and
+    admission.Overloaded if a prediction would have to run and the client
+    is turned away; cache hits and coalesced requests are always served.
+    """
+    started = time.monotonic()
+    if digest is None:
+        digest = image_digest(input_data['image'])
+    try:
+        with cancellation.scope(timeout=timeout):
+            result = generate(model, input_data, key_func, digest=digest, admit=True)
+    except admission.Overloaded:
+        raise
+    except Exception as e:
+        record_design(input_data, room_type, outcome_fields(model, started, error=e))
+        raise
+    record_design(input_data, room_type, outcome_fields(model, started, result, digest=digest))
+    return result
+
+
+def record_design(input_data, room_type, fields):
+    try:
+        create_design(input_data, room_type, **fields)
+    except Exception as e:
+        # The response doesn't depend on the record
+        logger.error(f"Could not record generation: {str(e)}")
+
+
+def submit_generation(model, input_data, key_func, room_type=None, timeout=None):
+    """
+    Record a generation job as a processing InteriorDesign and hand the
+    prediction and upload to the local worker pool.
+
+    Returns the InteriorDesign row immediately; callers poll its status
+    or follow its progress events. The job fails if it hasn't finished
+    after timeout seconds.
+    Raises admission.Overloaded if the client is over its rate limit.
+    """
+    admission.admit()
+    design = create_design(
+        input_data, room_type, status='processing', stage=progress.QUEUED,
+        deadline=cancellation.job_deadline(timeout)
+    )
+
+    if getattr(settings, 'GENERATION_JOBS_EAGER', False):
+        run_generation_job(design.pk, model, input_data, key_func, design.deadline)
+    else:
+        _get_executor().submit(
+            metrics.in_context(_run_in_worker), design.pk, model, input_data, key_func, design.deadline
+        )
+    return design
+
+
+def _run_in_worker(design_id, model, input_data, key_func, deadline):
+    # Worker threads keep their connection between jobs, like request threads
+    with worker_connection():
+        run_generation_job(design_id, model, input_data, key_func, deadline)
+
+
+def run_generation_job(design_id, model, input_data, key_func, deadline=None):
+    with progress.job(design_id), cancellation.job_scope(design_id, deadline):
+        _run_generation_job(design_id, model, input_data, key_func)
+    progress.finished(design_id)
+
+
+def _run_generation_job(design_id, model, input_data, key_func):
+    from . import webhooks
+
+    started = time.monotonic()
+    try:
+        digest = image_digest(input_data['image'])
+        if webhooks.enabled():
+            cache_key = prediction_cache.prediction_key(model, input_data, digest) if digest else None
+            with metrics.stage('cache_lookup'):
+                cached_urls = prediction_cache.lookup(cache_key)
+            if cached_urls is None:
+                cancellation.check()
+                # The webhook receiver finishes the job; no thread waits on the prediction
+                with admission.background():
+                    webhooks.create_prediction(design_id, model, input_data, digest, cache_key)
+                return
+            metrics.cache_result('hit')
+            result = GenerationResult(cached_urls, 'hit')
+        else:
+            with admission.background():
+                result = generate(model, input_data, key_func, digest=digest)
+    except Exception as e:
+        logger.error(f"Generation job {design_id} failed: {str(e)}")
+        InteriorDesign.objects.filter(pk=design_id).update(**outcome_fields(model, started, error=e))
+        return
+
+    InteriorDesign.objects.filter(pk=design_id).update(
+        **outcome_fields(model, started, result, digest=digest)
+    )
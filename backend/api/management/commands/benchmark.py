@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import subprocess
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.benchmark import Faults, FakeReplicate, FakeS3, compare, peak_rss, run_load, sample_png
+
+
+SCENARIOS = ['upload-image', 'generate', 'room-design', 'generate-3d-layout']
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _levels(value):
+    return [int(level) for level in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test the upload and generation endpoints against local stand-ins for '
+        'Replicate and S3, and store the results to compare runs'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Endpoints to drive, comma separated')
+        parser.add_argument('--concurrency', type=_levels, default=[1, 4, 16], help='Concurrency levels, e.g. 1,4,16')
+        parser.add_argument('--requests', type=int, default=50, help='Requests per scenario and concurrency level')
+        parser.add_argument('--replicate-latency', type=float, default=2.0, help='Mean seconds per prediction')
+        parser.add_argument('--replicate-jitter', type=float, default=0.5)
+        parser.add_argument('--replicate-error-rate', type=float, default=0.0)
+        parser.add_argument('--s3-latency', type=float, default=0.02, help='Mean seconds per S3 request')
+        parser.add_argument('--s3-jitter', type=float, default=0.01)
+        parser.add_argument('--s3-error-rate', type=float, default=0.0)
+        parser.add_argument('--output-size', type=int, default=512, help='Width and height of the fake model outputs')
+        parser.add_argument(
+            '--cache-hits', action='store_true',
+            help='Repeat identical requests, so generation is served from the prediction cache'
+        )
+        parser.add_argument('--gunicorn-args', default='', help='Extra gunicorn arguments, e.g. "--workers 2 --threads 8"')
+        parser.add_argument(
+            '--output-dir', default=os.path.join(settings.BASE_DIR, 'benchmarks'),
+            help='Where results are stored, one JSON file per run'
+        )
+        parser.add_argument('--compare', help='Result file to compare with; defaults to the latest stored run')
+        parser.add_argument('--no-save', action='store_true', help="Don't store this run's results")
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        import httpx
+
+        scenarios = [name for name in options['scenarios'].split(',') if name]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+        replicate_faults = Faults(
+            options['replicate_latency'], options['replicate_jitter'], options['replicate_error_rate']
+        )
+        s3_faults = Faults(options['s3_latency'], options['s3_jitter'], options['s3_error_rate'])
+        output = sample_png(options['output_size'], options['output_size'])
+
+        with FakeReplicate(replicate_faults, output=output) as replicate, FakeS3(s3_faults) as s3:
+            port = _free_port()
+            server = self.start_server(port, replicate.url, s3.url, options['gunicorn_args'])
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                with httpx.Client(base_url=base_url, timeout=600) as client:
+                    self.wait_until_ready(client, server)
+                    image_url = self.upload(client, sample_png(256, 256))['url']
+                    runs = []
+                    for scenario in scenarios:
+                        for concurrency in options['concurrency']:
+                            send = self.sender(client, scenario, image_url, options['cache_hits'])
+                            run = run_load(send, concurrency, options['requests'])
+                            run.update(
+                                scenario=scenario, concurrency=concurrency,
+                                peak_rss_mb=peak_rss(server.pid)
+                            )
+                            runs.append(run)
+                            if not options['json']:
+                                self.print_run(run)
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+
+        result = {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'commit': self.commit(),
+            'config': {
+                'requests': options['requests'],
+                'replicate': replicate_faults._asdict(),
+                's3': s3_faults._asdict(),
+                'output_size': options['output_size'],
+                'cache_hits': options['cache_hits'],
+                'gunicorn_args': options['gunicorn_args'],
+            },
+            'runs': runs,
+        }
+
+        previous = self.previous(options)
+        if not options['no_save']:
+            os.makedirs(options['output_dir'], exist_ok=True)
+            path = os.path.join(options['output_dir'], f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+            with open(path, 'w') as out:
+                json.dump(result, out, indent=2)
+            if not options['json']:
+                self.stdout.write(f"\nResults stored in {path}")
+
+        if options['json']:
+            self.stdout.write(json.dumps(result, indent=2))
+        elif previous is not None:
+            self.print_comparison(compare(result, previous[1]), previous[0])
+
+    def start_server(self, port, replicate_url, s3_url, gunicorn_args):
+        env = dict(
+            os.environ,
+            REPLICATE_API_BASE_URL=replicate_url,
+            REPLICATE_API_TOKEN='benchmark',
+            AWS_S3_ENDPOINT_URL=s3_url,
+            AWS_BUCKET_NAME='benchmark',
+            AWS_REGION='us-east-1',
+            AWS_ACCESS_KEY_ID='benchmark',
+            AWS_SECRET_ACCESS_KEY='benchmark',
+        )
+        command = [
+            sys.executable, '-m', 'gunicorn', 'interior_pilot.wsgi:application',
+            '--bind', f'127.0.0.1:{port}', '--timeout', '600', *shlex.split(gunicorn_args)
+        ]
+        return subprocess.Popen(command, cwd=settings.BASE_DIR, env=env)
+
+    def wait_until_ready(self, client, server, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f"The server exited with status {server.returncode}")
+            try:
+                if client.get('/api/ready/').status_code == 200:
+                    return
+            except Exception:
+                pass
+            time.sleep(0.25)
+        raise CommandError('The server did not become ready')
+
+    def upload(self, client, image, index=None):
+        # Unique bytes after the end of the PNG, so every upload is new content
+        suffix = f'{index}'.encode() if index is not None else b''
+        response = client.post('/api/upload-image/', files={'image': ('room.png', image + suffix, 'image/png')})
+        response.raise_for_status()
+        return response.json()
+
+    def sender(self, client, scenario, image_url, cache_hits):
+        if scenario == 'upload-image':
+            image = sample_png(256, 256)
+            nonce = time.time_ns()
+            return lambda index: bool(self.upload(client, image, f'{nonce}-{index}'))
+
+        # Unique text defeats the prediction cache unless hits are wanted
+        run_id = time.time_ns()
+
+        def unique(index):
+            return '' if cache_hits else f' (benchmark {run_id}-{index})'
+
+        def send(index):
+            if scenario == 'generate':
+                path, payload = '/api/generate/', {
+                    'image': image_url, 'theme': 'Modern', 'room_type': 'living_room',
+                    'color': 'White', 'additional_notes': 'Benchmark' + unique(index)
+                }
+            elif scenario == 'room-design':
+                path, payload = '/api/room-design/', {
+                    'image': image_url, 'theme': 'Modern', 'room_type': 'bedroom', 'color': 'White',
+                    'accessories': 'plants', 'furniture': 'bed', 'walls': 'white',
+                    'lights': 'warm lights', 'realistic': 'realistic' + unique(index)
+                }
+            else:
+                path, payload = '/api/generate-3d-layout/', {
+                    'image': image_url, 'prompt': 'Modern living room' + unique(index)
+                }
+            return client.post(path, json=payload).status_code == 200
+        return send
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                cwd=settings.BASE_DIR, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def previous(self, options):
+        """(path, result) of the run to compare with, if there is one."""
+        path = options['compare']
+        if path is None:
+            try:
+                stored = sorted(name for name in os.listdir(options['output_dir']) if name.endswith('.json'))
+            except OSError:
+                return None
+            if not stored:
+                return None
+            path = os.path.join(options['output_dir'], stored[-1])
+        with open(path) as stored_result:
+            return path, json.load(stored_result)
+
+    def print_run(self, run):
+        self.stdout.write(
+            f"{run['scenario']:>20} x{run['concurrency']:<3} "
+            f"p50 {run['p50_ms']} ms  p95 {run['p95_ms']} ms  p99 {run['p99_ms']} ms  "
+            f"{run['rps']} req/s  errors {run['errors']}/{run['requests']}  "
+            f"peak RSS {run['peak_rss_mb']} MiB"
+        )
+
+    def print_comparison(self, rows, path):
+        if not rows:
+            return
+        self.stdout.write(f"\nCompared with {path}:")
+        for scenario, concurrency, metric, before, after, change in rows:
+            change = f"{change:+.1f}%" if change is not None else 'n/a'
+            self.stdout.write(f"{scenario:>20} x{concurrency:<3} {metric:<12} {before:>10} -> {after:<10} {change}")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api import webhooks
+
+
+class Command(BaseCommand):
+    help = (
+        'Finish webhook-mode generation jobs whose webhook never came, from their prediction '
+        'on Replicate; for deployments whose instances may be gone before their own sweep runs'
+    )
+
+    def handle(self, *args, **options):
+        reaped = webhooks.reap()
+        self.stdout.write(f"Finished {reaped} generation job(s)")
@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from django.core.management.base import BaseCommand, CommandError
+
+
+# Runs in a fresh interpreter so every import is a cold one
+PROFILE_SCRIPT = '''
+import sys, json, time
+started = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+urls = time.perf_counter()
+report = {'setup_ms': (setup - started) * 1000, 'urls_ms': (urls - setup) * 1000}
+if '--warm-up' in sys.argv:
+    from api.warmup import warm_up
+    report['warm_up'] = warm_up()
+print(json.dumps(report))
+'''
+
+
+def parse_importtime(output):
+    """
+    Parse `python -X importtime` output into a list of
+    (module, self_us, cumulative_us, depth) tuples, in import order.
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return modules
+
+
+class Command(BaseCommand):
+    help = 'Print per-module import time of a cold start, slowest first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=25, help='Number of modules to list')
+        parser.add_argument('--warm-up', action='store_true', help='Also time the warm-up hook')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON, e.g. to compare releases')
+
+    def handle(self, *args, **options):
+        command = [sys.executable, '-X', 'importtime', '-c', PROFILE_SCRIPT]
+        if options['warm_up']:
+            command.append('--warm-up')
+
+        started = time.perf_counter()
+        result = subprocess.run(command, capture_output=True, text=True, env=os.environ.copy())
+        total_ms = (time.perf_counter() - started) * 1000
+        if result.returncode != 0:
+            raise CommandError(f"Profiling run failed:\n{result.stderr[-2000:]}")
+
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+        # Only top-level imports; nested ones are included in their parent's time
+        modules = sorted(
+            (module for module in parse_importtime(result.stderr) if module[3] == 0),
+            key=lambda module: module[2],
+            reverse=True
+        )
+        report['total_ms'] = total_ms
+        report['imports_ms'] = sum(module[2] for module in modules) / 1000
+        report['modules'] = [
+            {'module': name, 'cumulative_ms': cumulative / 1000, 'self_ms': self_us / 1000}
+            for name, self_us, cumulative, _ in modules[:options['limit']]
+        ]
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(
+            f"Cold start: {report['total_ms']:.1f} ms "
+            f"(django.setup {report['setup_ms']:.1f} ms, URLconf {report['urls_ms']:.1f} ms, "
+            f"imports {report['imports_ms']:.1f} ms)"
+        )
+        if 'warm_up' in report:
+            steps = ', '.join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in report['warm_up'].items())
+            self.stdout.write(f"Warm-up: {steps}")
+
+        self.stdout.write(f"\n{'cumulative':>12} {'self':>10}  module")
+        for module in report['modules']:
+            self.stdout.write(
+                f"{module['cumulative_ms']:>9.1f} ms {module['self_ms']:>7.1f} ms  {module['module']}"
+            )
@@ -0,0 +1,222 @@
+import os
+import time
+import inspect
+import functools
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+)
+
+
+# Replicate predictions take seconds to minutes; the other stages milliseconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+REQUESTS = Counter(
+    'api_requests_total', 'Generation requests handled, by response status',
+    ['endpoint', 'model', 'status']
+)
+REQUEST_SECONDS = Histogram(
+    'api_request_duration_seconds', 'Time to handle a generation request',
+    ['endpoint', 'model'], buckets=BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    'generation_stage_duration_seconds', 'Time spent in each stage of a generation request',
+    ['endpoint', 'model', 'stage'], buckets=BUCKETS
+)
+STAGE_ERRORS = Counter(
+    'generation_stage_errors_total', 'Stages of generation requests that raised',
+    ['endpoint', 'model', 'stage']
+)
+CACHE_RESULTS = Counter(
+    'generation_cache_results_total', 'Prediction cache outcomes: hit, miss or coalesced',
+    ['endpoint', 'model', 'cache']
+)
+# Admission control (api/admission.py); summed across worker processes
+PREDICTION_SLOTS = Gauge(
+    'prediction_slots_in_use', 'Replicate predictions running', multiprocess_mode='livesum'
+)
+PREDICTION_QUEUE = Gauge(
+    'prediction_queue_depth', 'Requests waiting for a prediction slot', multiprocess_mode='livesum'
+)
+SHED = Counter(
+    'prediction_requests_shed_total', 'Requests turned away with 429: queue_full or timeout',
+    ['endpoint', 'model', 'reason']
+)
+CANCELLED = Counter(
+    'generations_cancelled_total', 'Generations stopped because their client went away (disconnect) or its deadline passed (deadline)',
+    ['endpoint', 'model', 'reason']
+)
+
+# (endpoint, model) of the request being handled; copied into worker threads
+_labels = contextvars.ContextVar('metrics_labels', default=('other', 'unknown'))
+
+
+@contextmanager
+def labels(endpoint, model):
+    token = _labels.set((endpoint, model))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def instrumented(endpoint, model):
+    """
+    Count and time a view (sync or async function or method), labelling
+    every stage it runs with endpoint and model.
+    """
+    def decorator(view):
+        def finish(started, response):
+            REQUEST_SECONDS.labels(endpoint, model).observe(time.perf_counter() - started)
+            REQUESTS.labels(endpoint, model, getattr(response, 'status_code', 500)).inc()
+
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                response = None
+                with labels(endpoint, model):
+                    try:
+                        response = await view(*args, **kwargs)
+                        return response
+                    finally:
+                        finish(started, response)
+        else:
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                response = None
+                with labels(endpoint, model):
+                    try:
+                        response = view(*args, **kwargs)
+                        return response
+                    finally:
+                        finish(started, response)
+        return wrapper
+    return decorator
+
+
+def observe(stage, seconds):
+    STAGE_SECONDS.labels(*_labels.get(), stage).observe(seconds)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one stage of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.labels(*_labels.get(), name).inc()
+        raise
+    finally:
+        observe(name, time.perf_counter() - started)
+
+
+def cache_result(cache):
+    CACHE_RESULTS.labels(*_labels.get(), cache).inc()
+
+
+def shed(reason):
+    SHED.labels(*_labels.get(), reason).inc()
+
+
+def cancelled(reason):
+    CANCELLED.labels(*_labels.get(), reason).inc()
+
+
+def _timestamp(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')) if value else None
+
+
+def observe_prediction(prediction, waited):
+    """
+    Split the time spent waiting on a Replicate prediction into queueing
+    (created until started) and inference (Replicate's predict_time).
+    """
+    created, started, completed = (
+        _timestamp(prediction.created_at), _timestamp(prediction.started_at), _timestamp(prediction.completed_at)
+    )
+    inference = (prediction.metrics or {}).get('predict_time')
+    if inference is None and started and completed:
+        inference = (completed - started).total_seconds()
+    if created and started:
+        queue = (started - created).total_seconds()
+    else:
+        queue = max(waited - (inference or 0), 0)
+
+    observe('replicate_queue', queue)
+    if inference is not None:
+        observe('replicate_inference', inference)
+
+
+class TimedIterator:
+    """Wraps an iterator, adding up the time spent waiting for its items."""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+class AsyncTimedIterator:
+    """Async counterpart of TimedIterator."""
+
+    def __init__(self, iterable):
+        self.iterator = iterable.__aiter__()
+        self.seconds = 0.0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        started = time.perf_counter()
+        try:
+            return await self.iterator.__anext__()
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+def in_context(func):
+    """Bind func to the current labels, for running it on a worker thread."""
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def in_request_context(iterator):
+    """Iterate in the labels of the current request, e.g. for a streamed response."""
+    return _iterate_in(contextvars.copy_context(), iter(iterator))
+
+
+def _iterate_in(context, iterator):
+    try:
+        while True:
+            try:
+                item = context.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            context.run(iterator.close)
+
+
+def exposition():
+    """The metrics in the Prometheus text format, merged across worker processes when set up for it."""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
@@ -0,0 +1,116 @@
+import os
+import logging
+import resource
+import tracemalloc
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from . import admission
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryUsageMiddleware:
+    """
+    Log how much memory every API request took.
+
+    rss_delta is how much the resident set size grew while the request ran
+    (read from /proc, so only on Linux); process_peak_rss is the process-wide
+    high-water mark, which only says whether some request ever pushed it up.
+    With MEMORY_PROFILING=1 Python allocations are traced as well and the
+    peak traced while the request ran is logged; tracing has a cost, so it
+    is off by default. Concurrent requests share one process, so both
+    figures cover everything that overlapped with the request.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.tracing = os.getenv('MEMORY_PROFILING') == '1'
+        if self.tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not request.path.startswith('/api/'):
+            return self.get_response(request)
+
+        rss_before = self._started()
+        response = self.get_response(request)
+        self._log(request, response, rss_before)
+        return response
+
+    async def __acall__(self, request):
+        # Natively async, so async views don't get a thread per request for it
+        if not request.path.startswith('/api/'):
+            return await self.get_response(request)
+
+        rss_before = self._started()
+        response = await self.get_response(request)
+        self._log(request, response, rss_before)
+        return response
+
+    def _started(self):
+        if self.tracing:
+            tracemalloc.reset_peak()
+        return _current_rss()
+
+    def _log(self, request, response, rss_before):
+        rss_after = _current_rss()
+        # ru_maxrss is reported in KiB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        message = f"{request.method} {request.path} status={response.status_code}"
+        if rss_before is not None and rss_after is not None:
+            message += f" rss_delta={(rss_after - rss_before) / (1024 * 1024):+.1f}MiB"
+        message += f" process_peak_rss={peak_rss:.1f}MiB"
+        if self.tracing:
+            _, peak = tracemalloc.get_traced_memory()
+            message += f" peak_traced={peak / (1024 * 1024):.1f}MiB"
+        logger.info(message)
+
+
+def _current_rss():
+    """Resident set size of the process in bytes, or None where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+_PAGE_SIZE = resource.getpagesize()
+
+
+class AdmissionClientMiddleware:
+    """
+    Identify who an API request is from (API key, session or IP), so
+    prediction slots and rate limits are shared fairly between clients.
+    Runs natively under both WSGI and ASGI, as the context it sets must
+    reach the view.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if request.method != 'POST' or not request.path.startswith('/api/'):
+            return self.get_response(request)
+        with admission.client(admission.identify(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if request.method != 'POST' or not request.path.startswith('/api/'):
+            return await self.get_response(request)
+        # identify() may look the session up in the database
+        with admission.client(await sync_to_async(admission.identify)(request)):
+            return await self.get_response(request)
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_remove_designpreference_accessories_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='interiordesign',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='interiordesign',
+            name='output_urls',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_uploadedimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NormalizedImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_size', models.PositiveIntegerField()),
+                ('key', models.CharField(max_length=1024)),
+                ('size', models.BigIntegerField()),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('upload', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='normalized', to='api.uploadedimage')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('upload', 'max_size'), name='unique_normalized_image_size')],
+            },
+        ),
+    ]
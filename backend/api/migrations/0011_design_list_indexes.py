@@ -0,0 +1,25 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_normalizedimage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='floorplan',
+            index=models.Index(fields=['room_type'], name='floorplan_room_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interiordesign',
+            index=models.Index(fields=['-created_at', '-id'], name='design_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interiordesign',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='design_status_created_idx'),
+        ),
+    ]
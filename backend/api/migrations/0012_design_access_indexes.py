@@ -0,0 +1,21 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_design_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='interiordesign',
+            index=models.Index(fields=['floor_plan', '-created_at'], name='design_floor_plan_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interiordesign',
+            index=models.Index(fields=['edge_map'], name='design_edge_map_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_design_access_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientRateBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client', models.CharField(max_length=100, unique=True)),
+                ('tokens', models.FloatField()),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+    ]
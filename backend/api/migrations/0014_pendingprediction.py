@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_clientratebucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingPrediction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32, unique=True)),
+                ('prediction_id', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('model', models.CharField(max_length=200)),
+                ('digest', models.CharField(blank=True, max_length=100)),
+                ('cache_key', models.CharField(blank=True, max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('design', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_predictions', to='api.interiordesign')),
+            ],
+        ),
+    ]
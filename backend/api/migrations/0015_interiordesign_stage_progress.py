@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_pendingprediction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='interiordesign',
+            name='progress',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='interiordesign',
+            name='stage',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_interiordesign_stage_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='interiordesign',
+            name='abandoned_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='interiordesign',
+            name='deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
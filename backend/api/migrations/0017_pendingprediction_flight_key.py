@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_interiordesign_deadline_abandoned_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingprediction',
+            name='flight_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
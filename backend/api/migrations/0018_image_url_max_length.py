@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_pendingprediction_flight_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='floorplan',
+            name='image',
+            field=models.ImageField(max_length=500, upload_to='floorplans/'),
+        ),
+        migrations.AlterField(
+            model_name='interiordesign',
+            name='edge_map',
+            field=models.ImageField(max_length=500, null=True, upload_to='edge_maps/'),
+        ),
+        migrations.AlterField(
+            model_name='interiordesign',
+            name='generated_image',
+            field=models.ImageField(max_length=500, upload_to='designs/'),
+        ),
+    ]
@@ -9,7 +9,8 @@ class DesignStyle(models.Model):
         return self.name
 
 class FloorPlan(models.Model):
-    image = models.ImageField(upload_to="floorplans/")
+    # Holds the S3 URL of the upload, which outgrows the default 100
+    image = models.ImageField(upload_to="floorplans/", max_length=500)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     room_type = models.CharField(max_length=50, choices=[
         ('living_room', 'Living Room'),
@@ -23,6 +24,12 @@ class FloorPlan(models.Model):
 )
     area_sqft = models.IntegerField(default=50)
 
+    class Meta:
+        indexes = [
+            # /api/designs/?room_type= joins on it
+            models.Index(fields=['room_type'], name='floorplan_room_type_idx'),
+        ]
+
     def __str__(self):
         return f"{self.room_type} - {self.uploaded_at}"
 
@@ -37,8 +44,8 @@ class DesignPreference(models.Model):
 class InteriorDesign(models.Model):
     floor_plan = models.ForeignKey(FloorPlan, on_delete=models.CASCADE)
     preferences = models.OneToOneField(DesignPreference, on_delete=models.CASCADE, null=True)
-    generated_image = models.ImageField(upload_to="designs/")
-    edge_map = models.ImageField(upload_to="edge_maps/", null=True)
+    generated_image = models.ImageField(upload_to="designs/", max_length=500)
+    edge_map = models.ImageField(upload_to="edge_maps/", null=True, max_length=500)
     prompt_used = models.TextField(null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     processing_time = models.FloatField(null=True)
@@ -47,6 +54,105 @@ class InteriorDesign(models.Model):
         ('completed', 'Completed'),
         ('failed', 'Failed')
     ], default='processing')
+    output_urls = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True)
+    # Where a job is: queued, running, uploading, done or failed (api/progress.py)
+    stage = models.CharField(max_length=20, blank=True)
+    # Fraction of the prediction's steps done, while it runs and Replicate reports them
+    progress = models.FloatField(null=True, blank=True)
+    # When the job stops if it hasn't finished, as its client asked (api/cancellation.py)
+    deadline = models.DateTimeField(null=True, blank=True)
+    # When the client following the job's event stream closed it
+    abandoned_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of /api/designs/, newest first, with and without ?status=
+            models.Index(fields=['-created_at', '-id'], name='design_created_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='design_status_created_idx'),
+            # A floor plan's designs, newest first
+            models.Index(fields=['floor_plan', '-created_at'], name='design_floor_plan_created_idx'),
+            # Looking up whether an edge map is already stored
+            models.Index(fields=['edge_map'], name='design_edge_map_idx'),
+        ]
 
     def __str__(self):
         return f"Design for {self.floor_plan.room_type} - {self.created_at}"
+
+class PendingPrediction(models.Model):
+    """A job's prediction created with a webhook, until Replicate reports how it ended."""
+    # Part of the webhook URL, so the receiver finds the job even before prediction_id is saved
+    token = models.CharField(max_length=32, unique=True)
+    prediction_id = models.CharField(max_length=64, blank=True, db_index=True)
+    design = models.ForeignKey(InteriorDesign, on_delete=models.CASCADE, related_name='pending_predictions')
+    model = models.CharField(max_length=200)
+    digest = models.CharField(max_length=100, blank=True)
+    cache_key = models.CharField(max_length=64, blank=True)
+    # single_flight.flight_key() of the inputs; identical jobs join a running prediction
+    flight_key = models.CharField(max_length=64, blank=True, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Prediction {self.prediction_id or '(creating)'} for design {self.design_id}"
+
+class PredictionCacheEntry(models.Model):
+    """Stored outputs of a Replicate prediction, keyed on its content-addressed inputs."""
+    key = models.CharField(max_length=64, unique=True)
+    model_version = models.CharField(max_length=200)
+    output_urls = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.model_version} - {self.key[:12]}"
+
+class GenerationLock(models.Model):
+    """Marks a prediction as in flight so other workers wait for it instead of repeating it."""
+    key = models.CharField(max_length=64, unique=True)
+    owner = models.CharField(max_length=200)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.key[:12]} held by {self.owner}"
+
+class ClientRateBucket(models.Model):
+    """A client's prediction rate limit token bucket, when shared between worker processes."""
+    client = models.CharField(max_length=100, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.client}: {self.tokens:.1f} tokens"
+
+class UploadedImage(models.Model):
+    """Index of uploaded images by content hash, so duplicates are detected without asking S3."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    key = models.CharField(max_length=1024, db_index=True)
+    size = models.BigIntegerField()
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
+
+
+class NormalizedImage(models.Model):
+    """Downscaled, EXIF-stripped copy of an upload that is sent to the models instead of the original."""
+    upload = models.ForeignKey(UploadedImage, on_delete=models.CASCADE, related_name='normalized')
+    max_size = models.PositiveIntegerField()
+    key = models.CharField(max_length=1024)
+    size = models.BigIntegerField()
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['upload', 'max_size'], name='unique_normalized_image_size')
+        ]
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,123 @@
+import io
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.db import IntegrityError, transaction
+from .models import UploadedImage, NormalizedImage
+from .storage import s3_client, AWS_BUCKET_NAME, s3_url
+from .db import worker_connection
+
+logger = logging.getLogger(__name__)
+
+
+# Set to 0 to send uploads to the models as they are
+NORMALIZE_INPUT_IMAGES = os.getenv("NORMALIZE_INPUT_IMAGES", "1") == "1"
+NORMALIZED_JPEG_QUALITY = int(os.getenv("NORMALIZED_JPEG_QUALITY", "90"))
+# Uploads normalized at the same time, in the background after upload
+NORMALIZE_WORKERS = int(os.getenv("NORMALIZE_WORKERS", "2"))
+
+
+def normalized_key(sha256, max_size):
+    return f"uploads/normalized/{sha256}-{max_size}.jpg"
+
+
+def normalize_image(data, sizes):
+    """
+    Decode an image once and return {max_size: (jpeg_bytes, width, height)}
+    for each size: oriented per its EXIF data, downscaled so the longest
+    edge is at most max_size, and re-encoded without metadata.
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    # JPEGs are decoded at a reduced scale when that still covers the largest size
+    image.draft('RGB', (max(sizes), max(sizes)))
+    icc_profile = image.info.get('icc_profile')
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    results = {}
+    for max_size in sorted(sizes, reverse=True):
+        # Each size is resized from the previous, larger one
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        out = io.BytesIO()
+        # EXIF is dropped; the color profile is kept so colors don't shift
+        image.save(
+            out, 'JPEG', quality=NORMALIZED_JPEG_QUALITY,
+            optimize=True, progressive=True, icc_profile=icc_profile
+        )
+        results[max_size] = (out.getvalue(), image.width, image.height)
+    return results
+
+
+def create_normalized(upload, sizes):
+    """Store the derivatives of an upload that don't exist yet. Returns them by size."""
+    existing = {
+        derivative.max_size: derivative
+        for derivative in NormalizedImage.objects.filter(upload=upload, max_size__in=sizes)
+    }
+    missing = [max_size for max_size in sizes if max_size not in existing]
+    if not missing:
+        return existing
+
+    original = s3_client.get_object(Bucket=AWS_BUCKET_NAME, Key=upload.key)['Body'].read()
+    for max_size, (data, width, height) in normalize_image(original, missing).items():
+        key = normalized_key(upload.sha256, max_size)
+        s3_client.put_object(Bucket=AWS_BUCKET_NAME, Key=key, Body=data, ContentType='image/jpeg')
+        try:
+            with transaction.atomic():
+                existing[max_size] = NormalizedImage.objects.create(
+                    upload=upload, max_size=max_size, key=key,
+                    size=len(data), width=width, height=height
+                )
+        except IntegrityError:
+            # Normalized concurrently; both wrote the same bytes to the same key
+            existing[max_size] = NormalizedImage.objects.get(upload=upload, max_size=max_size)
+    return existing
+
+
+def normalized_url(url, max_size):
+    """
+    URL of the normalized copy of an uploaded image, creating it if needed.
+    Images that aren't uploads, or can't be decoded, are used as they are.
+    """
+    bucket_prefix = s3_url('')
+    if not NORMALIZE_INPUT_IMAGES or not url.startswith(bucket_prefix):
+        return url
+
+    upload = UploadedImage.objects.filter(key=url[len(bucket_prefix):]).first()
+    if upload is None:
+        return url
+
+    try:
+        return s3_url(create_normalized(upload, [max_size])[max_size].key)
+    except Exception as e:
+        logger.warning(f"Could not normalize {upload.key}, using the original: {str(e)}")
+        return url
+
+
+_executor = ThreadPoolExecutor(max_workers=NORMALIZE_WORKERS, thread_name_prefix='normalize')
+
+
+def schedule(upload_id):
+    """Normalize a new upload for every model in the background."""
+    if NORMALIZE_INPUT_IMAGES:
+        _executor.submit(_normalize_in_worker, upload_id)
+
+
+def _normalize_in_worker(upload_id):
+    from .generation import MODEL_INPUT_SIZES
+
+    with worker_connection():
+        try:
+            upload = UploadedImage.objects.get(pk=upload_id)
+            create_normalized(upload, sorted(set(MODEL_INPUT_SIZES.values())))
+        except Exception as e:
+            logger.warning(f"Could not normalize upload {upload_id}: {str(e)}")
@@ -0,0 +1,13 @@
+from rest_framework.pagination import CursorPagination
+
+
+class DesignCursorPagination(CursorPagination):
+    """
+    Keyset pagination on created_at, newest first. Each page is a range scan
+    of the created_at index, however deep it is, and rows added while a
+    client pages through don't shift or repeat results.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
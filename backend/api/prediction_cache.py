@@ -0,0 +1,73 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import timedelta
+from django.utils import timezone
+from .models import PredictionCacheEntry
+
+logger = logging.getLogger(__name__)
+
+
+# Entries older than this many seconds are treated as misses (0 disables the cache)
+PREDICTION_CACHE_TTL = int(os.getenv("PREDICTION_CACHE_TTL", str(7 * 24 * 3600)))
+# Least recently used entries are evicted beyond this many rows
+PREDICTION_CACHE_MAX_ENTRIES = int(os.getenv("PREDICTION_CACHE_MAX_ENTRIES", "1000"))
+
+
+def prediction_key(model, input_data, image_digest):
+    """
+    Content-addressed key for a prediction: the model version, the digest of
+    the input image's bytes and every other input field.
+    """
+    payload = dict(input_data, image=image_digest)
+    blob = json.dumps({'model': model, 'input': payload}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def lookup(key):
+    """Return the cached output URLs for key, or None on a miss."""
+    if not key or PREDICTION_CACHE_TTL <= 0:
+        return None
+
+    now = timezone.now()
+    entry = PredictionCacheEntry.objects.filter(
+        key=key,
+        created_at__gte=now - timedelta(seconds=PREDICTION_CACHE_TTL)
+    ).first()
+    if entry is None:
+        return None
+
+    PredictionCacheEntry.objects.filter(pk=entry.pk).update(last_used_at=now)
+    return entry.output_urls
+
+
+def store(key, model, output_urls):
+    if not key or PREDICTION_CACHE_TTL <= 0 or not output_urls:
+        return
+
+    now = timezone.now()
+    PredictionCacheEntry.objects.update_or_create(
+        key=key,
+        defaults={
+            'model_version': model,
+            'output_urls': output_urls,
+            'created_at': now,
+            'last_used_at': now,
+        }
+    )
+    evict()
+
+
+def evict():
+    """Drop expired entries and trim the table to PREDICTION_CACHE_MAX_ENTRIES by LRU."""
+    cutoff = timezone.now() - timedelta(seconds=PREDICTION_CACHE_TTL)
+    PredictionCacheEntry.objects.filter(created_at__lt=cutoff).delete()
+
+    stale = PredictionCacheEntry.objects.order_by('-last_used_at').values_list(
+        'pk', flat=True
+    )[PREDICTION_CACHE_MAX_ENTRIES:]
+    stale_ids = list(stale)
+    if stale_ids:
+        PredictionCacheEntry.objects.filter(pk__in=stale_ids).delete()
+        logger.info(f"Evicted {len(stale_ids)} prediction cache entries")
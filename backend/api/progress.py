@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from asgiref.sync import sync_to_async
+from . import cancellation
+from .models import InteriorDesign
+
+
+# Where a generation job is, streamed to clients by /api/designs/{id}/events/.
+# The stage and progress are stored on the job's InteriorDesign, so a stream
+# follows jobs run by any worker; jobs in this process wake streams at once,
+# others are picked up within PROGRESS_POLL_INTERVAL seconds.
+QUEUED, RUNNING, UPLOADING, DONE, FAILED = 'queued', 'running', 'uploading', 'done', 'failed'
+
+PROGRESS_POLL_INTERVAL = float(os.getenv("PROGRESS_POLL_INTERVAL", "1"))
+# A comment is sent after this many quiet seconds, so proxies keep the stream open
+PROGRESS_KEEPALIVE = float(os.getenv("PROGRESS_KEEPALIVE", "15"))
+# Streams are closed after this many seconds; EventSource reconnects by itself
+PROGRESS_STREAM_TIMEOUT = float(os.getenv("PROGRESS_STREAM_TIMEOUT", "600"))
+# Smaller changes in step progress than this aren't written
+PROGRESS_MIN_STEP = 0.02
+# Milliseconds browsers wait before reconnecting a dropped stream
+PROGRESS_RETRY_MS = 3000
+
+_job = contextvars.ContextVar('progress_job', default=None)
+# design id -> (stage, progress) last written, to skip repeated writes
+_reported = {}
+_changed = threading.Condition()
+
+
+@contextmanager
+def job(design_id):
+    """Report stages of the code run inside to the given InteriorDesign."""
+    token = _job.set(design_id)
+    try:
+        yield
+    finally:
+        _job.reset(token)
+
+
+def tracking():
+    return _job.get() is not None
+
+
+def report(stage, progress=None, design_id=None):
+    """Record the stage of the current job, if there is one, and wake its streams."""
+    design_id = design_id if design_id is not None else _job.get()
+    if design_id is None:
+        return
+    last = _reported.get(design_id)
+    if last is not None and last[0] == stage:
+        if progress is None or (last[1] is not None and abs(progress - last[1]) < PROGRESS_MIN_STEP):
+            return
+    _reported[design_id] = (stage, progress)
+    InteriorDesign.objects.filter(pk=design_id).update(stage=stage, progress=progress)
+    notify()
+
+
+def finished(design_id):
+    """Wake the streams of a job whose outcome was just recorded."""
+    _reported.pop(design_id, None)
+    notify()
+
+
+def notify():
+    with _changed:
+        _changed.notify_all()
+
+
+def _frame(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _event(status):
+    if status == 'completed':
+        return DONE
+    if status == 'failed':
+        return FAILED
+    return 'progress'
+
+
+def events(design_id):
+    """
+    Server-Sent Events for a generation job: a 'progress' event each time
+    its stage or progress changes, then 'done' with its output URLs or
+    'failed' with its error, after which the stream ends.
+
+    A job whose client closes the stream early is cancelled, unless the
+    client reconnects within cancellation.ABANDONED_JOB_GRACE seconds.
+    """
+    cancellation.attached(design_id)
+    try:
+        yield from _events(design_id)
+    except GeneratorExit:
+        cancellation.detached(design_id)
+        raise
+
+
+async def aevents(design_id):
+    """
+    events() as an async iterator, for ASGI servers: a stream waits in the
+    event loop instead of holding a thread for as long as it's open.
+    """
+    await sync_to_async(cancellation.attached)(design_id)
+    try:
+        stream = _Stream(design_id)
+        yield stream.opening()
+        poll = sync_to_async(stream.poll)
+        while True:
+            for frame in await poll():
+                yield frame
+            if stream.ended:
+                return
+            await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+    except (GeneratorExit, asyncio.CancelledError):
+        await sync_to_async(cancellation.detached)(design_id)
+        raise
+
+
+def _events(design_id):
+    stream = _Stream(design_id)
+    yield stream.opening()
+    while True:
+        yield from stream.poll()
+        if stream.ended:
+            return
+        with _changed:
+            _changed.wait(PROGRESS_POLL_INTERVAL)
+
+
+class _Stream:
+    """The frames of one event stream, read from the job's InteriorDesign."""
+
+    def __init__(self, design_id):
+        self.design_id = design_id
+        self.last = None
+        self.sent = self.started = time.monotonic()
+        self.sequence = 0
+        self.ended = False
+
+    def opening(self):
+        return f"retry: {PROGRESS_RETRY_MS}\n\n"
+
+    def poll(self):
+        """The frames to send now; sets ended once the stream is over."""
+        from .serializers import DesignJobStatusSerializer
+
+        design = InteriorDesign.objects.filter(pk=self.design_id).first()
+        if design is None:
+            self.ended = True
+            return [_frame(FAILED, {'id': self.design_id, 'status': 'failed', 'error': 'Design not found'})]
+
+        frames = []
+        state = (design.status, design.stage, design.progress)
+        now = time.monotonic()
+        if state != self.last:
+            self.sequence += 1
+            frames.append(_frame(_event(design.status), DesignJobStatusSerializer(design).data, self.sequence))
+            if design.status in ('completed', 'failed'):
+                self.ended = True
+                return frames
+            self.last, self.sent = state, now
+        elif now - self.sent >= PROGRESS_KEEPALIVE:
+            frames.append(": keep-alive\n\n")
+            self.sent = now
+
+        if now - self.started >= PROGRESS_STREAM_TIMEOUT:
+            self.ended = True
+        return frames
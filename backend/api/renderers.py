@@ -0,0 +1,18 @@
+import json
+from rest_framework.renderers import BaseRenderer
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets views that stream Server-Sent Events be negotiated for
+    Accept: text/event-stream. Only errors are rendered through it, as a
+    single 'error' event; the event streams themselves bypass rendering.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return f"event: error\ndata: {json.dumps(data, default=str)}\n\n".encode(self.charset)
@@ -0,0 +1,142 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .storage import s3_client, AWS_BUCKET_NAME
+
+logger = logging.getLogger(__name__)
+
+
+# S3 requires every part but the last to be at least 5 MiB
+S3_MULTIPART_PART_SIZE = max(int(os.getenv("S3_MULTIPART_PART_SIZE", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+# Parts of one upload that may be buffered and in flight at the same time
+S3_MULTIPART_MAX_INFLIGHT = int(os.getenv("S3_MULTIPART_MAX_INFLIGHT", "2"))
+
+_part_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='s3-part')
+
+
+class MultipartUpload:
+    """
+    Write a stream of chunks to one S3 object as a multipart upload.
+
+    Parts upload in the background while the caller keeps producing data,
+    and at most S3_MULTIPART_MAX_INFLIGHT parts are held in memory.
+    """
+
+    def __init__(self, key, content_type, cache_control=None):
+        self.key = key
+        self.content_type = content_type or 'application/octet-stream'
+        self.cache_control = cache_control
+        self.upload_id = None
+        self.buffer = bytearray()
+        self.parts = []
+        self.pending = []
+        self.size = 0
+
+    def start(self):
+        self.upload_id = s3_client.create_multipart_upload(
+            Bucket=AWS_BUCKET_NAME,
+            Key=self.key,
+            ContentType=self.content_type,
+            **_cache_headers(self.cache_control)
+        )['UploadId']
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.size += len(data)
+        if len(self.buffer) >= S3_MULTIPART_PART_SIZE:
+            self._send_part()
+
+    def complete(self):
+        if self.buffer or not (self.parts or self.pending):
+            self._send_part()
+        for future in self.pending:
+            self.parts.append(future.result())
+        self.pending = []
+        self.parts.sort(key=lambda part: part['PartNumber'])
+        s3_client.complete_multipart_upload(
+            Bucket=AWS_BUCKET_NAME,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending = []
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        try:
+            s3_client.abort_multipart_upload(
+                Bucket=AWS_BUCKET_NAME,
+                Key=self.key,
+                UploadId=self.upload_id
+            )
+        except Exception as e:
+            logger.error(f"Error aborting multipart upload of {self.key}: {str(e)}")
+
+    def _send_part(self):
+        # Bound the number of buffered parts before queueing another one
+        while len(self.pending) >= S3_MULTIPART_MAX_INFLIGHT:
+            self.parts.append(self.pending.pop(0).result())
+
+        part_number = len(self.parts) + len(self.pending) + 1
+        # The buffer itself becomes the part's body, so it isn't copied
+        body, self.buffer = self.buffer, bytearray()
+        self.pending.append(_part_executor.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body):
+        response = s3_client.upload_part(
+            Bucket=AWS_BUCKET_NAME,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+
+def _cache_headers(cache_control):
+    return {'CacheControl': cache_control} if cache_control else {}
+
+
+def upload_stream(chunks, key, content_type, cache_control=None):
+    """
+    Store an iterable of byte chunks in S3 without holding the whole object.
+
+    Objects that fit in a single part go up with one put_object call; larger
+    ones switch to a multipart upload once the first part is full.
+    Returns the number of bytes stored.
+    """
+    buffer = bytearray()
+    upload = None
+    try:
+        for chunk in chunks:
+            if upload is not None:
+                upload.write(chunk)
+                continue
+            buffer.extend(chunk)
+            if len(buffer) >= S3_MULTIPART_PART_SIZE:
+                upload = MultipartUpload(key, content_type, cache_control)
+                upload.start()
+                upload.write(buffer)
+                buffer = bytearray()
+
+        if upload is None:
+            # boto3 takes the bytearray as it is; copying it would double peak memory
+            s3_client.put_object(
+                Bucket=AWS_BUCKET_NAME,
+                Key=key,
+                Body=buffer,
+                ContentType=content_type,
+                **_cache_headers(cache_control)
+            )
+            return len(buffer)
+
+        upload.complete()
+        return upload.size
+    except Exception:
+        if upload is not None:
+            upload.abort()
+        raise
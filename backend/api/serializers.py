@@ -1,5 +1,9 @@
 from rest_framework import serializers
 from .models import FloorPlan, InteriorDesign, DesignStyle, DesignPreference
+from .uploads import UPLOAD_MAX_BYTES, UPLOAD_CONTENT_TYPES
+from .generation import BATCH_MAX_VARIANTS
+from .cancellation import GENERATION_MAX_TIMEOUT
+from . import variants
 
 class DesignGenerationRequestSerializer(serializers.Serializer):
     image = serializers.URLField(required=True)
@@ -7,6 +11,8 @@ class DesignGenerationRequestSerializer(serializers.Serializer):
     room_type = serializers.CharField(required=True)
     color = serializers.CharField(required=True)
     additional_notes = serializers.CharField(required=False, allow_blank=True)
+    # Seconds the client will wait for the generation
+    timeout = serializers.FloatField(required=False, min_value=1, max_value=GENERATION_MAX_TIMEOUT)
 
 class RoomDesignRequestSerializer(serializers.Serializer):
     image = serializers.URLField(required=True)
@@ -22,6 +28,25 @@ class RoomDesignRequestSerializer(serializers.Serializer):
 class Generate3DLayoutRequestSerializer(serializers.Serializer):
     image = serializers.URLField(required=True)
     prompt = serializers.CharField(required=True)
+    num_outputs = serializers.IntegerField(required=False, default=1, min_value=1, max_value=4)
+    timeout = serializers.FloatField(required=False, min_value=1, max_value=GENERATION_MAX_TIMEOUT)
+
+class PresignedUploadRequestSerializer(serializers.Serializer):
+    file_name = serializers.CharField(required=True, max_length=255)
+    content_type = serializers.ChoiceField(choices=UPLOAD_CONTENT_TYPES)
+    size = serializers.IntegerField(min_value=1, max_value=UPLOAD_MAX_BYTES)
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+    method = serializers.ChoiceField(choices=['POST', 'PUT'], default='POST')
+
+    def validate_sha256(self, value):
+        return value.lower()
+
+class UploadCompleteRequestSerializer(serializers.Serializer):
+    file_name = serializers.CharField(required=True, max_length=255)
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+
+    def validate_sha256(self, value):
+        return value.lower()
 
 class DesignStyleSerializer(serializers.ModelSerializer):
     class Meta:
@@ -34,16 +59,12 @@ class FloorPlanSerializer(serializers.ModelSerializer):
         fields = ['id', 'image', 'uploaded_at', 'room_type', 'area_sqft']
 
 class DesignPreferenceSerializer(serializers.ModelSerializer):
-    style_name = serializers.CharField(source='style.name', read_only=True)
-
     class Meta:
         model = DesignPreference
-        fields = [
-            'id', 'floor_plan', 'style', 'style_name', 'color_scheme',
-            'budget_level', 'lighting_preference', 'additional_notes'
-        ]
+        fields = ['id', 'floor_plan', 'theme', 'color', 'additional_notes']
 
 class InteriorDesignSerializer(serializers.ModelSerializer):
+    """Takes an optional fields argument to render only some of its fields."""
     floor_plan = FloorPlanSerializer(read_only=True)
     preferences = DesignPreferenceSerializer(read_only=True)
     status = serializers.CharField(read_only=True)
@@ -56,6 +77,12 @@ class InteriorDesignSerializer(serializers.ModelSerializer):
             'status'
         ]
 
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
 class RoomDesignRequestSerializer(serializers.Serializer):
     image = serializers.URLField(required=True)
     theme = serializers.CharField(required=True)
@@ -67,3 +94,46 @@ class RoomDesignRequestSerializer(serializers.Serializer):
     lights = serializers.CharField(required=True)
     realistic = serializers.CharField(required=True)
     additional_notes = serializers.CharField(required=False, allow_blank=True)
+    timeout = serializers.FloatField(required=False, min_value=1, max_value=GENERATION_MAX_TIMEOUT)
+
+class RoomDesignVariantSerializer(RoomDesignRequestSerializer):
+    # The image and timeout are given once for the whole batch
+    image = None
+    timeout = None
+
+class RoomDesignBatchRequestSerializer(serializers.Serializer):
+    image = serializers.URLField(required=True)
+    variants = serializers.ListField(
+        child=RoomDesignVariantSerializer(),
+        min_length=1,
+        max_length=BATCH_MAX_VARIANTS
+    )
+    timeout = serializers.FloatField(required=False, min_value=1, max_value=GENERATION_MAX_TIMEOUT)
+
+    def to_internal_value(self, data):
+        # Fields given next to the variants apply to every variant that doesn't set them
+        variants = data.get('variants')
+        if isinstance(variants, list):
+            shared = {
+                name: value for name, value in data.items()
+                if name in RoomDesignVariantSerializer._declared_fields
+            }
+            data = {
+                'image': data.get('image'),
+                'variants': [dict(shared, **variant) if isinstance(variant, dict) else variant for variant in variants],
+                **({'timeout': data['timeout']} if 'timeout' in data else {})
+            }
+        return super().to_internal_value(data)
+
+class DesignJobStatusSerializer(serializers.ModelSerializer):
+    srcsets = serializers.SerializerMethodField()
+
+    class Meta:
+        model = InteriorDesign
+        fields = [
+            'id', 'status', 'stage', 'progress', 'output_urls', 'srcsets', 'error',
+            'created_at', 'processing_time'
+        ]
+
+    def get_srcsets(self, obj):
+        return [variants.srcset(url) for url in obj.output_urls]
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import weakref
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import GenerationLock
+
+logger = logging.getLogger(__name__)
+
+
+# Longest a duplicate caller waits for the in-flight execution (matches the Cloud Run request timeout)
+SINGLE_FLIGHT_TIMEOUT = int(os.getenv("SINGLE_FLIGHT_TIMEOUT", "300"))
+# How often a worker checks whether a lock held by another worker was released
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv("SINGLE_FLIGHT_POLL_INTERVAL", "0.5"))
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def flight_key(model, input_data):
+    """Identify a prediction by model version and its normalized input dict."""
+    normalized = {
+        name: value.strip() if isinstance(value, str) else value
+        for name, value in input_data.items()
+    }
+    blob = json.dumps({'model': model, 'input': normalized}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def run(key, func, recheck):
+    """
+    Execute func() once for all concurrent callers with the same key.
+
+    Callers in this process wait on the leader's execution. When another
+    worker holds the database lock, the leader waits for it to be released
+    and then asks recheck() for the stored result, running func() itself
+    only if none is available.
+
+    Returns (value, shared) where shared is True when the value was produced
+    by someone else's execution.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if not flight.done.wait(SINGLE_FLIGHT_TIMEOUT):
+            raise TimeoutError("Timed out waiting for an identical generation in progress")
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, True
+
+    try:
+        flight.result, shared = _run_locked(key, func, recheck)
+        return flight.result, shared
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+def _run_locked(key, func, recheck):
+    deadline = time.monotonic() + SINGLE_FLIGHT_TIMEOUT
+    while True:
+        if acquire(key):
+            try:
+                return func(), False
+            finally:
+                release(key)
+
+        logger.info(f"Generation {key[:12]} is in flight on another worker, waiting")
+        wait_for_release(key, deadline)
+        value = recheck()
+        if value is not None:
+            return value, True
+        if time.monotonic() >= deadline:
+            raise TimeoutError("Timed out waiting for an identical generation in progress")
+
+
+# Async callers coalesce per event loop; futures can't be awaited across loops
+_async_flights = weakref.WeakKeyDictionary()
+
+
+async def arun(key, func, recheck):
+    """
+    Async counterpart of run(): func and recheck are coroutine functions,
+    and waiting on another worker's lock doesn't hold a thread.
+    """
+    flights = _async_flights.setdefault(asyncio.get_running_loop(), {})
+    flight = flights.get(key)
+    if flight is not None:
+        try:
+            value = await asyncio.wait_for(asyncio.shield(flight), SINGLE_FLIGHT_TIMEOUT)
+        except asyncio.CancelledError:
+            if not flight.cancelled() or asyncio.current_task().cancelling():
+                raise
+            # The leader was cancelled, not this caller; run func for it instead
+            return await arun(key, func, recheck)
+        return value, True
+
+    flight = flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        value, shared = await _arun_locked(key, func, recheck)
+        flight.set_result(value)
+        return value, shared
+    except asyncio.CancelledError:
+        flight.cancel()
+        raise
+    except Exception as e:
+        flight.set_exception(e)
+        # Waiters see the exception; the leader re-raises it
+        flight.exception()
+        raise
+    finally:
+        flights.pop(key, None)
+
+
+async def _arun_locked(key, func, recheck):
+    deadline = time.monotonic() + SINGLE_FLIGHT_TIMEOUT
+    while True:
+        if await sync_to_async(acquire)(key):
+            try:
+                return await func(), False
+            finally:
+                await sync_to_async(release)(key)
+
+        logger.info(f"Generation {key[:12]} is in flight on another worker, waiting")
+        while time.monotonic() < deadline:
+            if not await GenerationLock.objects.filter(key=key, expires_at__gte=timezone.now()).aexists():
+                break
+            await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        value = await recheck()
+        if value is not None:
+            return value, True
+        if time.monotonic() >= deadline:
+            raise TimeoutError("Timed out waiting for an identical generation in progress")
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def acquire(key):
+    now = timezone.now()
+    # A lock whose owner died is taken over once it expires
+    GenerationLock.objects.filter(key=key, expires_at__lt=now).delete()
+    try:
+        with transaction.atomic():
+            GenerationLock.objects.create(
+                key=key,
+                owner=_owner(),
+                expires_at=now + timedelta(seconds=SINGLE_FLIGHT_TIMEOUT)
+            )
+        return True
+    except IntegrityError:
+        return False
+
+
+def release(key):
+    GenerationLock.objects.filter(key=key, owner=_owner()).delete()
+
+
+def wait_for_release(key, deadline):
+    while time.monotonic() < deadline:
+        if not GenerationLock.objects.filter(key=key, expires_at__gte=timezone.now()).exists():
+            return
+        time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
@@ -0,0 +1,23 @@
+import os
+from django.utils.functional import SimpleLazyObject
+from .clients import build_s3_client
+
+
+AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
+AWS_REGION = os.getenv("AWS_REGION")
+# S3-compatible endpoint to use instead of AWS, e.g. the benchmark's local stand-in
+AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL")
+
+# Built on first use, so boto3 isn't imported during a cold start
+s3_client = SimpleLazyObject(lambda: build_s3_client(
+    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+    region_name=AWS_REGION,
+    endpoint_url=AWS_S3_ENDPOINT_URL,
+))
+
+
+def s3_url(key):
+    if AWS_S3_ENDPOINT_URL:
+        return f"{AWS_S3_ENDPOINT_URL.rstrip('/')}/{AWS_BUCKET_NAME}/{key}"
+    return f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{key}"
@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import hashlib
+import itertools
+import threading
+from collections import namedtuple
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import DesignStyle
+
+
+# The style list rarely changes, so each process keeps it in memory. Saving
+# or deleting a style clears it in the process that did so; other processes
+# pick the change up within STYLE_CATALOG_TTL seconds.
+STYLE_CATALOG_TTL = float(os.getenv("STYLE_CATALOG_TTL", "60"))
+
+# styles: serialized style list; etag: strong ETag of its content;
+# last_modified: Unix time its content last changed
+Catalog = namedtuple('Catalog', ['styles', 'etag', 'last_modified', 'expires_at'])
+
+_catalog = None
+_load_lock = threading.Lock()
+_generations = itertools.count(1)
+_generation = 0
+
+
+def get():
+    """The style catalog, loaded from the database when it isn't cached."""
+    catalog = _catalog
+    if catalog is not None and time.monotonic() < catalog.expires_at:
+        return catalog
+    return _load()
+
+
+def _load():
+    global _catalog
+    from .serializers import DesignStyleSerializer
+
+    with _load_lock:
+        previous = _catalog
+        if previous is not None and time.monotonic() < previous.expires_at:
+            # Loaded by another thread while this one waited
+            return previous
+
+        generation = _generation
+        styles = list(DesignStyleSerializer(DesignStyle.objects.order_by('id'), many=True).data)
+        body = json.dumps(styles, sort_keys=True, separators=(',', ':'), default=str)
+        etag = f'"{hashlib.sha256(body.encode()).hexdigest()[:32]}"'
+        # Reloading unchanged content keeps its Last-Modified
+        if previous is not None and previous.etag == etag:
+            last_modified = previous.last_modified
+        else:
+            last_modified = int(time.time())
+
+        catalog = Catalog(styles, etag, last_modified, time.monotonic() + STYLE_CATALOG_TTL)
+        # Don't keep a list that was invalidated while it was being read
+        if generation == _generation:
+            _catalog = catalog
+        return catalog
+
+
+def invalidate():
+    global _catalog, _generation
+    _generation = next(_generations)
+    _catalog = None
+
+
+@receiver([post_save, post_delete], sender=DesignStyle, dispatch_uid='style_catalog_invalidate')
+def _style_changed(sender, **kwargs):
+    invalidate()
+    # Again once committed, in case a request cached the old list in between
+    transaction.on_commit(invalidate)
@@ -1,12 +1,33 @@
-from django.test import TestCase
+from django.test import Client, LiveServerTestCase, TestCase, override_settings
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
-from .models import FloorPlan, DesignPreference, InteriorDesign, DesignStyle
+from .models import FloorPlan, DesignPreference, InteriorDesign, DesignStyle, PredictionCacheEntry, GenerationLock, UploadedImage, NormalizedImage, ClientRateBucket, PendingPrediction
+from . import prediction_cache, single_flight
+import threading
+import logging
+import json
+import time
+import hashlib
+from .upload_handlers import S3StreamingUploadHandler
+from . import s3_multipart, async_storage, clients, transports, normalize, uploads, variants, edges, metrics, benchmark, style_catalog, admission, webhooks, progress, cancellation
+from prometheus_client import REGISTRY
+import os
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import asyncio
+from asgiref.sync import async_to_sync
 from .serializers import DesignGenerationRequestSerializer
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, AsyncMock
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from .management.commands.startup_profile import parse_importtime
+from .storage import s3_url
+from .generation import generate, roomdesign_key, run_prediction, output_chunks, INTERIOR_DESIGN_MODEL, CONTROLNET_MODEL
 from io import BytesIO
+from PIL import Image
+from datetime import timedelta
+from django.utils import timezone
 
 
 class ViewTests(TestCase):
@@ -29,8 +50,8 @@ class ViewTests(TestCase):
         )
 
     # Design Generation Tests
-    @patch('api.views.replicate.Client')
-    @patch('api.views.s3_client.put_object')
+    @patch('api.generation.replicate_client')
+    @patch('api.storage.s3_client.put_object')
 
     def test_generate_design_invalid_data(self):
         """Test design generation with invalid data"""
@@ -45,7 +66,7 @@ class ViewTests(TestCase):
         response = self.client.post(url, data, format='multipart')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @patch('api.views.replicate.Client')
+    @patch('api.generation.replicate_client')
     def test_generate_design_api_error(self, mock_replicate):
         """Test handling of API errors"""
         mock_replicate.return_value.run.side_effect = Exception('API Error')
@@ -62,17 +83,58 @@ class ViewTests(TestCase):
         response = self.client.post(url, data, format='multipart')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @patch('api.views.s3_client.upload_fileobj')
-    def test_upload_image_success(self, mock_upload):
-        mock_upload.return_value = None
-        with open('test_image.jpg', 'rb') as img:
-            response = self.client.post(
-                reverse('upload-image'),
-                {'image': img},
-                format='multipart'
-            )
+    @patch('api.storage.s3_client.delete_object')
+    @patch('api.storage.s3_client.copy_object')
+    @patch('api.storage.s3_client.complete_multipart_upload')
+    @patch('api.storage.s3_client.upload_part', return_value={'ETag': 'etag-1'})
+    @patch('api.storage.s3_client.create_multipart_upload', return_value={'UploadId': 'upload-1'})
+    def test_upload_image_success(self, mock_create, mock_part, mock_complete, mock_copy, mock_delete):
+        digest = hashlib.sha256(b'dummy image data').hexdigest()
+        response = self.client.post(
+            reverse('upload-image'),
+            {'image': self.image},
+            format='multipart'
+        )
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('url', response.data)
+        self.assertEqual(response.data['sha256'], digest)
+        self.assertTrue(response.data['url'].endswith(f"uploads/{digest}.jpg"))
+        self.assertFalse(response.data['deduplicated'])
+        mock_complete.assert_called_once()
+        self.assertEqual(mock_copy.call_args.kwargs['Key'], f"uploads/{digest}.jpg")
+        self.assertTrue(UploadedImage.objects.filter(sha256=digest).exists())
+
+    @patch('api.storage.s3_client.create_multipart_upload')
+    def test_upload_image_known_hash_skips_transfer(self, mock_create):
+        digest = hashlib.sha256(b'dummy image data').hexdigest()
+        UploadedImage.objects.create(sha256=digest, key=f"uploads/{digest}.jpg", size=16)
+
+        response = self.client.post(
+            reverse('upload-image'),
+            {'image': self.image},
+            format='multipart',
+            HTTP_X_CONTENT_SHA256=digest
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['deduplicated'])
+        mock_create.assert_not_called()
+
+    @patch('api.storage.s3_client.abort_multipart_upload')
+    @patch('api.storage.s3_client.complete_multipart_upload')
+    @patch('api.storage.s3_client.create_multipart_upload', return_value={'UploadId': 'upload-1'})
+    def test_upload_image_duplicate_content_is_not_stored(self, mock_create, mock_complete, mock_abort):
+        digest = hashlib.sha256(b'dummy image data').hexdigest()
+        UploadedImage.objects.create(sha256=digest, key=f"uploads/{digest}.jpg", size=16)
+
+        response = self.client.post(
+            reverse('upload-image'),
+            {'image': self.image},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['deduplicated'])
+        mock_complete.assert_not_called()
+        mock_abort.assert_called_once()
 
     def test_upload_image_missing_file(self):
         response = self.client.post(
@@ -83,15 +145,16 @@ class ViewTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn('error', response.data)
 
-    @patch('api.views.s3_client.upload_fileobj')
-    def test_upload_image_s3_failure(self, mock_upload):
-        mock_upload.side_effect = Exception('S3 upload failed')
-        with open('test_image.jpg', 'rb') as img:
-            response = self.client.post(
-                reverse('upload-image'),
-                {'image': img},
-                format='multipart'
-            )
+    @patch('api.storage.s3_client.abort_multipart_upload')
+    @patch('api.storage.s3_client.upload_part', side_effect=Exception('S3 upload failed'))
+    @patch('api.storage.s3_client.create_multipart_upload', return_value={'UploadId': 'upload-1'})
+    def test_upload_image_s3_failure(self, mock_create, mock_part, mock_abort):
+        response = self.client.post(
+            reverse('upload-image'),
+            {'image': self.image},
+            format='multipart'
+        )
+        mock_abort.assert_called_once()
         self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
         self.assertIn('error', response.data)
 
@@ -109,19 +172,18 @@ class ViewTests(TestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @patch('api.views.s3_client.upload_fileobj')
-    def test_upload_s3_config_error(self, mock_upload):
-        mock_upload.side_effect = Exception('S3 configuration error')
-        with open('test_image.jpg', 'rb') as img:
-            response = self.client.post(
-                reverse('upload-image'),
-                {'image': img},
-                format='multipart'
-            )
+    @patch('api.storage.s3_client.create_multipart_upload')
+    def test_upload_s3_config_error(self, mock_create):
+        mock_create.side_effect = Exception('S3 configuration error')
+        response = self.client.post(
+            reverse('upload-image'),
+            {'image': self.image},
+            format='multipart'
+        )
         self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    @patch('api.views.replicate.Client')
-    @patch('api.views.s3_client.put_object')
+    @patch('api.generation.replicate_client')
+    @patch('api.storage.s3_client.put_object')
     def test_generate_design_missing_required_fields(self, mock_s3, mock_replicate):
         """Test design generation with missing required fields"""
         url = reverse('generate')
@@ -134,8 +196,8 @@ class ViewTests(TestCase):
         response = self.client.post(url, data, format='multipart')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @patch('api.views.replicate.Client')
-    @patch('api.views.s3_client.put_object')
+    @patch('api.generation.replicate_client')
+    @patch('api.storage.s3_client.put_object')
     def test_generate_design_invalid_image_format(self, mock_s3, mock_replicate):
         """Test design generation with invalid image format"""
         invalid_image = SimpleUploadedFile(
@@ -156,8 +218,8 @@ class ViewTests(TestCase):
         response = self.client.post(url, data, format='multipart')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @patch('api.views.replicate.Client')
-    @patch('api.views.s3_client.put_object')
+    @patch('api.generation.replicate_client')
+    @patch('api.storage.s3_client.put_object')
     def test_generate_design_serializer_error(self, mock_s3, mock_replicate):
         """
         Test that the API returns a 400 status code when a serializer error
@@ -180,8 +242,8 @@ class ViewTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
     # Room Design Tests
-    @patch('api.views.replicate.Client')
-    @patch('api.views.s3_client.put_object')
+    @patch('api.generation.replicate_client')
+    @patch('api.storage.s3_client.put_object')
     def test_room_design_invalid_data(self):
         response = self.client.post(
             reverse('room-design'),
@@ -212,7 +274,7 @@ class ViewTests(TestCase):
         url = reverse('interiordesign-list')
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_get_floor_plans_error(self):
         """Test retrieving floor plans"""
@@ -228,7 +290,7 @@ class ViewTests(TestCase):
         self.assertEqual(len(response.data['results']), 10)
 
     # 3D Layout Tests
-    @patch('api.views.replicate.Client')
+    @patch('api.generation.replicate_client')
     def test_generate_3d_layout_failure(self, mock_replicate):
         """Test successful 3D layout generation"""
         mock_replicate.return_value.run.return_value = Mock(read=lambda: b'3d_data')
@@ -261,26 +323,2163 @@ class ViewTests(TestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def test_memory_usage_is_logged_per_request(self):
+        with self.assertLogs('api.middleware', level='INFO') as logs:
+            self.client.get(reverse('interiordesign-list'))
 
-class ModelTests(TestCase):
-    def test_create_floor_plan(self):
-        """Test creating a floor plan"""
-        floor_plan = FloorPlan.objects.create(
-            room_type='living_room',
-            area_sqft=500
+        [message] = logs.output
+        # The request's own growth, next to the process-wide peak
+        self.assertRegex(message, r'GET /api/designs/ status=200 rss_delta=[+-]\d+\.\dMiB process_peak_rss=')
+
+    @override_settings(DEBUG=True)
+    def test_memory_usage_middleware_is_not_adapted_under_asgi(self):
+        from django.core.handlers.asgi import ASGIHandler
+
+        with self.assertLogs('django.request', level='DEBUG') as logs:
+            logging.getLogger('django.request').debug('loaded')
+            ASGIHandler().load_middleware(is_async=True)
+
+        # Adapting it would run every async request through a thread
+        self.assertFalse([line for line in logs.output if 'MemoryUsageMiddleware' in line])
+
+
+@override_settings(GENERATION_JOBS_EAGER=True)
+class GenerationJobTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.data = {
+            'image': 'https://example.com/image.jpg',
+            'theme': 'Modern',
+            'room_type': 'living_room',
+            'color': 'White',
+            'additional_notes': 'Some notes'
+        }
+
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_generate_design_async_completes(self, mock_s3, mock_run):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+
+        response = self.client.post(reverse('generate') + '?async=true', self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn('job_id', response.data)
+        self.assertTrue(response.data['events_url'].endswith(f"/api/designs/{response.data['job_id']}/events/"))
+
+        response = self.client.get(reverse('interiordesign-job-status', args=[response.data['job_id']]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'completed')
+        self.assertEqual(len(response.data['output_urls']), 1)
+        self.assertIsNotNone(response.data['processing_time'])
+        mock_s3.assert_called_once()
+        design = InteriorDesign.objects.get(pk=response.data['id'])
+        self.assertEqual(design.generated_image.name, response.data['output_urls'][0])
+
+    @override_settings(SECURE_PROXY_SSL_HEADER=('HTTP_X_FORWARDED_PROTO', 'https'))
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_job_urls_are_https_behind_a_tls_proxy(self, mock_s3, mock_run):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+
+        response = self.client.post(
+            reverse('generate') + '?async=true', self.data, format='json', HTTP_X_FORWARDED_PROTO='https'
         )
-        self.assertEqual(str(floor_plan), f"living_room - {floor_plan.uploaded_at}")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        for url in (response.data['status_url'], response.data['events_url'], response['Location']):
+            self.assertTrue(url.startswith('https://'), url)
 
-    def test_create_design_preference(self):
-        """Test creating design preferences"""
-        floor_plan = FloorPlan.objects.create(room_type='bedroom', area_sqft=300)
-        preferences = DesignPreference.objects.create(
-            floor_plan=floor_plan,
-            theme='Modern',
-            color='White',
-            additional_notes='Some notes'
+    @patch('api.generation.run_prediction')
+    def test_generate_3d_layout_async_failure(self, mock_run):
+        mock_run.side_effect = Exception('API Error')
+
+        response = self.client.post(
+            reverse('generate-3d-layout'),
+            {'image': 'https://example.com/image.jpg', 'prompt': 'Modern living room'},
+            format='json',
+            HTTP_PREFER='respond-async'
         )
-        self.assertEqual(str(preferences), f"Preferences for {floor_plan}")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        design = InteriorDesign.objects.get(pk=response.data['job_id'])
+        self.assertEqual(design.status, 'failed')
+        self.assertEqual(design.error, 'API Error')
+        self.assertEqual(design.generated_image.name, '')
+
+
+@override_settings(GENERATION_JOBS_EAGER=True)
+class RoomDesignBatchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.data = {
+            'image': 'https://example.com/room.jpg',
+            'room_type': 'living_room',
+            'color': 'White',
+            'accessories': 'plants',
+            'furniture': 'sofa',
+            'walls': 'white',
+            'lights': 'warm lights',
+            'realistic': 'realistic',
+            'variants': [{'theme': 'Modern'}, {'theme': 'Boho', 'color': 'Terracotta'}, {'theme': 'Japandi'}]
+        }
+
+    def lines(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_variants_stream_back_and_share_the_image(self, mock_s3, mock_run, mock_digest):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+
+        response = self.client.post(reverse('room-design-batch'), self.data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = self.lines(response)
+        self.assertEqual(sorted(line['index'] for line in lines[:-1]), [0, 1, 2])
+        self.assertEqual(lines[-1]['completed'], 3)
+        mock_digest.assert_called_once()
+        self.assertEqual(mock_run.call_count, 3)
+        self.assertIn('Terracotta', mock_run.call_args_list[1].args[1]['prompt'])
+
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_failed_variant_does_not_fail_the_batch(self, mock_s3, mock_run, mock_digest):
+        mock_run.side_effect = [Mock(read=lambda: b'a'), Exception('API Error'), Mock(read=lambda: b'c')]
+
+        lines = self.lines(self.client.post(reverse('room-design-batch'), self.data, format='json'))
+
+        self.assertEqual(lines[1], {'index': 1, 'status': 'failed', 'error': 'API Error'})
+        self.assertEqual((lines[-1]['completed'], lines[-1]['failed']), (2, 1))
+
+    @override_settings(GENERATION_JOBS_EAGER=False)
+    @patch('api.generation.record_design')
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.generate')
+    @patch('api.generation._get_batch_executor')
+    def test_results_arrive_in_completion_order(self, mock_executor, mock_generate, mock_digest, mock_record):
+        # A pool of its own, so every variant runs at once whatever other tests left running
+        executor = ThreadPoolExecutor(max_workers=3)
+        self.addCleanup(executor.shutdown)
+        mock_executor.return_value = executor
+        others_read = threading.Event()
+
+        def generate(model, input_data, key_func, digest=None, admit=False):
+            # The first variant finishes once the other two have been streamed back
+            if 'Modern' in input_data['prompt']:
+                others_read.wait(5)
+            return Mock(urls=[input_data['prompt'][:20]], cache='miss')
+
+        mock_generate.side_effect = generate
+
+        content = iter(self.client.post(reverse('room-design-batch'), self.data, format='json').streaming_content)
+        first = [json.loads(next(content)) for _ in range(2)]
+        others_read.set()
+        rest = [json.loads(line) for line in b''.join(content).splitlines()]
+
+        self.assertEqual(sorted(line['index'] for line in first), [1, 2])
+        self.assertEqual(rest[0]['index'], 0)
+        self.assertEqual(rest[-1]['completed'], 3)
+
+    @override_settings(GENERATION_JOBS_EAGER=False)
+    @patch('api.generation.record_design')
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.generate')
+    def test_closed_stream_cancels_running_variants(self, mock_generate, mock_digest, mock_record):
+        stopped = threading.Event()
+
+        def generate(model, input_data, key_func, digest=None, admit=False):
+            if 'Modern' in input_data['prompt']:
+                # A prediction that runs until the client goes away
+                for _ in range(500):
+                    try:
+                        cancellation.check()
+                    except cancellation.Cancelled:
+                        stopped.set()
+                        raise
+                    time.sleep(0.01)
+            return Mock(urls=[input_data['prompt'][:20]], cache='miss')
+
+        mock_generate.side_effect = generate
+
+        response = self.client.post(reverse('room-design-batch'), self.data, format='json')
+        next(iter(response.streaming_content))
+        response.close()
+
+        self.assertTrue(stopped.wait(5))
+
+    def test_invalid_batch(self):
+        response = self.client.post(reverse('room-design-batch'), dict(self.data, variants=[]), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        del self.data['room_type']
+        response = self.client.post(reverse('room-design-batch'), self.data, format='json')
+        self.assertIn('variants', response.data)
+
+
+class PredictionCacheTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.data = {
+            'image': 'https://example.com/image.jpg',
+            'theme': 'Modern',
+            'room_type': 'living_room',
+            'color': 'White',
+            'additional_notes': 'Some notes'
+        }
+
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_repeated_generation_is_served_from_cache(self, mock_s3, mock_run, mock_digest):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+
+        first = self.client.post(reverse('generate'), self.data, format='json')
+        second = self.client.post(reverse('generate'), self.data, format='json')
+
+        self.assertEqual(first.data['cache'], 'miss')
+        self.assertEqual(second.data['cache'], 'hit')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.data['url'], second.data['url'])
+        mock_run.assert_called_once()
+        mock_s3.assert_called_once()
+
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_different_inputs_miss(self, mock_s3, mock_run, mock_digest):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+
+        self.client.post(reverse('generate'), self.data, format='json')
+        response = self.client.post(reverse('generate'), dict(self.data, color='Blue'), format='json')
+
+        self.assertEqual(response.data['cache'], 'miss')
+        self.assertEqual(mock_run.call_count, 2)
+
+    def test_expired_entry_is_a_miss(self):
+        key = prediction_cache.prediction_key('model', {'image': 'x', 'prompt': 'p'}, 'sha256:abc')
+        prediction_cache.store(key, 'model', ['https://bucket/a.png'])
+        self.assertEqual(prediction_cache.lookup(key), ['https://bucket/a.png'])
+
+        with patch.object(prediction_cache, 'PREDICTION_CACHE_TTL', 60):
+            PredictionCacheEntry.objects.update(created_at=timezone.now() - timedelta(seconds=120))
+            self.assertIsNone(prediction_cache.lookup(key))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        with patch.object(prediction_cache, 'PREDICTION_CACHE_MAX_ENTRIES', 2):
+            prediction_cache.store('a', 'model', ['https://bucket/a.png'])
+            prediction_cache.store('b', 'model', ['https://bucket/b.png'])
+            PredictionCacheEntry.objects.filter(key='a').update(
+                last_used_at=timezone.now() + timedelta(seconds=1)
+            )
+            prediction_cache.store('c', 'model', ['https://bucket/c.png'])
+
+        self.assertEqual(
+            set(PredictionCacheEntry.objects.values_list('key', flat=True)),
+            {'a', 'c'}
+        )
+
+
+class SingleFlightTests(TestCase):
+    def test_flight_key_normalizes_inputs(self):
+        self.assertEqual(
+            single_flight.flight_key('model', {'image': 'x', 'prompt': ' room '}),
+            single_flight.flight_key('model', {'prompt': 'room', 'image': 'x'})
+        )
+
+    @patch('api.single_flight.release')
+    @patch('api.single_flight.acquire', return_value=True)
+    def test_concurrent_callers_share_one_execution(self, mock_acquire, mock_release):
+        started = threading.Event()
+        finish = threading.Event()
+        calls = []
+
+        def predict():
+            calls.append(1)
+            started.set()
+            finish.wait(5)
+            return 'url'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.run('k', predict, lambda: None)))
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(target=lambda: results.append(single_flight.run('k', predict, lambda: None)))
+            for _ in range(2)
+        ]
+        for follower in followers:
+            follower.start()
+        finish.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('url', False), ('url', True), ('url', True)])
+
+    def test_waits_for_lock_held_by_another_worker(self):
+        GenerationLock.objects.create(
+            key='k', owner='other-worker', expires_at=timezone.now() + timedelta(seconds=60)
+        )
+        predict = Mock(return_value='fresh')
+
+        # The other worker finishes while we poll
+        with patch('api.single_flight.time.sleep', side_effect=lambda _: GenerationLock.objects.all().delete()):
+            result = single_flight.run('k', predict, lambda: 'stored')
+
+        self.assertEqual(result, ('stored', True))
+        predict.assert_not_called()
+
+    def test_expired_lock_is_taken_over(self):
+        GenerationLock.objects.create(
+            key='k', owner='dead-worker', expires_at=timezone.now() - timedelta(seconds=1)
+        )
+
+        result = single_flight.run('k', lambda: 'fresh', lambda: None)
+
+        self.assertEqual(result, ('fresh', False))
+        self.assertFalse(GenerationLock.objects.exists())
+
+
+class PresignedUploadTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.digest = hashlib.sha256(b'image bytes').hexdigest()
+        self.data = {
+            'file_name': 'plan.png',
+            'content_type': 'image/png',
+            'size': 1024,
+            'sha256': self.digest
+        }
+
+    @patch('api.storage.s3_client.generate_presigned_post')
+    def test_presigned_post_limits_size_and_type(self, mock_presign):
+        mock_presign.return_value = {'url': 'https://bucket.s3.amazonaws.com/', 'fields': {'key': 'k'}}
+
+        response = self.client.post(reverse('upload-url'), self.data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['upload']['method'], 'POST')
+        self.assertEqual(response.data['upload']['key'], f"uploads/{self.digest}.png")
+        conditions = mock_presign.call_args.kwargs['Conditions']
+        self.assertIn(['content-length-range', 1, 1024], conditions)
+        self.assertIn({'Content-Type': 'image/png'}, conditions)
+
+    def test_presign_rejects_unsupported_uploads(self):
+        response = self.client.post(reverse('upload-url'), dict(self.data, content_type='text/plain'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('upload-url'), dict(self.data, size=10 ** 10), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('api.storage.s3_client.generate_presigned_post')
+    def test_presign_known_content_is_deduplicated(self, mock_presign):
+        UploadedImage.objects.create(sha256=self.digest, key=f"uploads/{self.digest}.png", size=11)
+
+        response = self.client.post(reverse('upload-url'), self.data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['deduplicated'])
+        mock_presign.assert_not_called()
+
+    @patch('api.storage.s3_client.get_object')
+    @patch('api.storage.s3_client.head_object')
+    def test_complete_records_upload(self, mock_head, mock_get):
+        buffer = BytesIO()
+        Image.new('RGB', (40, 30)).save(buffer, format='PNG')
+        digest = hashlib.sha256(buffer.getvalue()).hexdigest()
+        # Stored without a checksum, so it is hashed as it is read back
+        mock_head.return_value = {'ContentLength': len(buffer.getvalue()), 'ContentType': 'image/png'}
+        mock_get.side_effect = lambda **kwargs: {'Body': BytesIO(buffer.getvalue())}
+
+        response = self.client.post(
+            reverse('upload-complete'),
+            {'file_name': 'plan.png', 'sha256': digest},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        record = UploadedImage.objects.get(sha256=digest)
+        self.assertEqual((record.width, record.height), (40, 30))
+
+    @patch('api.storage.s3_client.delete_object')
+    @patch('api.storage.s3_client.get_object')
+    @patch('api.storage.s3_client.head_object')
+    def test_complete_rejects_objects_that_do_not_hash_to_their_sha256(self, mock_head, mock_get, mock_delete):
+        mock_head.return_value = {'ContentLength': 11, 'ContentType': 'image/png'}
+        mock_get.return_value = {'Body': BytesIO(b'other bytes')}
+
+        response = self.client.post(
+            reverse('upload-complete'),
+            {'file_name': 'plan.png', 'sha256': self.digest},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_delete.assert_called_once()
+        self.assertFalse(UploadedImage.objects.exists())
+
+    @patch('api.storage.s3_client.delete_object')
+    @patch('api.storage.s3_client.head_object')
+    def test_complete_rejects_objects_outside_limits(self, mock_head, mock_delete):
+        mock_head.return_value = {'ContentLength': 10, 'ContentType': 'text/html'}
+
+        response = self.client.post(
+            reverse('upload-complete'),
+            {'file_name': 'plan.png', 'sha256': self.digest},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_delete.assert_called_once()
+        self.assertFalse(UploadedImage.objects.exists())
+
+    @patch('api.storage.s3_client.delete_object')
+    @patch('api.storage.s3_client.head_object')
+    def test_complete_returns_indexed_upload_without_touching_it(self, mock_head, mock_delete):
+        UploadedImage.objects.create(sha256=self.digest, key=f"uploads/{self.digest}.png", size=11)
+
+        response = self.client.post(
+            reverse('upload-complete'),
+            {'file_name': 'plan.png', 'sha256': self.digest.upper()},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['deduplicated'])
+        self.assertEqual(response.data['url'], s3_url(f"uploads/{self.digest}.png"))
+        mock_head.assert_not_called()
+        mock_delete.assert_not_called()
+
+    @patch('api.storage.s3_client.delete_object')
+    @patch('api.storage.s3_client.head_object')
+    def test_indexed_objects_are_never_deleted(self, mock_head, mock_delete):
+        key = f"uploads/{self.digest}.png"
+        UploadedImage.objects.create(sha256='0' * 64, key=key, size=11)
+        mock_head.return_value = {'ContentLength': 10, 'ContentType': 'text/html'}
+
+        self.assertIsNone(uploads.record_direct_upload(self.digest, 'plan.png'))
+        mock_delete.assert_not_called()
+
+
+class StreamingUploadHandlerTests(TestCase):
+    @patch.object(s3_multipart, 'S3_MULTIPART_PART_SIZE', 4)
+    @patch('api.s3_multipart.s3_client')
+    def test_chunks_are_forwarded_as_ordered_parts(self, mock_s3):
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+
+        handler = S3StreamingUploadHandler(key_func=lambda name: f"uploads/{name}")
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file('image', 'plan.png', 'image/png', None)
+        for start, chunk in enumerate([b'abc', b'defgh', b'ij']):
+            self.assertIsNone(handler.receive_data_chunk(chunk, start))
+        uploaded = handler.file_complete(10)
+
+        self.assertEqual(uploaded.key, 'uploads/plan.png')
+        self.assertEqual(uploaded.sha256, hashlib.sha256(b'abcdefghij').hexdigest())
+        parts = mock_s3.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']
+        self.assertEqual([part['PartNumber'] for part in parts], [1, 2])
+        bodies = [call.kwargs['Body'] for call in mock_s3.upload_part.call_args_list]
+        self.assertEqual(b''.join(bodies), b'abcdefghij')
+
+    @patch('api.s3_multipart.s3_client')
+    def test_image_dimensions_are_read_from_the_stream(self, mock_s3):
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3.upload_part.return_value = {'ETag': 'etag-1'}
+        buffer = BytesIO()
+        Image.new('RGB', (40, 30)).save(buffer, format='PNG')
+
+        handler = S3StreamingUploadHandler()
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file('image', 'plan.png', 'image/png', None)
+        handler.receive_data_chunk(buffer.getvalue(), 0)
+        uploaded = handler.file_complete(len(buffer.getvalue()))
+
+        self.assertEqual((uploaded.width, uploaded.height), (40, 30))
+
+    def test_other_fields_fall_through(self):
+        handler = S3StreamingUploadHandler()
+        handler.new_file('attachment', 'notes.txt', 'text/plain', None)
+        self.assertEqual(handler.receive_data_chunk(b'data', 0), b'data')
+        self.assertIsNone(handler.file_complete(4))
+
+
+class LayoutFanOutTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.data = {
+            'image': 'https://example.com/plan.png',
+            'prompt': 'Modern living room',
+            'num_outputs': 3
+        }
+
+    @patch('api.generation.image_digest', return_value=None)
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_outputs_keep_order_and_partial_failures_are_returned(self, mock_s3, mock_run, mock_digest):
+        mock_run.return_value = [
+            Mock(read=lambda body=body: body) for body in (b'first', b'second', b'third')
+        ]
+        stored = {}
+
+        def put_object(**kwargs):
+            if kwargs['Body'] == b'second':
+                raise Exception('S3 unavailable')
+            stored[kwargs['Key']] = kwargs['Body']
+
+        mock_s3.side_effect = put_object
+
+        response = self.client.post(reverse('generate-3d-layout'), self.data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['failed_outputs'], 1)
+        self.assertEqual(mock_run.call_args.args[1]['num_outputs'], 3)
+        bodies = [stored[url.split('.amazonaws.com/')[1]] for url in response.data['image_urls']]
+        self.assertEqual(bodies, [b'first', b'third'])
+
+    @patch('api.generation.image_digest', return_value=None)
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object', side_effect=Exception('S3 unavailable'))
+    def test_all_outputs_failing_is_an_error(self, mock_s3, mock_run, mock_digest):
+        mock_run.return_value = [Mock(read=lambda: b'first'), Mock(read=lambda: b'second')]
+
+        response = self.client.post(reverse('generate-3d-layout'), self.data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def test_num_outputs_is_bounded(self):
+        response = self.client.post(
+            reverse('generate-3d-layout'), dict(self.data, num_outputs=10), format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class OutputStreamingTests(TestCase):
+    @patch('api.s3_multipart.s3_client')
+    def test_small_output_is_a_single_put(self, mock_s3):
+        size = s3_multipart.upload_stream(iter([b'abc', b'def']), 'roomdesign/a.png', 'image/png')
+
+        self.assertEqual(size, 6)
+        body = mock_s3.put_object.call_args.kwargs['Body']
+        # The buffer is sent as it is, not copied to bytes
+        self.assertIsInstance(body, bytearray)
+        self.assertEqual(body, b'abcdef')
+        mock_s3.create_multipart_upload.assert_not_called()
+
+    @patch.object(s3_multipart, 'S3_MULTIPART_PART_SIZE', 4)
+    @patch('api.s3_multipart.s3_client')
+    def test_large_output_switches_to_multipart(self, mock_s3):
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+
+        size = s3_multipart.upload_stream(iter([b'abc', b'defgh', b'ij']), 'roomdesign/a.png', 'image/png')
+
+        self.assertEqual(size, 10)
+        mock_s3.put_object.assert_not_called()
+        bodies = [call.kwargs['Body'] for call in mock_s3.upload_part.call_args_list]
+        self.assertEqual(b''.join(bodies), b'abcdefghij')
+        self.assertTrue(all(len(body) >= 4 for body in bodies[:-1]))
+        mock_s3.complete_multipart_upload.assert_called_once()
+
+    @patch.object(s3_multipart, 'S3_MULTIPART_PART_SIZE', 4)
+    @patch('api.s3_multipart.s3_client')
+    def test_failed_stream_aborts_the_upload(self, mock_s3):
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+
+        def chunks():
+            yield b'abcdef'
+            raise IOError('connection reset')
+
+        with self.assertRaises(IOError):
+            s3_multipart.upload_stream(chunks(), 'roomdesign/a.png', 'image/png')
+        mock_s3.abort_multipart_upload.assert_called_once()
+        mock_s3.complete_multipart_upload.assert_not_called()
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.data = {
+            'image': 'https://example.com/image.jpg',
+            'theme': 'Modern',
+            'room_type': 'living_room',
+            'color': 'White',
+            'additional_notes': 'Some notes'
+        }
+
+    @patch('api.async_generation.aimage_digest', new_callable=AsyncMock, return_value='sha256:abc')
+    @patch('api.async_generation.arun_prediction', new_callable=AsyncMock)
+    @patch('api.async_storage.put_object', new_callable=AsyncMock)
+    def test_generate_design_matches_sync_response(self, mock_put, mock_run, mock_digest):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+
+        first = self.client.post(reverse('generate-async'), self.data, content_type='application/json')
+        second = self.client.post(reverse('generate-async'), self.data, content_type='application/json')
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.json()['cache'], 'miss')
+        self.assertEqual(second.json()['cache'], 'hit')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.json()['url'], second.json()['url'])
+        mock_run.assert_awaited_once()
+        mock_put.assert_awaited_once()
+
+    def test_room_design_invalid_data(self):
+        response = self.client.post(reverse('room-design-async'), {}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('api.async_generation.aimage_digest', new_callable=AsyncMock, return_value=None)
+    @patch('api.async_generation.arun_prediction', new_callable=AsyncMock)
+    def test_generate_3d_layout_failure(self, mock_run, mock_digest):
+        mock_run.side_effect = Exception('API Error')
+
+        response = self.client.post(
+            reverse('generate-3d-layout-async'),
+            {'image': 'https://example.com/image.jpg', 'prompt': 'Modern living room'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(response.json()['error'], 'Failed to generate 3D layout')
+
+    @patch('api.async_storage.put_object', new_callable=AsyncMock)
+    def test_upload_goes_straight_to_content_key(self, mock_put):
+        buffer = BytesIO()
+        Image.new('RGB', (4, 3)).save(buffer, format='PNG')
+        content = buffer.getvalue()
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        def upload():
+            image = SimpleUploadedFile('room.png', content, content_type='image/png')
+            return self.client.post(reverse('upload-image-async'), {'image': image})
+
+        first = upload()
+        second = upload()
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertFalse(first.json()['deduplicated'])
+        self.assertEqual((first.json()['width'], first.json()['height']), (4, 3))
+        self.assertTrue(second.json()['deduplicated'])
+        mock_put.assert_awaited_once()
+        self.assertEqual(mock_put.call_args.args[0], f'uploads/{sha256}.png')
+        self.assertTrue(UploadedImage.objects.filter(sha256=sha256).exists())
+
+    def test_upload_missing_file(self):
+        response = self.client.post(reverse('upload-image-async'), {})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncStorageTests(TestCase):
+    @patch.object(async_storage, 'S3_MULTIPART_PART_SIZE', 4)
+    @patch('api.async_storage.presign', side_effect=lambda operation, **params: operation)
+    @patch('api.async_storage.http_client')
+    def test_large_stream_switches_to_multipart(self, mock_http, mock_presign):
+        client = mock_http.return_value
+        client.post = AsyncMock(side_effect=[
+            Mock(content=b'<InitiateMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                         b'<UploadId>upload-1</UploadId></InitiateMultipartUploadResult>'),
+            Mock(content=b'<CompleteMultipartUploadResult/>'),
+        ])
+        client.put = AsyncMock(side_effect=lambda url, content: Mock(headers={'ETag': f'"{content.decode()}"'}))
+
+        async def chunks():
+            for chunk in (b'abc', b'defgh', b'ij'):
+                yield chunk
+
+        size = asyncio.run(async_storage.upload_stream(chunks(), 'roomdesign/a.png', 'image/png'))
+
+        self.assertEqual(size, 10)
+        bodies = [call.kwargs['content'] for call in client.put.call_args_list]
+        self.assertEqual(b''.join(bodies), b'abcdefghij')
+        completion = client.post.call_args_list[1].kwargs['content']
+        self.assertIn('<PartNumber>1</PartNumber>', completion)
+        client.delete.assert_not_called()
+
+
+class ClientPoolTests(TestCase):
+    def transport(self, name, responses):
+        sent = []
+
+        class Upstream(httpx.BaseTransport):
+            def handle_request(self, request):
+                # Only the first request opens a connection
+                if not sent:
+                    request.extensions['trace']('connection.connect_tcp.complete', {})
+                    request.extensions['trace']('connection.start_tls.complete', {})
+                sent.append(request)
+                return responses.pop(0)
+
+        return transports.TracedTransport(name, Upstream()), sent
+
+    def test_connection_reuse_is_counted(self):
+        transport, sent = self.transport('test-reuse', [httpx.Response(200) for _ in range(3)])
+        with httpx.Client(transport=transport) as client:
+            for _ in range(3):
+                client.get('https://api.example.com/')
+
+        stats = clients.connection_stats()['test-reuse']
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['tls_handshakes'], 1)
+        self.assertEqual(stats['reused'], 2)
+
+    @patch('api.transports.time.sleep')
+    def test_throttled_post_is_retried_after_retry_after(self, mock_sleep):
+        transport, sent = self.transport('test-throttle', [
+            httpx.Response(429, headers={'Retry-After': '2'}),
+            httpx.Response(201),
+        ])
+        with httpx.Client(transport=transport) as client:
+            response = client.post('https://api.example.com/predictions', json={})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(sent), 2)
+        mock_sleep.assert_called_once_with(2.0)
+
+    def test_s3_client_uses_pool_and_adaptive_retries(self):
+        config = clients.build_s3_client(region_name='us-east-1').meta.config
+        self.assertEqual(config.max_pool_connections, clients.CLIENT_POOL_SIZE)
+        self.assertEqual(config.retries['mode'], 'adaptive')
+        self.assertTrue(config.tcp_keepalive)
+
+    def test_stats_endpoint(self):
+        response = APIClient().get(reverse('client-stats'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('reused', response.data['s3'])
+
+
+class StartupTests(TestCase):
+    def test_ready_warms_up_clients(self):
+        response = APIClient().get(reverse('ready'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['warm_up']), {'database', 'replicate', 's3'})
+        self.assertIs(clients.replicate_client(), clients.replicate_client())
+
+    @patch('api.views.warm_up', side_effect=Exception('database unavailable'))
+    def test_ready_reports_failure(self, mock_warm_up):
+        response = APIClient().get(reverse('ready'))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(response.data['ready'])
+
+    def test_parse_importtime(self):
+        output = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       120 |        120 |   botocore.compat\n"
+            "import time:       450 |     126183 | boto3\n"
+        )
+        self.assertEqual(parse_importtime(output), [
+            ('botocore.compat', 120, 120, 1),
+            ('boto3', 450, 126183, 0),
+        ])
+
+
+class NormalizationTests(TestCase):
+    def photo(self, size=(3000, 2000), orientation=6):
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        exif[0x010F] = 'PhoneMaker'
+        buffer = BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, format='JPEG', exif=exif.tobytes())
+        return buffer.getvalue()
+
+    def test_photo_is_oriented_downscaled_and_stripped(self):
+        results = normalize.normalize_image(self.photo(), [1024, 512])
+
+        data, width, height = results[1024]
+        self.assertEqual((width, height), (683, 1024))
+        self.assertEqual(results[512][1:], (341, 512))
+        normalized = Image.open(BytesIO(data))
+        self.assertEqual(normalized.format, 'JPEG')
+        self.assertEqual(dict(normalized.getexif()), {})
+
+    def test_transparent_png_is_flattened(self):
+        buffer = BytesIO()
+        Image.new('RGBA', (100, 50), (0, 0, 0, 0)).save(buffer, format='PNG')
+
+        data, width, height = normalize.normalize_image(buffer.getvalue(), [512])[512]
+
+        self.assertEqual((width, height), (100, 50))
+        self.assertEqual(Image.open(BytesIO(data)).getpixel((0, 0)), (255, 255, 255))
+
+    @patch('api.normalize.s3_client')
+    def test_uploads_are_normalized_once(self, mock_s3):
+        mock_s3.get_object.return_value = {'Body': BytesIO(self.photo())}
+        upload = UploadedImage.objects.create(sha256='a' * 64, key=f"uploads/{'a' * 64}.jpg", size=100)
+
+        first = normalize.normalized_url(s3_url(upload.key), 512)
+        second = normalize.normalized_url(s3_url(upload.key), 512)
+
+        self.assertEqual(first, s3_url(f"uploads/normalized/{'a' * 64}-512.jpg"))
+        self.assertEqual(first, second)
+        mock_s3.get_object.assert_called_once()
+        self.assertEqual(NormalizedImage.objects.get(upload=upload).width, 341)
+
+    def test_other_images_are_used_as_they_are(self):
+        url = 'https://example.com/room.jpg'
+        self.assertEqual(normalize.normalized_url(url, 512), url)
+
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_generation_sends_the_normalized_image(self, mock_s3, mock_run, mock_digest):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+        upload = UploadedImage.objects.create(sha256='b' * 64, key=f"uploads/{'b' * 64}.jpg", size=100)
+        NormalizedImage.objects.create(
+            upload=upload, max_size=1024, key='uploads/normalized/b-1024.jpg', size=10, width=1024, height=683
+        )
+
+        generate(INTERIOR_DESIGN_MODEL, {'image': s3_url(upload.key), 'prompt': 'room'}, roomdesign_key)
+
+        self.assertEqual(mock_run.call_args.args[1]['image'], s3_url('uploads/normalized/b-1024.jpg'))
+
+    def test_new_uploads_are_scheduled_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            uploads.index('c' * 64, 'uploads/c.jpg', 100, 10, 10, 'image/jpeg')
+            uploads.index('c' * 64, 'uploads/c.jpg', 100, 10, 10, 'image/jpeg')
+        self.assertEqual(len(callbacks), 1)
+
+
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        variants._stored_variants.clear()
+
+    def png(self, size):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'blue').save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def spool(self, data):
+        spool = variants.Spool()
+        list(spool.tee([data]))
+        return spool
+
+    def test_variants_are_downscaled_and_never_upscaled(self):
+        spool = self.spool(self.png((1000, 600)))
+        spool.file.close()
+
+        rendered = variants.render_variants(spool.file.name, [320, 768, 2000], ['webp'], 80)
+
+        sizes = {width: Image.open(path).size for width, _, path in rendered}
+        self.assertEqual(sizes, {2000: (1000, 600), 768: (768, 461), 320: (320, 192)})
+        for _, _, path in rendered:
+            os.remove(path)
+        spool.discard()
+
+    def test_srcset_lists_stored_variants_only(self):
+        url = 'https://bucket/roomdesign/a.png'
+        self.assertEqual(variants.srcset(url), {})
+
+        variants._remember(url, 768, 'webp')
+        variants._remember(url, 320, 'webp')
+        variants._remember(url, 768, 'avif')
+
+        self.assertEqual(variants.srcset(url), {
+            'webp': 'https://bucket/roomdesign/a-320w.webp 320w, https://bucket/roomdesign/a-768w.webp 768w',
+            'avif': 'https://bucket/roomdesign/a-768w.avif 768w',
+        })
+
+    @patch('api.variants._get_process_pool', return_value=ThreadPoolExecutor(max_workers=1))
+    @patch('api.variants._formats', return_value=['webp'])
+    @patch('api.variants.s3_client')
+    def test_variants_are_stored_with_immutable_caching(self, mock_s3, mock_formats, mock_pool):
+        spool = self.spool(self.png((1000, 600)))
+        spool.file.close()
+
+        variants._store_variants('roomdesign/a.png', spool.file.name)
+
+        keys = [call.kwargs['Key'] for call in mock_s3.put_object.call_args_list]
+        self.assertEqual(sorted(keys), ['roomdesign/a-320w.webp', 'roomdesign/a-768w.webp'])
+        for call in mock_s3.put_object.call_args_list:
+            self.assertEqual(call.kwargs['ContentType'], 'image/webp')
+            self.assertEqual(call.kwargs['CacheControl'], variants.IMMUTABLE_CACHE_CONTROL)
+        self.assertFalse(os.path.exists(spool.file.name))
+        self.assertEqual(variants.srcset(s3_url('roomdesign/a.png')), {
+            'webp': f"{s3_url('roomdesign/a-320w.webp')} 320w, {s3_url('roomdesign/a-768w.webp')} 768w"
+        })
+
+    @patch.object(variants, 'IMAGE_VARIANT_PROCESSES', 0)
+    @patch('api.variants._formats', return_value=['webp'])
+    @patch('api.variants.s3_client')
+    def test_variants_that_fail_to_upload_are_not_listed(self, mock_s3, mock_formats):
+        # Widths are stored largest first; the second upload fails
+        mock_s3.put_object.side_effect = [{}, Exception('S3 is down')]
+        spool = self.spool(self.png((1000, 600)))
+        spool.file.close()
+
+        variants._store_variants('roomdesign/a.png', spool.file.name)
+
+        self.assertEqual(variants.srcset(s3_url('roomdesign/a.png')), {
+            'webp': f"{s3_url('roomdesign/a-768w.webp')} 768w"
+        })
+
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.run_prediction')
+    @patch('api.generation.variants.schedule')
+    @patch('api.storage.s3_client.put_object')
+    def test_outputs_are_immutable_and_variants_come_after_the_response(self, mock_s3, mock_schedule, mock_run, mock_digest):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+
+        response = APIClient().post(reverse('generate'), {
+            'image': 'https://example.com/image.jpg',
+            'theme': 'Modern',
+            'room_type': 'living_room',
+            'color': 'White',
+            'additional_notes': ''
+        }, format='json')
+
+        self.assertEqual(mock_s3.call_args.kwargs['CacheControl'], variants.IMMUTABLE_CACHE_CONTROL)
+        # Not stored yet, so not listed
+        self.assertEqual(response.data['srcset'], {})
+        key, spool = mock_schedule.call_args.args
+        self.assertTrue(response.data['url'].endswith(key))
+        spool.discard()
+
+    @patch.object(variants, '_queued', threading.BoundedSemaphore(1))
+    @patch('api.variants._upload_executor')
+    def test_outputs_past_the_queue_get_no_variants(self, mock_executor):
+        first = self.spool(self.png((100, 100)))
+        second = self.spool(self.png((100, 100)))
+
+        variants.schedule('roomdesign/a.png', first)
+        variants.schedule('roomdesign/b.png', second)
+
+        mock_executor.submit.assert_called_once_with(variants._queued_store_variants, 'roomdesign/a.png', first.file.name)
+        self.assertFalse(os.path.exists(second.file.name))
+        os.remove(first.file.name)
+
+    @patch.object(variants, 'IMAGE_VARIANT_PROCESSES', 0)
+    @patch('api.variants._get_process_pool')
+    @patch('api.variants._formats', return_value=['webp'])
+    @patch('api.variants.s3_client')
+    def test_variants_are_encoded_in_thread_without_processes(self, mock_s3, mock_formats, mock_pool):
+        spool = self.spool(self.png((1000, 600)))
+        spool.file.close()
+
+        variants._store_variants('roomdesign/a.png', spool.file.name)
+
+        mock_pool.assert_not_called()
+        self.assertEqual(mock_s3.put_object.call_count, 2)
+
+    def test_small_containers_default_to_no_processes(self):
+        with patch('api.variants._memory_limit', return_value=128 * 1024 * 1024):
+            self.assertEqual(variants._default_processes(), 0)
+        with patch('api.variants._memory_limit', return_value=None):
+            self.assertEqual(variants._default_processes(), 2)
+
+
+class _InlineExecutor:
+    """Runs submitted work right away, in the calling thread."""
+
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+@patch.object(edges, 'PRECOMPUTE_EDGE_MAPS', True)
+class EdgeMapTests(TestCase):
+    def setUp(self):
+        edges._stored_keys.clear()
+
+    def floor_plan(self):
+        # A white room outline on black
+        image = Image.new('L', (200, 200), 0)
+        image.paste(255, (50, 50, 150, 150))
+        buffer = BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def test_canny_finds_the_outline_only(self):
+        found = edges.canny_edges(edges.grayscale(self.floor_plan(), 200))
+
+        self.assertTrue(found[100, 48:53].any())
+        self.assertTrue(found[48:53, 100].any())
+        self.assertFalse(found[100, 60:140].any())
+        self.assertFalse(found[:40, :40].any())
+        # Thin: at most a couple of pixels across the edge
+        self.assertLessEqual(found[100, 40:60].sum(), 2)
+
+    def test_soft_edges_peak_at_the_outline(self):
+        soft = edges.soft_edges(edges.grayscale(self.floor_plan(), 200))
+
+        self.assertGreater(soft[100, 50], 0.9)
+        self.assertLess(soft[100, 100], 0.05)
+
+    @patch('api.edges.s3_client')
+    def test_edge_map_is_computed_once_per_floor_plan(self, mock_s3):
+        from botocore.exceptions import ClientError
+
+        mock_s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        mock_s3.get_object.return_value = {'Body': BytesIO(self.floor_plan())}
+
+        first = edges.store_edge_map('uploads/plan.png', 'sha256:plan', 512)
+        second = edges.store_edge_map('uploads/plan.png', 'sha256:plan', 512)
+
+        self.assertEqual(first, 'edge_maps/sha256-plan-hed-512.png')
+        self.assertEqual(first, second)
+        self.assertEqual(edges.edge_map(s3_url('uploads/plan.png'), 'sha256:plan', 512), first)
+        mock_s3.get_object.assert_called_once()
+        stored = Image.open(BytesIO(mock_s3.put_object.call_args.kwargs['Body']))
+        self.assertEqual(stored.size, (200, 200))
+        # Dark edges on white
+        self.assertEqual(stored.getpixel((100, 100)), 255)
+        self.assertLess(stored.getpixel((50, 100)), 128)
+
+    def test_images_outside_the_bucket_are_left_to_controlnet(self):
+        self.assertIsNone(edges.edge_map('https://example.com/plan.png', 'sha256:plan', 512))
+
+    @patch('api.edges.s3_client')
+    def test_missing_map_is_made_in_the_background(self, mock_s3):
+        from botocore.exceptions import ClientError
+
+        mock_s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        with patch.object(edges, '_executor') as executor:
+            self.assertIsNone(edges.edge_map(s3_url('uploads/plan.png'), 'sha256:plan', 512))
+        executor.submit.assert_called_once_with(edges._store_in_worker, 'uploads/plan.png', 'sha256:plan', 512)
+        mock_s3.get_object.assert_not_called()
+
+    @patch('api.edges.s3_client')
+    def test_uploads_have_their_map_made_after_commit(self, mock_s3):
+        from botocore.exceptions import ClientError
+
+        mock_s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        mock_s3.get_object.return_value = {'Body': BytesIO(self.floor_plan())}
+        with patch.object(edges, '_executor', _InlineExecutor()), patch('api.normalize.schedule'):
+            with self.captureOnCommitCallbacks(execute=True):
+                uploads.index('d' * 64, 'uploads/d.png', 100, 200, 200, 'image/png')
+
+        self.assertEqual(
+            mock_s3.put_object.call_args.kwargs['Key'], f"edge_maps/sha256-{'d' * 64}-hed-512.png"
+        )
+
+    def test_remembered_keys_are_bounded(self):
+        with patch.object(edges, 'EDGE_MAP_KEYS_REMEMBERED', 2):
+            for digest in ('sha256:a', 'sha256:b', 'sha256:c'):
+                edges._remember(edges.edge_map_key(digest, 512))
+        self.assertIsNone(edges.stored_key('sha256:a', 512))
+        self.assertIsNotNone(edges.stored_key('sha256:c', 512))
+
+    @override_settings(GENERATION_JOBS_EAGER=True)
+    @patch('api.generation.image_digest', return_value='sha256:plan')
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    @patch('api.edges.s3_client')
+    @patch.object(edges, '_executor', _InlineExecutor())
+    def test_layouts_reuse_the_stored_edge_map(self, mock_edges_s3, mock_put, mock_run, mock_digest):
+        from botocore.exceptions import ClientError
+
+        mock_edges_s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        mock_edges_s3.get_object.return_value = {'Body': BytesIO(self.floor_plan())}
+        mock_run.return_value = [Mock(read=lambda: b'image_data')]
+        image = s3_url('uploads/plan.png')
+
+        for prompt in ['Modern living room', 'Rustic living room']:
+            response = APIClient().post(
+                reverse('generate-3d-layout') + '?async=true',
+                {'image': image, 'prompt': prompt},
+                format='json'
+            )
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        mock_edges_s3.get_object.assert_called_once()
+        model, input_data = mock_run.call_args.args
+        self.assertEqual(model, CONTROLNET_MODEL)
+        self.assertEqual(input_data['image'], s3_url('edge_maps/sha256-plan-hed-512.png'))
+        self.assertEqual(input_data['structure'], 'scribble')
+        self.assertEqual(
+            set(InteriorDesign.objects.values_list('edge_map', flat=True)),
+            {'edge_maps/sha256-plan-hed-512.png'}
+        )
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.data = {
+            'image': 'https://example.com/image.jpg',
+            'theme': 'Modern',
+            'room_type': 'living_room',
+            'color': 'White',
+            'additional_notes': 'Some notes'
+        }
+
+    def stage_count(self, stage, endpoint='generate', model=INTERIOR_DESIGN_MODEL):
+        return REGISTRY.get_sample_value(
+            'generation_stage_duration_seconds_count',
+            {'endpoint': endpoint, 'model': model, 'stage': stage}
+        ) or 0
+
+    def request_count(self, status_code, endpoint='generate', model=INTERIOR_DESIGN_MODEL):
+        return REGISTRY.get_sample_value(
+            'api_requests_total', {'endpoint': endpoint, 'model': model, 'status': str(status_code)}
+        ) or 0
+
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_stages_are_timed_and_the_request_recorded(self, mock_s3, mock_run, mock_digest):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+        stages = ['validation', 'cache_lookup', 'normalize', 'output_download', 'upload']
+        before = {stage: self.stage_count(stage) for stage in stages}
+        requests_before = self.request_count(200)
+
+        response = APIClient().post(reverse('generate'), self.data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for stage in stages:
+            self.assertEqual(self.stage_count(stage), before[stage] + 1, stage)
+        self.assertEqual(self.request_count(200), requests_before + 1)
+        design = InteriorDesign.objects.get()
+        self.assertEqual(design.status, 'completed')
+        self.assertEqual(design.output_urls, [response.data['url']])
+        self.assertIsNotNone(design.processing_time)
+
+    @patch('api.generation.image_digest', return_value=None)
+    @patch('api.generation.run_prediction', side_effect=Exception('API Error'))
+    def test_failed_requests_are_recorded(self, mock_run, mock_digest):
+        response = APIClient().post(reverse('generate'), self.data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        design = InteriorDesign.objects.get()
+        self.assertEqual((design.status, design.error), ('failed', 'API Error'))
+        self.assertIsNotNone(design.processing_time)
+
+    @patch('api.generation.replicate_client')
+    def test_prediction_time_is_split_into_queue_and_inference(self, mock_client):
+        mock_client.return_value.predictions.create.return_value = Mock(
+            status='succeeded',
+            created_at='2025-01-01T00:00:00.000Z',
+            started_at='2025-01-01T00:00:04.000Z',
+            completed_at='2025-01-01T00:00:10.000Z',
+            metrics={'predict_time': 5.5},
+            output=['https://replicate.delivery/out.png']
+        )
+        queue_before = REGISTRY.get_sample_value(
+            'generation_stage_duration_seconds_sum',
+            {'endpoint': 'generate', 'model': INTERIOR_DESIGN_MODEL, 'stage': 'replicate_queue'}
+        ) or 0
+
+        with metrics.labels('generate', INTERIOR_DESIGN_MODEL):
+            outputs = run_prediction(INTERIOR_DESIGN_MODEL, {'image': 'x'})
+
+        self.assertEqual([output.url for output in outputs], ['https://replicate.delivery/out.png'])
+        self.assertEqual(
+            mock_client.return_value.predictions.create.call_args.kwargs['version'],
+            INTERIOR_DESIGN_MODEL.split(':')[1]
+        )
+        self.assertAlmostEqual(REGISTRY.get_sample_value(
+            'generation_stage_duration_seconds_sum',
+            {'endpoint': 'generate', 'model': INTERIOR_DESIGN_MODEL, 'stage': 'replicate_queue'}
+        ) - queue_before, 4.0)
+
+    def test_metrics_endpoint(self):
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'generation_stage_duration_seconds', response.content)
+        self.assertIn(b'api_requests_total', response.content)
+
+
+class BenchmarkTests(TestCase):
+    def s3(self, fake):
+        import boto3
+        from botocore.config import Config
+
+        return boto3.client(
+            's3', endpoint_url=fake.url, region_name='us-east-1',
+            aws_access_key_id='benchmark', aws_secret_access_key='benchmark',
+            config=Config(retries={'max_attempts': 1})
+        )
+
+    def test_percentiles_and_summary(self):
+        latencies = [i / 1000 for i in range(1, 101)]
+
+        self.assertEqual(benchmark.percentile(latencies, 0.5), 0.05)
+        self.assertEqual(benchmark.percentile(latencies, 0.99), 0.099)
+        self.assertIsNone(benchmark.percentile([], 0.5))
+        summary = benchmark.summarize(latencies, errors=2, elapsed=10)
+        self.assertEqual(
+            (summary['requests'], summary['errors'], summary['rps'], summary['p95_ms']),
+            (102, 2, 10.0, 95.0)
+        )
+
+    def test_run_load_counts_failures(self):
+        summary = benchmark.run_load(lambda index: index % 4 != 0, concurrency=4, requests=20)
+        self.assertEqual((summary['requests'], summary['errors']), (20, 5))
+
+    def test_fake_s3_serves_the_calls_the_app_makes(self):
+        with benchmark.FakeS3() as fake:
+            s3 = self.s3(fake)
+            s3.put_object(Bucket='bench', Key='a.png', Body=b'data', ContentType='image/png')
+            upload = s3.create_multipart_upload(Bucket='bench', Key='b.png')
+            parts = [
+                {'PartNumber': number, 'ETag': s3.upload_part(
+                    Bucket='bench', Key='b.png', UploadId=upload['UploadId'], PartNumber=number, Body=body
+                )['ETag']}
+                for number, body in [(1, b'ab'), (2, b'cd')]
+            ]
+            s3.complete_multipart_upload(
+                Bucket='bench', Key='b.png', UploadId=upload['UploadId'], MultipartUpload={'Parts': parts}
+            )
+            s3.copy_object(Bucket='bench', Key='c.png', CopySource={'Bucket': 'bench', 'Key': 'b.png'})
+            s3.delete_object(Bucket='bench', Key='b.png')
+
+            self.assertEqual(s3.get_object(Bucket='bench', Key='a.png')['Body'].read(), b'data')
+            self.assertEqual(s3.get_object(Bucket='bench', Key='c.png')['Body'].read(), b'abcd')
+            self.assertEqual(s3.head_object(Bucket='bench', Key='a.png')['ContentType'], 'image/png')
+            self.assertNotIn('b.png', fake.objects)
+
+    def test_fake_s3_errors(self):
+        from botocore.exceptions import ClientError
+
+        with benchmark.FakeS3(benchmark.Faults(error_rate=1.0)) as fake:
+            with self.assertRaises(ClientError):
+                self.s3(fake).put_object(Bucket='bench', Key='a.png', Body=b'data')
+
+    def test_fake_replicate_runs_predictions(self):
+        import replicate
+
+        with benchmark.FakeReplicate(benchmark.Faults(latency=0.05), output=b'png') as fake:
+            client = replicate.Client(api_token='benchmark', base_url=fake.url)
+            with patch('api.generation.replicate_client', return_value=client):
+                outputs = list(run_prediction(CONTROLNET_MODEL, {'image': 'x', 'num_outputs': 2}))
+                self.assertEqual(len(outputs), 2)
+                self.assertEqual(b''.join(output_chunks(outputs[0])), b'png')
+
+    def test_compare(self):
+        previous = {'runs': [{'scenario': 'generate', 'concurrency': 4, 'p50_ms': 100.0, 'rps': 10.0}]}
+        current = {'runs': [
+            {'scenario': 'generate', 'concurrency': 4, 'p50_ms': 80.0, 'rps': 12.0},
+            {'scenario': 'generate', 'concurrency': 16, 'p50_ms': 90.0, 'rps': 30.0},
+        ]}
+
+        self.assertEqual(benchmark.compare(current, previous), [
+            ('generate', 4, 'p50_ms', 100.0, 80.0, -20.0),
+            ('generate', 4, 'rps', 10.0, 12.0, 20.0),
+        ])
+
+
+class DesignListTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        for index in range(5):
+            floor_plan = FloorPlan.objects.create(room_type='bedroom' if index % 2 else 'kitchen')
+            InteriorDesign.objects.create(
+                floor_plan=floor_plan,
+                preferences=DesignPreference.objects.create(floor_plan=floor_plan, theme=f'Theme {index}'),
+                prompt_used='x' * 1000,
+                status='completed' if index < 3 else 'failed'
+            )
+
+    def test_list_takes_one_query_however_many_designs(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('interiordesign-list'))
+
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(response.data['results'][0]['preferences']['theme'], 'Theme 4')
+        self.assertEqual(response.data['results'][0]['floor_plan']['room_type'], 'kitchen')
+
+    def test_cursor_pagination_newest_first(self):
+        url = reverse('interiordesign-list') + '?page_size=2'
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertLessEqual(len(response.data['results']), 2)
+            ids += [design['id'] for design in response.data['results']]
+            url = response.data['next']
+
+        self.assertEqual(ids, list(InteriorDesign.objects.order_by('-created_at', '-id').values_list('id', flat=True)))
+        self.assertNotIn('count', response.data)
+
+    def test_filters(self):
+        response = self.client.get(reverse('interiordesign-list') + '?status=failed&room_type=bedroom')
+
+        self.assertEqual([design['status'] for design in response.data['results']], ['failed'])
+        self.assertEqual(response.data['results'][0]['floor_plan']['room_type'], 'bedroom')
+
+        response = self.client.get(reverse('interiordesign-list') + '?status=done')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('status', response.data)
+
+    def test_sparse_fieldsets(self):
+        response = self.client.get(reverse('interiordesign-list'))
+        self.assertNotIn('prompt_used', response.data['results'][0])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('interiordesign-list') + '?fields=id,status,prompt_used')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'status', 'prompt_used'})
+
+        design = InteriorDesign.objects.first()
+        response = self.client.get(reverse('interiordesign-detail', args=[design.pk]))
+        self.assertEqual(response.data['prompt_used'], 'x' * 1000)
+
+        response = self.client.get(reverse('interiordesign-list') + '?fields=id,secret')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class StyleCatalogTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        DesignStyle.objects.create(name='Modern', description='Clean lines')
+        DesignStyle.objects.create(name='Rustic', description='Wood and stone')
+        style_catalog.invalidate()
+        self.addCleanup(style_catalog.invalidate)
+
+    def test_list_is_cached_in_process(self):
+        response = self.client.get(reverse('designstyle-list'))
+        self.assertEqual([style['name'] for style in response.data], ['Modern', 'Rustic'])
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse('designstyle-list'))
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertTrue(cached['ETag'].startswith('"'))
+        self.assertIn('Last-Modified', cached)
+
+    def test_conditional_requests(self):
+        response = self.client.get(reverse('designstyle-list'))
+
+        revalidated = self.client.get(reverse('designstyle-list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+
+        revalidated = self.client.get(
+            reverse('designstyle-list'), HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+        )
+        self.assertEqual(revalidated.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        stale = self.client.get(reverse('designstyle-list'), HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(stale.status_code, status.HTTP_200_OK)
+
+    def test_saving_or_deleting_a_style_invalidates(self):
+        etag = self.client.get(reverse('designstyle-list'))['ETag']
+
+        style = DesignStyle.objects.create(name='Coastal', description='Light and airy')
+        response = self.client.get(reverse('designstyle-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
+        self.assertNotEqual(response['ETag'], etag)
+
+        style.delete()
+        response = self.client.get(reverse('designstyle-list'))
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_admin_refresh(self):
+        from django.contrib.auth.models import User
+
+        self.client.get(reverse('designstyle-list'))
+        # A change the signals don't see
+        DesignStyle.objects.filter(name='Rustic').update(description='Reclaimed wood')
+        with self.assertNumQueries(0):
+            self.client.get(reverse('designstyle-list'))
+
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        response = self.client.post(reverse('admin:api_designstyle_changelist'), {
+            'action': 'refresh_style_catalog',
+            '_selected_action': list(DesignStyle.objects.values_list('pk', flat=True)),
+        })
+        self.assertEqual(response.status_code, 302)
+
+        response = self.client.get(reverse('designstyle-list'))
+        self.assertEqual(response.data[1]['description'], 'Reclaimed wood')
+
+
+class AdmissionTests(TestCase):
+    def hold_slot(self, limiter):
+        """Acquire a slot on another thread; returns an Event that releases it."""
+        acquired, release = threading.Event(), threading.Event()
+
+        def hold():
+            with limiter.slot():
+                acquired.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        self.assertTrue(acquired.wait(5))
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(release.set)
+        return release
+
+    def test_full_queue_is_turned_away(self):
+        limiter = admission.Limiter(1, 1, timeout=5)
+        release = self.hold_slot(limiter)
+
+        queued = ThreadPoolExecutor(max_workers=1).submit(limiter.acquire)
+        while limiter.stats()['queued'] < 1:
+            threading.Event().wait(0.01)
+        with self.assertRaises(admission.Overloaded) as raised:
+            limiter.acquire()
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.assertEqual(raised.exception.queued, 1)
+
+        # The freed slot goes to the request that was waiting
+        release.set()
+        queued.result(timeout=5)
+        self.assertEqual(limiter.stats()['active'], 1)
+        limiter.release(admission.ANONYMOUS)
+        self.assertEqual((limiter.stats()['active'], limiter.stats()['queued']), (0, 0))
+
+    def test_wait_times_out(self):
+        limiter = admission.Limiter(1, 4, timeout=0.05)
+        self.hold_slot(limiter)
+
+        with self.assertRaises(admission.Overloaded):
+            limiter.acquire()
+        self.assertEqual(limiter.stats()['queued'], 0)
+
+    def test_background_jobs_wait_beyond_the_queue(self):
+        limiter = admission.Limiter(1, 0, timeout=0.05)
+        release = self.hold_slot(limiter)
+
+        def background_acquire():
+            with admission.background():
+                limiter.acquire()
+
+        waiting = ThreadPoolExecutor(max_workers=1).submit(background_acquire)
+        with self.assertRaises(admission.Overloaded):
+            limiter.acquire()
+        release.set()
+        waiting.result(timeout=5)
+        limiter.release(admission.ANONYMOUS)
+
+    def test_async_waiter_gets_a_released_slot(self):
+        limiter = admission.Limiter(1, 1, timeout=5)
+        release = self.hold_slot(limiter)
+
+        async def acquire():
+            async with limiter.aslot():
+                return limiter.stats()['active']
+
+        threading.Timer(0.05, release.set).start()
+        self.assertEqual(asyncio.run(acquire()), 1)
+        self.assertEqual(limiter.stats()['active'], 0)
+
+    @patch('api.generation.image_digest', return_value=None)
+    @patch('api.generation.run_prediction')
+    def test_generate_answers_429_with_retry_after(self, mock_run, mock_digest):
+        with patch.object(admission, 'limiter', admission.Limiter(0, 0, timeout=0)):
+            response = APIClient().post(reverse('generate'), {
+                'image': 'https://example.com/image.jpg', 'theme': 'Modern', 'room_type': 'living_room',
+                'color': 'White', 'additional_notes': ''
+            }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], str(response.data['retry_after']))
+        # Shed before the prediction, and not recorded
+        mock_run.assert_not_called()
+        self.assertFalse(InteriorDesign.objects.exists())
+
+    @patch('api.generation.image_digest', return_value='sha256:abc')
+    @patch('api.generation.prediction_cache.lookup', return_value=['https://bucket/roomdesign/a.png'])
+    @patch('api.generation.run_prediction')
+    def test_cache_hits_are_not_admitted(self, mock_run, mock_lookup, mock_digest):
+        limiter = admission.Limiter(1, 1, timeout=0, buckets=admission.TokenBuckets(1, 1))
+        data = {
+            'image': 'https://example.com/image.jpg', 'theme': 'Modern', 'room_type': 'living_room',
+            'color': 'White', 'additional_notes': ''
+        }
+
+        with patch.object(admission, 'limiter', limiter):
+            responses = [APIClient().post(reverse('generate'), data, format='json') for _ in range(3)]
+
+        # Over the rate of 1, but no prediction had to run
+        self.assertEqual([response.status_code for response in responses], [status.HTTP_200_OK] * 3)
+        self.assertEqual(responses[0].data['cache'], 'hit')
+        self.assertEqual(limiter.buckets.take('ip:127.0.0.1'), 0)
+        mock_run.assert_not_called()
+
+
+class FairSchedulingTests(TestCase):
+    def acquire_as(self, limiter, client, order=None, hold=None):
+        """Run a slot for client on another thread; returns its future."""
+        def run():
+            with admission.client(client), limiter.slot():
+                if order is not None:
+                    order.append(client.key)
+                if hold is not None:
+                    hold.wait(5)
+
+        return ThreadPoolExecutor(max_workers=1).submit(run)
+
+    def wait_until(self, condition):
+        for _ in range(500):
+            if condition():
+                return
+            threading.Event().wait(0.01)
+        self.fail('Condition not reached')
+
+    def test_light_client_goes_before_a_heavy_clients_backlog(self):
+        heavy, light = admission.Client('heavy', 1.0), admission.Client('light', 1.0)
+        limiter = admission.Limiter(1, 10, timeout=5, client_limit=1, client_queue_size=5)
+        release, order = threading.Event(), []
+
+        running = self.acquire_as(limiter, heavy, hold=release)
+        self.wait_until(lambda: limiter.stats()['active'] == 1)
+        backlog = [self.acquire_as(limiter, heavy, order) for _ in range(3)]
+        self.wait_until(lambda: limiter.stats()['queued'] == 3)
+        late = self.acquire_as(limiter, light, order)
+        self.wait_until(lambda: limiter.stats()['queued'] == 4)
+
+        threading.Event().wait(0.05)
+        release.set()
+        for future in [running, late] + backlog:
+            future.result(timeout=5)
+
+        # The light client arrived last but had used no slot time yet
+        self.assertEqual(order[0], 'light')
+        self.assertEqual(order[1:], ['heavy'] * 3)
+        self.assertEqual(limiter.stats()['clients'], 0)
+
+    def test_per_client_cap(self):
+        heavy, light = admission.Client('heavy', 1.0), admission.Client('light', 1.0)
+        limiter = admission.Limiter(4, 10, timeout=0.05, client_limit=1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        self.acquire_as(limiter, heavy, hold=release)
+        self.wait_until(lambda: limiter.stats()['active'] == 1)
+
+        # Slots are free, but not for a client already at its cap
+        with admission.client(heavy), self.assertRaises(admission.Overloaded):
+            limiter.acquire()
+        with admission.client(light), limiter.slot():
+            self.assertEqual(limiter.stats()['active'], 2)
+
+    def test_token_buckets(self):
+        for buckets in (admission.TokenBuckets(60, 2), admission.SharedTokenBuckets(60, 2)):
+            self.assertEqual(buckets.take('ip:10.0.0.1'), 0)
+            self.assertEqual(buckets.take('ip:10.0.0.1'), 0)
+            self.assertAlmostEqual(buckets.take('ip:10.0.0.1'), 1, delta=0.1)
+            # Other clients have their own bucket
+            self.assertEqual(buckets.take('ip:10.0.0.2'), 0)
+        self.assertEqual(ClientRateBucket.objects.count(), 2)
+
+    def test_identify(self):
+        from django.test import RequestFactory
+
+        factory = RequestFactory()
+        with patch.dict(admission.PREDICTION_CLIENT_WEIGHTS, {'partner': 4.0}):
+            client = admission.identify(factory.post('/api/generate/', HTTP_X_API_KEY='partner'))
+            self.assertTrue(client.key.startswith('key:'))
+            self.assertNotIn('partner', client.key)
+            self.assertEqual(client.weight, 4.0)
+
+            # Unknown keys and made-up sessions don't make a new identity
+            request = factory.post('/api/generate/', HTTP_X_API_KEY='made-up', REMOTE_ADDR='10.0.0.5')
+            request.COOKIES['sessionid'] = 'made-up'
+            from django.contrib.sessions.backends.db import SessionStore
+            request.session = SessionStore('made-up')
+            self.assertEqual(admission.identify(request), admission.Client('ip:10.0.0.5', 1.0))
+
+        request = factory.post('/api/generate/', HTTP_X_FORWARDED_FOR='1.2.3.4', REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(admission.identify(request).key, 'ip:10.0.0.5')
+        with patch.object(admission, 'TRUST_X_FORWARDED_FOR', True):
+            self.assertEqual(admission.identify(request).key, 'ip:1.2.3.4')
+
+    @patch('api.generation.image_digest', return_value=None)
+    @patch('api.generation.run_prediction')
+    @patch('api.storage.s3_client.put_object')
+    def test_rate_limit_per_client_ip(self, mock_s3, mock_run, mock_digest):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+        data = {
+            'image': 'https://example.com/image.jpg', 'theme': 'Modern', 'room_type': 'living_room',
+            'color': 'White', 'additional_notes': ''
+        }
+        limiter = admission.Limiter(4, 4, timeout=5, buckets=admission.TokenBuckets(1, 1))
+
+        with patch.object(admission, 'limiter', limiter):
+            first = APIClient(REMOTE_ADDR='10.0.0.1').post(reverse('generate'), data, format='json')
+            second = APIClient(REMOTE_ADDR='10.0.0.1').post(reverse('generate'), data, format='json')
+            other = APIClient(REMOTE_ADDR='10.0.0.2').post(reverse('generate'), data, format='json')
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(second.data['reason'], 'rate_limited')
+        self.assertIn(int(second['Retry-After']), range(50, 61))
+        self.assertEqual(other.status_code, status.HTTP_200_OK)
+
+
+@override_settings(GENERATION_JOBS_EAGER=True)
+class WebhookTests(LiveServerTestCase):
+    """Jobs in webhook mode, completed by a fake Replicate calling this live server back."""
+
+    def setUp(self):
+        self.replicate = self.enterContext(benchmark.FakeReplicate(output=benchmark.sample_png(64, 64)))
+        self.enterContext(patch.object(clients, 'REPLICATE_API_BASE_URL', self.replicate.url))
+        self.enterContext(patch.object(clients, '_replicate_client', None))
+        self.enterContext(patch.dict(os.environ, {'REPLICATE_API_TOKEN': 'test'}))
+        self.enterContext(patch.object(webhooks, 'REPLICATE_WEBHOOK_BASE_URL', self.live_server_url))
+        # Fetched from the fake, like from Replicate
+        self.enterContext(patch.object(webhooks, '_secret', None))
+        self.enterContext(patch.object(webhooks, 'REPLICATE_WEBHOOK_SECRET', None))
+        self.enterContext(patch('api.generation.image_digest', return_value='sha256:webhook'))
+        self.put_object = self.enterContext(patch('api.storage.s3_client.put_object'))
+        self.enterContext(patch.object(variants, 'IMAGE_VARIANTS', False))
+        self.enterContext(patch.object(admission, 'limiter', admission.Limiter(4, 4, timeout=5)))
+        self.enterContext(patch.dict(webhooks._slots, clear=True))
+
+    def submit(self):
+        response = APIClient().post(reverse('room-design') + '?async=true', {
+            'image': 'https://example.com/room.jpg', 'theme': 'Modern', 'room_type': 'bedroom',
+            'color': 'White', 'accessories': 'plants', 'furniture': 'bed', 'walls': 'white',
+            'lights': 'warm', 'realistic': 'realistic'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        # Only the prediction was created; nothing waits on it
+        self.assertEqual(InteriorDesign.objects.get(pk=response.data['job_id']).status, 'processing')
+
+        for _ in range(500):
+            if self.replicate.webhook_deliveries:
+                break
+            threading.Event().wait(0.01)
+        return InteriorDesign.objects.get(pk=response.data['job_id'])
+
+    def test_webhook_completes_the_job(self):
+        design = self.submit()
+
+        self.assertEqual(self.replicate.webhook_deliveries[0][1], 200)
+        self.assertEqual(design.status, 'completed')
+        self.assertEqual(len(design.output_urls), 1)
+        self.assertTrue(design.output_urls[0].endswith('.png'))
+        self.assertEqual(design.generated_image.name, design.output_urls[0])
+        self.put_object.assert_called_once()
+        self.assertFalse(PendingPrediction.objects.exists())
+        self.assertEqual(PredictionCacheEntry.objects.get().output_urls, design.output_urls)
+
+    def test_failed_prediction_fails_the_job(self):
+        self.replicate.faults = benchmark.Faults(error_rate=1.0)
+        design = self.submit()
+
+        self.assertEqual(design.status, 'failed')
+        self.assertIn('Fake prediction failed', design.error)
+        self.put_object.assert_not_called()
+
+    def test_unsigned_deliveries_are_rejected(self):
+        design = InteriorDesign.objects.create(floor_plan=FloorPlan.objects.create(room_type='bedroom'))
+        PendingPrediction.objects.create(token='t' * 32, design=design, model=INTERIOR_DESIGN_MODEL)
+        body = json.dumps({'id': 'p1', 'status': 'succeeded', 'output': ['https://example.com/x.png']}).encode()
+        timestamp = str(int(time.time()))
+        # Signed, but for a different body
+        signed = self.replicate.sign('msg_1', timestamp, b'{}')
+
+        for headers in ({}, {'webhook-id': 'msg_1', 'webhook-timestamp': timestamp, 'webhook-signature': signed}):
+            response = Client().post(
+                reverse('replicate-webhook') + '?token=' + 't' * 32, body,
+                content_type='application/json', headers=headers
+            )
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertTrue(PendingPrediction.objects.exists())
+
+
+class _PolledPrediction:
+    """A prediction that reports step progress in its logs over a few polls."""
+
+    def __init__(self, output):
+        self.id = 'p1'
+        self.status = 'starting'
+        self.logs = ''
+        self.output = None
+        self.created_at = self.started_at = self.completed_at = None
+        self.metrics = {}
+        self._polls = iter([
+            ('processing', ' 10%|#         | 5/50'),
+            ('processing', ' 50%|#####     | 25/50'),
+            ('succeeded', '100%|##########| 50/50'),
+        ])
+        self._output = output
+
+    @property
+    def progress(self):
+        from replicate.prediction import Prediction
+        return Prediction.Progress.parse(self.logs)
+
+    def reload(self):
+        self.status, self.logs = next(self._polls)
+        if self.status == 'succeeded':
+            self.output = self._output
+
+
+class WebhookReaperTests(TestCase):
+    def setUp(self):
+        self.client_mock = self.enterContext(patch('api.webhooks.replicate_client')).return_value
+        self.design = InteriorDesign.objects.create(
+            floor_plan=FloorPlan.objects.create(room_type='bedroom'), status='processing'
+        )
+
+    def pending(self, prediction_id='p1', age=3600):
+        pending = PendingPrediction.objects.create(
+            token='t' * 32, design=self.design, model=INTERIOR_DESIGN_MODEL, prediction_id=prediction_id
+        )
+        PendingPrediction.objects.filter(pk=pending.pk).update(created_at=timezone.now() - timedelta(seconds=age))
+        return pending
+
+    def prediction(self, status, error=None):
+        return Mock(
+            id='p1', status=status, output=None, error=error, logs='', metrics=None,
+            created_at=None, started_at=None, completed_at=None
+        )
+
+    def test_job_is_finished_from_its_prediction(self):
+        self.pending()
+        self.client_mock.predictions.get.return_value = self.prediction('failed', 'CUDA out of memory')
+
+        self.assertEqual(webhooks.reap(), 1)
+
+        self.client_mock.predictions.get.assert_called_once_with('p1')
+        self.design.refresh_from_db()
+        self.assertEqual((self.design.status, self.design.error), ('failed', 'CUDA out of memory'))
+        self.assertFalse(PendingPrediction.objects.exists())
+
+    def test_running_and_recent_predictions_are_left_alone(self):
+        self.pending()
+        self.client_mock.predictions.get.return_value = self.prediction('processing')
+        self.assertEqual(webhooks.reap(), 0)
+
+        PendingPrediction.objects.all().delete()
+        self.pending(age=10)
+        self.assertEqual(webhooks.reap(), 0)
+
+        self.assertEqual(self.client_mock.predictions.get.call_count, 1)
+        self.assertEqual(PendingPrediction.objects.count(), 1)
+
+    def test_missing_predictions_fail_their_job(self):
+        from replicate.exceptions import ReplicateError
+
+        self.pending()
+        self.client_mock.predictions.get.side_effect = ReplicateError(status=404, detail='Not found')
+
+        self.assertEqual(webhooks.reap(), 1)
+        self.design.refresh_from_db()
+        self.assertEqual((self.design.status, self.design.error), ('failed', 'Prediction not found'))
+
+        # Never created at all
+        design = self.design
+        self.design = InteriorDesign.objects.create(floor_plan=design.floor_plan, status='processing')
+        self.pending(prediction_id='')
+        self.assertEqual(webhooks.reap(), 1)
+        self.design.refresh_from_db()
+        self.assertEqual(self.design.error, 'Prediction was never created')
+
+
+class WebhookCoalescingTests(TestCase):
+    """Identical jobs in webhook mode, sharing one prediction."""
+
+    def setUp(self):
+        self.client_mock = self.enterContext(patch('api.webhooks.replicate_client')).return_value
+        self.client_mock.predictions.create.return_value = Mock(id='p1')
+        self.enterContext(patch.object(webhooks, 'REPLICATE_WEBHOOK_BASE_URL', 'https://api.example.com'))
+        self.enterContext(patch('api.webhooks.normalized_input', side_effect=lambda model, data, digest: data))
+        self.enterContext(patch('api.webhooks._start_reaper'))
+        self.limiter = self.enterContext(patch.object(admission, 'limiter', admission.Limiter(4, 4, timeout=5)))
+        self.enterContext(patch.dict(webhooks._slots, clear=True))
+        self.upload_outputs = self.enterContext(
+            patch('api.webhooks.upload_outputs', return_value=(['https://bucket/roomdesign/a.png'], 0))
+        )
+        self.data = {'image': 'https://example.com/room.jpg', 'prompt': 'Modern bedroom'}
+
+    def design(self):
+        return InteriorDesign.objects.create(
+            floor_plan=FloorPlan.objects.create(room_type='bedroom'), status='processing'
+        )
+
+    def token(self, design):
+        return PendingPrediction.objects.get(design=design).token
+
+    def test_identical_jobs_share_one_prediction(self):
+        first, second = self.design(), self.design()
+
+        self.assertEqual(webhooks.create_prediction(first.pk, INTERIOR_DESIGN_MODEL, self.data), 'p1')
+        self.assertEqual(webhooks.create_prediction(second.pk, INTERIOR_DESIGN_MODEL, dict(self.data)), 'p1')
+        self.client_mock.predictions.create.assert_called_once()
+
+        self.assertTrue(webhooks.handle_webhook(self.token(first), {
+            'id': 'p1', 'status': 'succeeded', 'output': ['https://replicate.delivery/a.png']
+        }))
+        self.upload_outputs.assert_called_once()
+        for design in (first, second):
+            design.refresh_from_db()
+            self.assertEqual((design.status, design.output_urls), ('completed', ['https://bucket/roomdesign/a.png']))
+        self.assertFalse(PendingPrediction.objects.exists())
+
+    def test_prediction_runs_on_for_jobs_still_waiting(self):
+        first, second = self.design(), self.design()
+        webhooks.create_prediction(first.pk, INTERIOR_DESIGN_MODEL, self.data)
+        webhooks.create_prediction(second.pk, INTERIOR_DESIGN_MODEL, self.data)
+        token = self.token(first)
+        InteriorDesign.objects.filter(pk=first.pk).update(deadline=timezone.now() - timedelta(seconds=1))
+
+        self.assertTrue(webhooks.handle_webhook(token, {'id': 'p1', 'status': 'processing', 'logs': ''}))
+        self.client_mock.predictions.cancel.assert_not_called()
+        first.refresh_from_db()
+        self.assertEqual((first.status, first.error), ('failed', 'Deadline exceeded'))
+
+        # Delivered to the first job's webhook, which is gone
+        self.assertTrue(webhooks.handle_webhook(token, {
+            'id': 'p1', 'status': 'succeeded', 'output': ['https://replicate.delivery/a.png']
+        }))
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'completed')
+
+    def test_predictions_hold_a_slot_until_their_jobs_finish(self):
+        self.client_mock.predictions.create.side_effect = [Mock(id='p1'), Mock(id='p2')]
+        limiter = admission.Limiter(1, 0, timeout=5)
+        first, second, joining = self.design(), self.design(), self.design()
+        other = dict(self.data, prompt='Rustic kitchen')
+
+        with patch.object(admission, 'limiter', limiter):
+            webhooks.create_prediction(first.pk, INTERIOR_DESIGN_MODEL, self.data)
+            with self.assertRaises(admission.Overloaded):
+                webhooks.create_prediction(second.pk, INTERIOR_DESIGN_MODEL, other)
+            # Joining a running prediction needs no slot of its own
+            self.assertEqual(webhooks.create_prediction(joining.pk, INTERIOR_DESIGN_MODEL, self.data), 'p1')
+            self.assertEqual(limiter.active, 1)
+
+            webhooks.handle_webhook(self.token(first), {
+                'id': 'p1', 'status': 'succeeded', 'output': ['https://replicate.delivery/a.png']
+            })
+            self.assertEqual(limiter.active, 0)
+            self.assertEqual(webhooks.create_prediction(second.pk, INTERIOR_DESIGN_MODEL, other), 'p2')
+        self.assertEqual(self.client_mock.predictions.create.call_count, 2)
+
+    def test_reaper_releases_slots_of_jobs_finished_elsewhere(self):
+        design = self.design()
+        webhooks.create_prediction(design.pk, INTERIOR_DESIGN_MODEL, self.data)
+        self.assertEqual(self.limiter.active, 1)
+
+        # Another process handled the webhook
+        PendingPrediction.objects.all().delete()
+        webhooks.reap()
+
+        self.assertEqual(self.limiter.active, 0)
+        self.assertEqual(webhooks._slots, {})
+
+    @override_settings(GENERATION_JOBS_EAGER=True)
+    @patch('api.generation.image_digest', return_value=None)
+    def test_webhook_jobs_take_from_the_rate_limit(self, mock_digest):
+        limiter = admission.Limiter(4, 4, timeout=5, buckets=admission.TokenBuckets(1, 1))
+        data = {
+            'image': 'https://example.com/image.jpg', 'theme': 'Modern', 'room_type': 'living_room',
+            'color': 'White', 'additional_notes': ''
+        }
+
+        with patch.object(admission, 'limiter', limiter):
+            first = APIClient(REMOTE_ADDR='10.0.0.1').post(reverse('generate') + '?async=true', data, format='json')
+            second = APIClient(REMOTE_ADDR='10.0.0.1').post(reverse('generate') + '?async=true', data, format='json')
+
+        self.assertEqual(first.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(second.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.client_mock.predictions.create.assert_called_once()
+
+
+@override_settings(GENERATION_JOBS_EAGER=True)
+class ProgressTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.enterContext(patch('api.generation.image_digest', return_value=None))
+        self.enterContext(patch('api.storage.s3_client.put_object'))
+        self.enterContext(patch.object(variants, 'IMAGE_VARIANTS', False))
+
+    def submit(self):
+        response = self.client.post(reverse('generate') + '?async=true', {
+            'image': 'https://example.com/image.jpg', 'theme': 'Modern', 'room_type': 'living_room',
+            'color': 'White', 'additional_notes': 'Some notes'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        return response.data['job_id']
+
+    def events(self, response):
+        frames = b''.join(response.streaming_content).decode().strip().split('\n\n')
+        events = []
+        for frame in frames:
+            fields = dict(line.split(': ', 1) for line in frame.splitlines() if not line.startswith(':'))
+            if 'event' in fields:
+                events.append((fields['event'], json.loads(fields['data'])))
+        return events
+
+    @patch('api.generation.replicate_client')
+    def test_job_reports_stages_and_step_progress(self, mock_client):
+        prediction = _PolledPrediction([Mock(read=lambda: b'image_data')])
+        mock_client.return_value = Mock(poll_interval=0)
+        mock_client.return_value.predictions.create.return_value = prediction
+
+        with patch.object(progress, 'report', wraps=progress.report) as report:
+            job_id = self.submit()
+
+        self.assertEqual(
+            [c.args for c in report.call_args_list],
+            [('running',), ('running', 0.1), ('running', 0.5), ('running', 1.0), ('uploading',)]
+        )
+        # Polled rather than waited on, so its progress can be seen
+        self.assertNotIn('wait', mock_client.return_value.predictions.create.call_args.kwargs)
+        design = InteriorDesign.objects.get(pk=job_id)
+        self.assertEqual((design.status, design.stage, design.progress), ('completed', 'done', 1.0))
+
+    @patch('api.generation.run_prediction')
+    def test_stream_ends_with_the_outcome(self, mock_run):
+        mock_run.return_value = Mock(read=lambda: b'image_data')
+        job_id = self.submit()
+
+        response = self.client.get(
+            reverse('interiordesign-events', args=[job_id]), HTTP_ACCEPT='text/event-stream'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        [(event, data)] = self.events(response)
+        self.assertEqual(event, 'done')
+        self.assertEqual(data['stage'], 'done')
+        self.assertEqual(len(data['output_urls']), 1)
+
+    def test_stream_follows_a_running_job(self):
+        design = InteriorDesign.objects.create(
+            floor_plan=FloorPlan.objects.create(room_type='bedroom'), status='processing', stage='queued'
+        )
+        stream = progress.events(design.pk)
+        self.assertTrue(next(stream).startswith('retry: '))
+        self.assertIn('"stage": "queued"', next(stream))
+
+        progress.report('running', 0.25, design_id=design.pk)
+        self.assertIn('"progress": 0.25', next(stream))
+        # Too small a step to be written
+        progress.report('running', 0.26, design_id=design.pk)
+        InteriorDesign.objects.filter(pk=design.pk).update(status='failed', stage='failed', error='boom')
+        progress.finished(design.pk)
+        frame = next(stream)
+        self.assertIn('event: failed', frame)
+        self.assertIn('"progress": 0.25', frame)
+        self.assertRaises(StopIteration, next, stream)
+
+    def test_stream_waits_in_the_event_loop_under_asgi(self):
+        design = InteriorDesign.objects.create(
+            floor_plan=FloorPlan.objects.create(room_type='bedroom'), status='completed', stage='done',
+            output_urls=['https://example.com/a.png']
+        )
+
+        async def follow():
+            response = await self.async_client.get(
+                reverse('interiordesign-events', args=[design.pk]), headers={'Accept': 'text/event-stream'}
+            )
+            return response, [chunk async for chunk in response.streaming_content]
+
+        response, chunks = async_to_sync(follow)()
+        self.assertTrue(response.is_async)
+        self.assertIn(b'event: done', b''.join(chunks))
+
+    def test_webhook_deliveries_report_step_progress(self):
+        design = InteriorDesign.objects.create(
+            floor_plan=FloorPlan.objects.create(room_type='bedroom'), status='processing', stage='queued'
+        )
+        PendingPrediction.objects.create(token='t' * 32, design=design, model=INTERIOR_DESIGN_MODEL, prediction_id='p1')
+
+        self.assertTrue(webhooks.handle_webhook('t' * 32, {'id': 'p1', 'status': 'processing', 'logs': ' 40%|####      | 20/50'}))
+        design.refresh_from_db()
+        self.assertEqual((design.status, design.stage, design.progress), ('processing', 'running', 0.4))
+        # Not claimed; the completed delivery finishes the job
+        self.assertTrue(PendingPrediction.objects.exists())
+
+    def test_unknown_job_is_not_found(self):
+        response = self.client.get(reverse('interiordesign-events', args=[999]), HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertTrue(response.content.startswith(b'event: error'))
+
+
+class _StuckPrediction:
+    """A prediction that keeps running until it's cancelled."""
+
+    def __init__(self):
+        self.id = 'p1'
+        self.status = 'processing'
+        self.logs = ''
+        self.progress = None
+
+    def reload(self):
+        pass
+
+    async def async_reload(self):
+        pass
+
+
+class CancellationTests(TestCase):
+    def setUp(self):
+        self.enterContext(patch('api.generation.image_digest', return_value=None))
+        self.put_object = self.enterContext(patch('api.storage.s3_client.put_object'))
+        self.client_mock = self.enterContext(patch('api.generation.replicate_client')).return_value
+        self.client_mock.poll_interval = 0.01
+        self.client_mock.predictions.create.return_value = _StuckPrediction()
+
+    def cancelled_count(self, endpoint, reason):
+        return REGISTRY.get_sample_value(
+            'generations_cancelled_total', {'endpoint': endpoint, 'model': INTERIOR_DESIGN_MODEL, 'reason': reason}
+        ) or 0
+
+    def test_deadline_cancels_the_prediction(self):
+        before = self.cancelled_count('room-design', 'deadline')
+        response = APIClient().post(reverse('room-design'), {
+            'image': 'https://example.com/room.jpg', 'theme': 'Modern', 'room_type': 'bedroom',
+            'color': 'White', 'accessories': 'plants', 'furniture': 'bed', 'walls': 'white',
+            'lights': 'warm', 'realistic': 'realistic'
+        }, format='json', HTTP_X_REQUEST_TIMEOUT='0.05')
+
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertEqual(response.data['reason'], 'deadline')
+        self.client_mock.predictions.cancel.assert_called_once_with('p1')
+        self.put_object.assert_not_called()
+        self.assertEqual(InteriorDesign.objects.get().error, 'Deadline exceeded')
+        self.assertEqual(self.cancelled_count('room-design', 'deadline'), before + 1)
+
+    @patch.object(cancellation, 'ABANDONED_CHECK_INTERVAL', 0)
+    def test_abandoned_job_is_cancelled(self):
+        from .generation import run_generation_job
+
+        design = InteriorDesign.objects.create(
+            floor_plan=FloorPlan.objects.create(room_type='bedroom'), status='processing'
+        )
+
+        def create(**kwargs):
+            # The client closes its event stream while the prediction runs
+            InteriorDesign.objects.filter(pk=design.pk).update(abandoned_at=timezone.now() - timedelta(minutes=5))
+            return _StuckPrediction()
+
+        self.client_mock.predictions.create.side_effect = create
+        run_generation_job(
+            design.pk, INTERIOR_DESIGN_MODEL, {'image': 'https://example.com/x.jpg', 'prompt': 'p'}, roomdesign_key
+        )
+
+        design.refresh_from_db()
+        self.assertEqual((design.status, design.error), ('failed', 'Client went away'))
+        self.client_mock.predictions.cancel.assert_called_once_with('p1')
+        self.put_object.assert_not_called()
+
+    def test_closed_event_stream_abandons_the_job(self):
+        design = InteriorDesign.objects.create(
+            floor_plan=FloorPlan.objects.create(room_type='bedroom'), status='processing', stage='queued'
+        )
+        stream = progress.events(design.pk)
+        next(stream)
+        stream.close()
+        design.refresh_from_db()
+        self.assertIsNotNone(design.abandoned_at)
+
+        # Reconnecting in time keeps it running
+        reconnected = progress.events(design.pk)
+        self.addCleanup(reconnected.close)
+        next(reconnected)
+        design.refresh_from_db()
+        self.assertIsNone(design.abandoned_at)
+
+    def test_webhook_delivery_past_the_deadline_stops_the_job(self):
+        design = InteriorDesign.objects.create(
+            floor_plan=FloorPlan.objects.create(room_type='bedroom'), status='processing',
+            deadline=timezone.now() - timedelta(seconds=1)
+        )
+        PendingPrediction.objects.create(token='t' * 32, design=design, model=INTERIOR_DESIGN_MODEL, prediction_id='p1')
+
+        with patch('api.webhooks.replicate_client') as mock_client:
+            self.assertTrue(webhooks.handle_webhook('t' * 32, {'id': 'p1', 'status': 'processing', 'logs': ''}))
+        mock_client.return_value.predictions.cancel.assert_called_once_with('p1')
+        design.refresh_from_db()
+        self.assertEqual((design.status, design.error), ('failed', 'Deadline exceeded'))
+        self.assertFalse(PendingPrediction.objects.exists())
+
+    def test_disconnect_cancels_async_prediction(self):
+        client = Mock(poll_interval=0.01)
+        client.predictions.async_create = AsyncMock(return_value=_StuckPrediction())
+        client.predictions.async_cancel = AsyncMock()
+
+        async def disconnect():
+            from .async_generation import arun_prediction
+            task = asyncio.ensure_future(arun_prediction(INTERIOR_DESIGN_MODEL, {'image': 'x'}))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with patch('api.async_generation.async_replicate_client', return_value=client):
+            asyncio.run(disconnect())
+        client.predictions.async_cancel.assert_awaited_once_with('p1')
+
+    def test_request_timeout(self):
+        request = Mock(headers={'X-Request-Timeout': '30'})
+        self.assertEqual(cancellation.request_timeout(request), 30)
+        self.assertEqual(cancellation.request_timeout(request, {'timeout': 10.0}), 10)
+        self.assertEqual(cancellation.request_timeout(Mock(headers={'X-Request-Timeout': '1e9'})), cancellation.GENERATION_MAX_TIMEOUT)
+        self.assertIsNone(cancellation.request_timeout(Mock(headers={'X-Request-Timeout': 'soon'})))
+
+
+class DatabaseConfigTests(TestCase):
+    def test_postgres_url(self):
+        from interior_pilot.settings import database_config
+
+        config = database_config('postgres://pilot:p%40ss@db:5432/interior_pilot?sslmode=require')
+
+        self.assertEqual(config['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual(
+            (config['NAME'], config['USER'], config['PASSWORD'], config['HOST'], config['PORT']),
+            ('interior_pilot', 'pilot', 'p@ss', 'db', '5432')
+        )
+        self.assertEqual(config['OPTIONS']['sslmode'], 'require')
+        self.assertGreater(config['CONN_MAX_AGE'], 0)
+        self.assertTrue(config['CONN_HEALTH_CHECKS'])
+        self.assertNotIn('pool', config['OPTIONS'])
+
+    def test_pooling_replaces_persistent_connections(self):
+        from interior_pilot import settings as project_settings
+
+        with patch.object(project_settings, 'DATABASE_POOL_MAX_SIZE', 8):
+            config = project_settings.database_config('postgresql://pilot@db/interior_pilot')
+
+        self.assertEqual(config['OPTIONS']['pool']['max_size'], 8)
+        self.assertEqual(config['CONN_MAX_AGE'], 0)
+
+    def test_sqlite_and_unsupported_urls(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from interior_pilot.settings import BASE_DIR, database_config
+
+        self.assertEqual(database_config(None)['NAME'], BASE_DIR / 'db.sqlite3')
+        self.assertEqual(database_config('sqlite:///local.sqlite3')['NAME'], BASE_DIR / 'local.sqlite3')
+        with self.assertRaises(ImproperlyConfigured):
+            database_config('mysql://pilot@db/interior_pilot')
+
+    def test_design_access_indexes(self):
+        indexes = {index.name: index.fields for index in InteriorDesign._meta.indexes}
+        self.assertEqual(indexes['design_status_created_idx'], ['status', '-created_at', '-id'])
+        self.assertEqual(indexes['design_floor_plan_created_idx'], ['floor_plan', '-created_at'])
+        self.assertIn('design_edge_map_idx', indexes)
+
+
+class ModelTests(TestCase):
+    def test_create_floor_plan(self):
+        """Test creating a floor plan"""
+        floor_plan = FloorPlan.objects.create(
+            room_type='living_room',
+            area_sqft=500
+        )
+        self.assertEqual(str(floor_plan), f"living_room - {floor_plan.uploaded_at}")
+
+    def test_create_design_preference(self):
+        """Test creating design preferences"""
+        floor_plan = FloorPlan.objects.create(room_type='bedroom', area_sqft=300)
+        preferences = DesignPreference.objects.create(
+            floor_plan=floor_plan,
+            theme='Modern',
+            color='White',
+            additional_notes='Some notes'
+        )
+        self.assertEqual(str(preferences), f"Preferences for {floor_plan}")
+
+    def test_image_fields_fit_content_hash_urls(self):
+        """Stored S3 URLs of content-addressed uploads fit the image columns"""
+        from .generation import create_design
+
+        url = s3_url(f"uploads/{hashlib.sha256(b'plan').hexdigest()}.png")
+        self.assertGreater(len(url), 100)
+        design = create_design({'image': url, 'prompt': 'a room'}, 'bedroom', generated_image=url)
+
+        design.refresh_from_db()
+        self.assertEqual(design.floor_plan.image.name, url)
+        self.assertEqual(design.generated_image.name, url)
+        # SQLite doesn't enforce lengths; Postgres would raise a DataError
+        for model, field in ((FloorPlan, 'image'), (InteriorDesign, 'generated_image'), (InteriorDesign, 'edge_map')):
+            self.assertGreaterEqual(model._meta.get_field(field).max_length, len(url))
 
 
 class SerializerTests(TestCase):
@@ -0,0 +1,58 @@
+import time
+import asyncio
+import httpx
+from .clients import _TRACE_EVENTS, _record, _retry_delay, _should_retry
+
+
+class TracedTransport(httpx.BaseTransport):
+    """Counts requests and new connections, and retries throttled POSTs."""
+
+    def __init__(self, name, transport):
+        self.name = name
+        self.transport = transport
+
+    def handle_request(self, request):
+        request.extensions['trace'] = self._trace
+        attempt = 0
+        while True:
+            _record(self.name, 'requests')
+            response = self.transport.handle_request(request)
+            if not _should_retry(request, response, attempt):
+                return response
+            response.close()
+            time.sleep(_retry_delay(response, attempt))
+            attempt += 1
+
+    def _trace(self, event_name, info):
+        if event_name in _TRACE_EVENTS:
+            _record(self.name, _TRACE_EVENTS[event_name])
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncTracedTransport(httpx.AsyncBaseTransport):
+    """Async counterpart of TracedTransport."""
+
+    def __init__(self, name, transport):
+        self.name = name
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        request.extensions['trace'] = self._trace
+        attempt = 0
+        while True:
+            _record(self.name, 'requests')
+            response = await self.transport.handle_async_request(request)
+            if not _should_retry(request, response, attempt):
+                return response
+            await response.aclose()
+            await asyncio.sleep(_retry_delay(response, attempt))
+            attempt += 1
+
+    async def _trace(self, event_name, info):
+        if event_name in _TRACE_EVENTS:
+            _record(self.name, _TRACE_EVENTS[event_name])
+
+    async def aclose(self):
+        await self.transport.aclose()
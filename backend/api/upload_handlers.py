@@ -0,0 +1,144 @@
+import hashlib
+import logging
+from PIL import ImageFile
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from .storage import s3_url
+from .s3_multipart import MultipartUpload
+from .generation import UploadError
+
+logger = logging.getLogger(__name__)
+
+
+# Stop looking for image dimensions if the header hasn't been parsed after this many bytes
+IMAGE_HEADER_MAX_BYTES = 256 * 1024
+
+
+class S3UploadedFile(UploadedFile):
+    """
+    An upload that was streamed straight to S3; only its metadata is kept.
+
+    key is None when the upload was discarded because should_store() said
+    the content is already stored.
+    """
+
+    def __init__(self, name, content_type, size, charset, key, sha256, width=None, height=None):
+        super().__init__(None, name, content_type, size, charset)
+        self.key = key
+        self.url = s3_url(key) if key else None
+        self.sha256 = sha256
+        self.width = width
+        self.height = height
+
+
+class S3StreamingUploadHandler(FileUploadHandler):
+    """
+    Forward a multipart file field to an S3 multipart upload as it arrives.
+
+    At most S3_MULTIPART_MAX_INFLIGHT parts are buffered, so memory stays flat
+    regardless of file size, and parts upload while the rest of the body is
+    still being received. Other fields fall through to the default handlers.
+
+    should_store(sha256) is asked before the upload is completed; returning
+    False aborts it so content that is already stored isn't written again.
+    """
+
+    def __init__(self, request=None, field_name='image', key_func=None, should_store=None):
+        super().__init__(request)
+        self.stream_field = field_name
+        self.key_func = key_func or (lambda file_name: file_name)
+        self.should_store = should_store or (lambda sha256: True)
+        self.active = False
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.active = field_name == self.stream_field
+        if not self.active:
+            return
+
+        self.key = self.key_func(file_name)
+        self.sha256 = hashlib.sha256()
+        self.header_parser = ImageFile.Parser()
+        self.header_bytes = 0
+        self.dimensions = (None, None)
+        self.upload = MultipartUpload(self.key, content_type)
+        try:
+            self.upload.start()
+        except Exception as e:
+            self.active = False
+            raise UploadError(str(e)) from e
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+
+        self.sha256.update(raw_data)
+        self._parse_header(raw_data)
+        try:
+            self.upload.write(raw_data)
+        except Exception as e:
+            self._abort()
+            raise UploadError(str(e)) from e
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+
+        digest = self.sha256.hexdigest()
+        width, height = self.dimensions
+        if not self.should_store(digest):
+            self._abort()
+            return S3UploadedFile(
+                name=self.file_name,
+                content_type=self.content_type,
+                size=file_size,
+                charset=self.charset,
+                key=None,
+                sha256=digest,
+                width=width,
+                height=height
+            )
+
+        try:
+            self.upload.complete()
+        except Exception as e:
+            self._abort()
+            raise UploadError(str(e)) from e
+
+        self.active = False
+        return S3UploadedFile(
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            key=self.key,
+            sha256=digest,
+            width=width,
+            height=height
+        )
+
+    def upload_interrupted(self):
+        if self.active:
+            self._abort()
+
+    def _parse_header(self, raw_data):
+        # Feed only the first bytes: once the header is parsed Pillow would start decoding
+        if self.header_parser is None:
+            return
+        try:
+            self.header_parser.feed(raw_data)
+        except Exception:
+            self.header_parser = None
+            return
+        self.header_bytes += len(raw_data)
+        if self.header_parser.image is not None:
+            self.dimensions = self.header_parser.image.size
+            self.header_parser = None
+        elif self.header_bytes >= IMAGE_HEADER_MAX_BYTES:
+            self.header_parser = None
+
+    def _abort(self):
+        self.active = False
+        self.upload.abort()
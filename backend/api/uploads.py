@@ -0,0 +1,230 @@
+import os
+import uuid
+import base64
+import hashlib
+import logging
+from PIL import ImageFile
+from functools import partial
+from django.db import IntegrityError, transaction
+from . import edges, normalize
+from .storage import s3_client, AWS_BUCKET_NAME, s3_url
+from .models import UploadedImage
+
+logger = logging.getLogger(__name__)
+
+
+# Limits enforced on presigned direct-to-S3 uploads
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_CONTENT_TYPES = ['image/jpeg', 'image/png', 'image/webp', 'image/heic', 'image/avif']
+PRESIGNED_UPLOAD_EXPIRES = int(os.getenv("PRESIGNED_UPLOAD_EXPIRES", "900"))
+
+
+def content_key(sha256, file_name):
+    """Uploads are stored under their content hash, keeping the original extension."""
+    extension = os.path.splitext(file_name or '')[1].lower()
+    return f"uploads/{sha256}{extension}"
+
+
+def staging_key(file_name):
+    """Where an upload streams to before its content hash is known."""
+    extension = os.path.splitext(file_name or '')[1].lower()
+    return f"uploads/staging/{uuid.uuid4().hex}{extension}"
+
+
+def find(sha256):
+    if not sha256:
+        return None
+    return UploadedImage.objects.filter(sha256=sha256.lower()).first()
+
+
+async def afind(sha256):
+    if not sha256:
+        return None
+    return await UploadedImage.objects.filter(sha256=sha256.lower()).afirst()
+
+
+def is_new(sha256):
+    return not UploadedImage.objects.filter(sha256=sha256).exists()
+
+
+def promote(uploaded_file):
+    """
+    Move a streamed upload from its staging key to its content key and index
+    it. S3 copies the object server-side, so no bytes pass through us again.
+    """
+    key = content_key(uploaded_file.sha256, uploaded_file.name)
+    s3_client.copy_object(
+        Bucket=AWS_BUCKET_NAME,
+        Key=key,
+        CopySource={'Bucket': AWS_BUCKET_NAME, 'Key': uploaded_file.key},
+        ContentType=uploaded_file.content_type or 'application/octet-stream',
+        MetadataDirective='REPLACE'
+    )
+    try:
+        s3_client.delete_object(Bucket=AWS_BUCKET_NAME, Key=uploaded_file.key)
+    except Exception as e:
+        logger.error(f"Error deleting staged upload {uploaded_file.key}: {str(e)}")
+
+    return index(
+        uploaded_file.sha256, key, uploaded_file.size,
+        uploaded_file.width, uploaded_file.height, uploaded_file.content_type
+    )
+
+
+def index(sha256, key, size, width, height, content_type):
+    """Record a stored upload in the local index and return its entry."""
+    try:
+        record, created = UploadedImage.objects.get_or_create(
+            sha256=sha256,
+            defaults={
+                'key': key,
+                'size': size,
+                'width': width,
+                'height': height,
+                'content_type': content_type or '',
+            }
+        )
+    except IntegrityError:
+        # An identical upload finished first
+        return UploadedImage.objects.get(sha256=sha256)
+
+    if created:
+        # Prepare the copies sent to the models once the index entry is visible to other threads
+        transaction.on_commit(partial(_prepare, record.pk))
+    return record
+
+
+def _prepare(upload_id):
+    """Make the normalized copies and the edge map of a new upload in the background."""
+    normalize.schedule(upload_id)
+    edges.schedule(upload_id)
+
+
+def upload_payload(record, deduplicated):
+    """Response body describing a stored upload."""
+    return {
+        'url': s3_url(record.key),
+        'sha256': record.sha256,
+        'size': record.size,
+        'width': record.width,
+        'height': record.height,
+        'deduplicated': deduplicated,
+        'message': 'Image uploaded successfully'
+    }
+
+
+def _checksum(sha256):
+    """S3 expects SHA-256 checksums base64 encoded."""
+    return base64.b64encode(bytes.fromhex(sha256)).decode('ascii')
+
+
+def presign_upload(sha256, file_name, content_type, size, method='POST'):
+    """
+    Let the client send an upload straight to S3 under its content key.
+
+    S3 enforces the content type, the size and the declared SHA-256, so the
+    object can only end up holding exactly what the client announced.
+    """
+    key = content_key(sha256, file_name)
+    checksum = _checksum(sha256)
+
+    if method == 'PUT':
+        url = s3_client.generate_presigned_url(
+            'put_object',
+            Params={
+                'Bucket': AWS_BUCKET_NAME,
+                'Key': key,
+                'ContentType': content_type,
+                'ContentLength': size,
+                'ChecksumSHA256': checksum,
+            },
+            ExpiresIn=PRESIGNED_UPLOAD_EXPIRES
+        )
+        return {
+            'method': 'PUT',
+            'url': url,
+            'key': key,
+            'headers': {
+                'Content-Type': content_type,
+                'x-amz-checksum-sha256': checksum,
+            },
+        }
+
+    post = s3_client.generate_presigned_post(
+        Bucket=AWS_BUCKET_NAME,
+        Key=key,
+        Fields={
+            'Content-Type': content_type,
+            'x-amz-checksum-sha256': checksum,
+        },
+        Conditions=[
+            {'Content-Type': content_type},
+            {'x-amz-checksum-sha256': checksum},
+            ['content-length-range', 1, min(size, UPLOAD_MAX_BYTES)],
+        ],
+        ExpiresIn=PRESIGNED_UPLOAD_EXPIRES
+    )
+    return {
+        'method': 'POST',
+        'url': post['url'],
+        'key': key,
+        'fields': post['fields'],
+    }
+
+
+def _stored_sha256(key):
+    """SHA-256 of a stored object, hashed as it streams from S3; None if it can't be read."""
+    try:
+        body = s3_client.get_object(Bucket=AWS_BUCKET_NAME, Key=key)['Body']
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: body.read(64 * 1024), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+    except Exception as e:
+        logger.error(f"Could not read direct upload {key}: {str(e)}")
+        return None
+
+
+def _read_dimensions(key):
+    """Read image dimensions from the first bytes of a stored object."""
+    try:
+        head = s3_client.get_object(Bucket=AWS_BUCKET_NAME, Key=key, Range='bytes=0-65535')
+        parser = ImageFile.Parser()
+        parser.feed(head['Body'].read())
+        if parser.image is not None:
+            return parser.image.size
+    except Exception as e:
+        logger.warning(f"Could not read dimensions of {key}: {str(e)}")
+    return None, None
+
+
+def record_direct_upload(sha256, file_name):
+    """
+    Index an object the client uploaded directly to S3.
+
+    Returns None when the object is missing or doesn't match the limits or
+    its SHA-256, in which case it is deleted, unless it is indexed already.
+    """
+    key = content_key(sha256, file_name)
+    try:
+        head = s3_client.head_object(Bucket=AWS_BUCKET_NAME, Key=key, ChecksumMode='ENABLED')
+    except Exception as e:
+        logger.error(f"Direct upload {key} not found: {str(e)}")
+        return None
+
+    checksum = head.get('ChecksumSHA256')
+    valid = head['ContentLength'] <= UPLOAD_MAX_BYTES and head.get('ContentType') in UPLOAD_CONTENT_TYPES
+    if valid:
+        # An object S3 stored without a checksum is hashed here instead of trusted
+        valid = checksum == _checksum(sha256) if checksum is not None else _stored_sha256(key) == sha256.lower()
+    if not valid:
+        if UploadedImage.objects.filter(key=key).exists():
+            # Served to others already; whatever the client sent didn't replace it
+            logger.error(f"Direct upload {key} does not match its upload limits or checksum")
+            return None
+        logger.error(f"Direct upload {key} does not match its upload limits or checksum, deleting it")
+        s3_client.delete_object(Bucket=AWS_BUCKET_NAME, Key=key)
+        return None
+
+    width, height = _read_dimensions(key)
+    return index(sha256, key, head['ContentLength'], width, height, head.get('ContentType'))
@@ -1,6 +1,9 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DesignStyleViewSet, InteriorDesignViewSet, generate_design, Generate3DLayoutView, UploadImageView, RoomDesignView
+from .async_views import (
+    generate_design_async, AsyncGenerate3DLayoutView, AsyncUploadImageView, AsyncRoomDesignView
+)
+from .views import DesignStyleViewSet, InteriorDesignViewSet, generate_design, Generate3DLayoutView, UploadImageView, RoomDesignView, RoomDesignBatchView, PresignedUploadView, UploadCompleteView, client_stats, ready, replicate_webhook
 
 router = DefaultRouter()
 router.register(r'styles', DesignStyleViewSet)
@@ -11,5 +14,16 @@ urlpatterns = [
     path('generate/', generate_design, name='generate'),
     path('generate-3d-layout/', Generate3DLayoutView.as_view(), name='generate-3d-layout'),
     path('upload-image/', UploadImageView.as_view(), name='upload-image'),
+    path('upload-url/', PresignedUploadView.as_view(), name='upload-url'),
+    path('upload-complete/', UploadCompleteView.as_view(), name='upload-complete'),
     path('room-design/', RoomDesignView.as_view(), name='room-design'),
+    path('room-design/batch/', RoomDesignBatchView.as_view(), name='room-design-batch'),
+    path('client-stats/', client_stats, name='client-stats'),
+    path('ready/', ready, name='ready'),
+    path('replicate-webhook/', replicate_webhook, name='replicate-webhook'),
+    # Non-blocking versions of the endpoints above, meant to be served under ASGI
+    path('async/generate/', generate_design_async, name='generate-async'),
+    path('async/generate-3d-layout/', AsyncGenerate3DLayoutView.as_view(), name='generate-3d-layout-async'),
+    path('async/upload-image/', AsyncUploadImageView.as_view(), name='upload-image-async'),
+    path('async/room-design/', AsyncRoomDesignView.as_view(), name='room-design-async'),
 ]
@@ -0,0 +1,248 @@
+import os
+import logging
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .storage import s3_client, AWS_BUCKET_NAME, s3_url
+
+logger = logging.getLogger(__name__)
+
+
+# Generated images and their variants are never overwritten under the same key
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Set to 0 to store only the full-size PNG outputs
+IMAGE_VARIANTS = os.getenv("IMAGE_VARIANTS", "1") == "1"
+# Widths of the thumbnail and medium renditions
+IMAGE_VARIANT_WIDTHS = [int(width) for width in os.getenv("IMAGE_VARIANT_WIDTHS", "320,768").split(',')]
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+
+
+def _memory_limit():
+    """The container's memory limit in bytes (cgroup v2 or v1), or None if it has none."""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as limit:
+                value = limit.read().strip()
+        except OSError:
+            continue
+        return None if value == 'max' else int(value)
+    return None
+
+
+def _default_processes():
+    # Every worker process re-imports Django and Pillow, too much for a small container
+    limit = _memory_limit()
+    return 0 if limit is not None and limit < 1024 ** 3 else 2
+
+
+# Processes that encode variants, so encoding doesn't hold the GIL; 0 encodes in
+# the background thread. By default 0 in containers with under 1 GiB of memory.
+IMAGE_VARIANT_PROCESSES = int(os.getenv("IMAGE_VARIANT_PROCESSES", str(_default_processes())))
+# Outputs waiting for their variants; outputs past this get none, rather than piling up spooled files
+IMAGE_VARIANT_QUEUE_SIZE = int(os.getenv("IMAGE_VARIANT_QUEUE_SIZE", "32"))
+
+CONTENT_TYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+
+
+def variant_formats():
+    """WebP always; AVIF when Pillow has an AVIF encoder (e.g. pillow-avif-plugin)."""
+    from PIL import Image
+
+    try:
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+    Image.init()
+    return ['avif', 'webp'] if 'AVIF' in Image.SAVE else ['webp']
+
+
+def variant_key(key, width, image_format):
+    return f"{os.path.splitext(key)[0]}-{width}w.{image_format}"
+
+
+def srcset(url):
+    """
+    srcset strings of an output's stored variants by format, e.g.
+    {'webp': '<url>-320w.webp 320w, <url>-768w.webp 768w'}. Variants are
+    stored after the output's URL is handed out, so only the ones this
+    process has stored are listed; until then the PNG stands in.
+    """
+    if not IMAGE_VARIANTS:
+        return {}
+    stored = _stored_variants.get(url, ())
+    return {
+        image_format: ', '.join(
+            f"{variant_key(url, width, image_format)} {width}w"
+            for width in sorted(width for width, stored_format in stored if stored_format == image_format)
+        )
+        for image_format in dict.fromkeys(image_format for _, image_format in stored)
+    }
+
+
+# Variants stored by this process, by output URL; only the most recent
+# VARIANT_URLS_REMEMBERED outputs are kept
+VARIANT_URLS_REMEMBERED = 1024
+_stored_variants = OrderedDict()
+_stored_variants_lock = threading.Lock()
+
+
+def _remember(url, width, image_format):
+    with _stored_variants_lock:
+        _stored_variants[url] = _stored_variants.get(url, ()) + ((width, image_format),)
+        _stored_variants.move_to_end(url)
+        while len(_stored_variants) > VARIANT_URLS_REMEMBERED:
+            _stored_variants.popitem(last=False)
+
+
+_supported_formats = None
+
+
+def _formats():
+    global _supported_formats
+    if _supported_formats is None:
+        _supported_formats = variant_formats()
+    return _supported_formats
+
+
+def render_variants(path, widths, formats, quality):
+    """
+    Encode the image at path at each width and format. Runs in a worker
+    process; returns [(width, format, variant_path)] of temporary files.
+    """
+    from PIL import Image
+
+    try:
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+
+    rendered = []
+    with Image.open(path) as original:
+        original.load()
+        image = original.convert('RGBA' if 'A' in original.getbands() else 'RGB')
+
+    for width in sorted(widths, reverse=True):
+        # Never upscale; smaller outputs keep their size
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        for image_format in formats:
+            handle, variant_path = tempfile.mkstemp(suffix=f'.{image_format}')
+            with os.fdopen(handle, 'wb') as out:
+                image.save(out, image_format.upper(), quality=quality)
+            rendered.append((width, image_format, variant_path))
+    return rendered
+
+
+class Spool:
+    """Copies an output to a local temporary file while it streams to S3."""
+
+    def __init__(self):
+        self.file = tempfile.NamedTemporaryFile(suffix='.png', delete=False) if IMAGE_VARIANTS else None
+
+    def tee(self, chunks):
+        for chunk in chunks:
+            if self.file is not None:
+                self.file.write(chunk)
+            yield chunk
+
+    async def atee(self, chunks):
+        async for chunk in chunks:
+            if self.file is not None:
+                # Local disk write, not network
+                self.file.write(chunk)
+            yield chunk
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            _remove(self.file.name)
+            self.file = None
+
+
+_process_pool = None
+_upload_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-variants')
+_queued = threading.BoundedSemaphore(IMAGE_VARIANT_QUEUE_SIZE)
+
+
+def _get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        # Spawned rather than forked: forking would copy the server's threads and open connections
+        _process_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_VARIANT_PROCESSES,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _process_pool
+
+
+def schedule(key, spool):
+    """
+    Render and store the variants of an output in the background; takes over
+    the spool. When IMAGE_VARIANT_QUEUE_SIZE outputs are already waiting, the
+    output gets no variants.
+    """
+    if spool.file is None:
+        return
+    spool.file.close()
+    if not _queued.acquire(blocking=False):
+        logger.warning(f"Image variant queue is full, skipping variants of {key}")
+        _remove(spool.file.name)
+        return
+    try:
+        _upload_executor.submit(_queued_store_variants, key, spool.file.name)
+    except Exception:
+        _queued.release()
+        _remove(spool.file.name)
+        raise
+
+
+def _queued_store_variants(key, path):
+    try:
+        _store_variants(key, path)
+    finally:
+        _queued.release()
+
+
+def _store_variants(key, path):
+    from PIL import Image
+
+    rendered = []
+    try:
+        try:
+            # Only reads the header; outputs that aren't images get no variants
+            Image.open(path).close()
+        except Exception:
+            logger.debug(f"Output {key} is not an image, skipping variants")
+            return
+        if IMAGE_VARIANT_PROCESSES > 0:
+            rendered = _get_process_pool().submit(
+                render_variants, path, IMAGE_VARIANT_WIDTHS, _formats(), IMAGE_VARIANT_QUALITY
+            ).result()
+        else:
+            rendered = render_variants(path, IMAGE_VARIANT_WIDTHS, _formats(), IMAGE_VARIANT_QUALITY)
+        for width, image_format, variant_path in rendered:
+            with open(variant_path, 'rb') as variant:
+                s3_client.put_object(
+                    Bucket=AWS_BUCKET_NAME,
+                    Key=variant_key(key, width, image_format),
+                    Body=variant,
+                    ContentType=CONTENT_TYPES[image_format],
+                    CacheControl=IMMUTABLE_CACHE_CONTROL
+                )
+            _remember(s3_url(key), width, image_format)
+    except Exception as e:
+        logger.error(f"Error storing variants of {key}: {str(e)}")
+    finally:
+        _remove(path)
+        for _, _, variant_path in rendered:
+            _remove(variant_path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,76 +1,125 @@
-import os
-import time
-from botocore.serialize import Serializer
-from rest_framework.decorators import api_view
+import json
+from rest_framework.decorators import api_view, action
 from rest_framework.response import Response
 from rest_framework import status, viewsets
 from rest_framework.parsers import MultiPartParser, FormParser
-from django.core.files.storage import default_storage
-from django.conf import settings
-from .models import FloorPlan, InteriorDesign, DesignStyle, DesignPreference
+from django.urls import reverse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from .models import FloorPlan, InteriorDesign, DesignStyle
 from .serializers import (
-    FloorPlanSerializer, InteriorDesignSerializer, DesignStyleSerializer,
-    DesignPreferenceSerializer, DesignGenerationRequestSerializer, RoomDesignRequestSerializer
+    InteriorDesignSerializer, DesignStyleSerializer,
+    DesignGenerationRequestSerializer, RoomDesignRequestSerializer,
+    DesignJobStatusSerializer, PresignedUploadRequestSerializer, UploadCompleteRequestSerializer,
+    RoomDesignBatchRequestSerializer
 )
 from rest_framework.views import APIView
+from rest_framework.exceptions import ValidationError
+from .pagination import DesignCursorPagination
+from .renderers import EventStreamRenderer
 from .serializers import Generate3DLayoutRequestSerializer
-import replicate
-from rest_framework.parsers import MultiPartParser, FormParser
-import boto3
-import os
-from datetime import datetime
-import uuid
+from .upload_handlers import S3StreamingUploadHandler
+from . import admission, cancellation, metrics, progress, style_catalog, uploads, variants, webhooks
+from .clients import connection_stats
+from .warmup import warm_up
+from .generation import (
+    INTERIOR_DESIGN_MODEL, CONTROLNET_MODEL,
+    build_design_input, build_room_design_input, build_layout_input,
+    roomdesign_key, layout_key, generate_recorded, generate_batch, UploadError, submit_generation
+)
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
-AWS_REGION = os.getenv("AWS_REGION")
+def wants_async(request):
+    """A client opts into submit/poll mode with ?async=true or Prefer: respond-async."""
+    if request.query_params.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
 
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=AWS_REGION,
-)
+
+def job_accepted(request, design):
+    status_url = request.build_absolute_uri(
+        reverse('interiordesign-job-status', args=[design.pk])
+    )
+    return Response({
+        'job_id': design.pk,
+        'status': design.status,
+        'status_url': status_url,
+        'events_url': request.build_absolute_uri(reverse('interiordesign-events', args=[design.pk])),
+        'message': 'Generation job accepted'
+    }, status=status.HTTP_202_ACCEPTED, headers={'Location': status_url})
+
+def overloaded(error):
+    """429 for a request turned away by admission control."""
+    return Response({
+        'error': 'Too many generations in progress, try again later',
+        'reason': error.reason,
+        'retry_after': error.retry_after,
+        'queued': error.queued
+    }, status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': str(error.retry_after)})
+
+def deadline_exceeded(error):
+    """504 for a generation stopped because the client's deadline passed."""
+    return Response(
+        {'error': str(error), 'reason': error.reason},
+        status=status.HTTP_504_GATEWAY_TIMEOUT
+    )
+
+def uploaded_response(record, deduplicated):
+    return Response(uploads.upload_payload(record, deduplicated), status=status.HTTP_200_OK)
 
 class UploadImageView(APIView):
     parser_classes = (MultiPartParser, FormParser)
+
+    def initialize_request(self, request, *args, **kwargs):
+        # Stream the image field to S3 as it arrives instead of spooling it first
+        request.upload_handlers.insert(0, S3StreamingUploadHandler(
+            request, key_func=uploads.staging_key, should_store=uploads.is_new
+        ))
+        return super().initialize_request(request, *args, **kwargs)
+
     def post(self, request):
         try:
-            if 'image' not in request.FILES:
+            # Clients that send the content hash up front skip re-sending a stored file
+            existing = uploads.find(request.headers.get('X-Content-SHA256'))
+            if existing is not None:
+                return uploaded_response(existing, deduplicated=True)
+
+            try:
+                has_image = 'image' in request.FILES
+            except UploadError as e:
+                logger.error(f"Error uploading to S3: {str(e)}")
+                return Response(
+                    {'error': 'Failed to upload image'}, 
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+            if not has_image:
                 return Response(
                     {'error': 'No image file provided'}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
             image_file = request.FILES['image']
-            # Generate a unique filename to avoid conflicts
-            #file_extension = os.path.splitext(image_file.name)[1]
-            #unique_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}{file_extension}"
-            image_key = f"{image_file.name}"
+            if image_file.key is None:
+                # Same content is already stored; the upload handler discarded this copy
+                return uploaded_response(uploads.find(image_file.sha256), deduplicated=True)
 
             try:
-                s3_client.upload_fileobj(
-                    image_file,
-                    AWS_BUCKET_NAME,
-                    image_key,
-                    
-                )
-                
-                file_url = f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{image_key}"
-                return Response({
-                    'url': file_url,
-                    'message': 'Image uploaded successfully'
-                }, status=status.HTTP_200_OK)
-                
+                record = uploads.promote(image_file)
             except Exception as e:
                 logger.error(f"Error uploading to S3: {str(e)}")
                 return Response(
                     {'error': 'Failed to upload image'}, 
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
+            return uploaded_response(record, deduplicated=False)
             
         except Exception as e:
             return Response(
@@ -78,60 +127,109 @@ class UploadImageView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class PresignedUploadView(APIView):
+    """
+    Hand out a presigned POST (or PUT) so the client uploads straight to S3.
+    /api/upload-image/ remains the fallback for clients that can't.
+    """
+
+    def post(self, request):
+        serializer = PresignedUploadRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        existing = uploads.find(data['sha256'])
+        if existing is not None:
+            return uploaded_response(existing, deduplicated=True)
+
+        try:
+            upload = uploads.presign_upload(
+                data['sha256'], data['file_name'], data['content_type'],
+                data['size'], method=data['method']
+            )
+        except Exception as e:
+            logger.error(f"Error presigning upload: {str(e)}")
+            return Response(
+                {'error': 'Failed to prepare upload'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        return Response({
+            'upload': upload,
+            'complete_url': request.build_absolute_uri(reverse('upload-complete')),
+            'expires_in': uploads.PRESIGNED_UPLOAD_EXPIRES,
+        }, status=status.HTTP_200_OK)
+
+class UploadCompleteView(APIView):
+    """Record an object the client uploaded with a presigned URL."""
+
+    def post(self, request):
+        serializer = UploadCompleteRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # Already indexed, e.g. an identical upload completed first
+        existing = uploads.find(serializer.validated_data['sha256'])
+        if existing is not None:
+            return uploaded_response(existing, deduplicated=True)
+
+        record = uploads.record_direct_upload(
+            serializer.validated_data['sha256'],
+            serializer.validated_data['file_name']
+        )
+        if record is None:
+            return Response(
+                {'error': 'Uploaded object is missing or does not match the upload limits'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return uploaded_response(record, deduplicated=False)
+
 class RoomDesignView(APIView):
+    @metrics.instrumented('room-design', INTERIOR_DESIGN_MODEL)
     def post(self, request):
         try:
             serializer = RoomDesignRequestSerializer(data=request.data)
-            if serializer.is_valid():
-                # Configure Replicate client with API token
-                replicate.Client(api_token=os.getenv('REPLICATE_API_TOKEN'))
-                
-                # Format the prompt
-                prompt = f"""Generate a high quality resolution image of a {serializer.validated_data['theme']}-themed {serializer.validated_data['room_type']} with a {serializer.validated_data['color']} 
-                        color design with {serializer.validated_data['accessories']}. With these furniture {serializer.validated_data['furniture']}. Soft rugs, {serializer.validated_data['walls']} walls, and 
-                        {serializer.validated_data['lights']} create warmth, making it {serializer.validated_data['realistic']}."""
-                
-                input_data = {
-                    "image": serializer.validated_data['image'],
-                    "prompt": prompt,
-                }
-                
-                # Run the model
-                output = replicate.run(
-                    "adirik/interior-design:76604baddc85b1b4616e1c6475eca080da339c8875bd4996705440484a6eac38",
-                    input=input_data
-                )
-                
-                # Generate unique filename
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                unique_id = uuid.uuid4().hex[:8]
-                filename = f"roomdesign_{timestamp}_{unique_id}.png"
-                file_path = os.path.join('roomdesign', filename)
-                
-                # Upload to S3
+            with metrics.stage('validation'):
+                valid = serializer.is_valid()
+            if valid:
+                input_data = build_room_design_input(serializer.validated_data)
+
+                timeout = cancellation.request_timeout(request, serializer.validated_data)
+
+                if wants_async(request):
+                    design = submit_generation(
+                        INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                        room_type=serializer.validated_data['room_type'], timeout=timeout
+                    )
+                    return job_accepted(request, design)
+
+                # Run the model and upload to S3
                 try:
-                    s3_client.put_object(
-                        Bucket=AWS_BUCKET_NAME,
-                        Key=file_path,
-                        Body=output.read(),
-                        ContentType='image/png'
+                    result = generate_recorded(
+                        INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                        room_type=serializer.validated_data['room_type'], timeout=timeout
                     )
-                    
-                    file_url = f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{file_path}"
-                    return Response({
-                        'url': file_url,
-                        'message': 'Room design generated successfully'
-                    }, status=status.HTTP_200_OK)
-                    
-                except Exception as e:
+                except UploadError as e:
                     logger.error(f"Error uploading to S3: {str(e)}")
                     return Response(
                         {'error': 'Failed to upload generated image'}, 
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR
                     )
+
+                return Response({
+                    'url': result.urls[0],
+                    'srcset': variants.srcset(result.urls[0]),
+                    'message': 'Room design generated successfully',
+                    'cache': result.cache
+                }, status=status.HTTP_200_OK, headers={'X-Cache': result.cache.upper()})
             
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             
+        except admission.Overloaded as e:
+            return overloaded(e)
+        except cancellation.DeadlineExceeded as e:
+            return deadline_exceeded(e)
         except Exception as e:
             logger.error(f"Error in room design generation: {str(e)}")
             return Response(
@@ -139,133 +237,322 @@ class RoomDesignView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class RoomDesignBatchView(APIView):
+    """
+    Render one room in several variants. Results are streamed back as
+    newline-delimited JSON, one line per variant as soon as it finishes,
+    followed by a summary line.
+    """
+
+    @metrics.instrumented('room-design-batch', INTERIOR_DESIGN_MODEL)
+    def post(self, request):
+        serializer = RoomDesignBatchRequestSerializer(data=request.data)
+        with metrics.stage('validation'):
+            valid = serializer.is_valid()
+        if not valid:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        image = serializer.validated_data['image']
+        variant_specs = serializer.validated_data['variants']
+        inputs = [build_room_design_input(dict(variant, image=image)) for variant in variant_specs]
+        timeout = cancellation.request_timeout(request, serializer.validated_data)
+
+        if wants_async(request):
+            jobs = []
+            for variant, input_data in zip(variant_specs, inputs):
+                try:
+                    design = submit_generation(
+                        INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                        room_type=variant['room_type'], timeout=timeout
+                    )
+                except admission.Overloaded as e:
+                    # Over the rate limit part way through: the rest aren't submitted
+                    if not jobs:
+                        return overloaded(e)
+                    jobs.append({'status': 'rejected', 'error': str(e), 'retry_after': e.retry_after})
+                    continue
+                jobs.append({
+                    'job_id': design.pk,
+                    'status': design.status,
+                    'status_url': request.build_absolute_uri(
+                        reverse('interiordesign-job-status', args=[design.pk])
+                    ),
+                    'events_url': request.build_absolute_uri(
+                        reverse('interiordesign-events', args=[design.pk])
+                    )
+                })
+            return Response(
+                {'jobs': jobs, 'message': 'Generation jobs accepted'},
+                status=status.HTTP_202_ACCEPTED
+            )
+
+        try:
+            admission.check()
+        except admission.Overloaded as e:
+            return overloaded(e)
+
+        # Variants run while the response streams, after this method returns
+        return StreamingHttpResponse(
+            metrics.in_request_context(self.stream_results(inputs, timeout)),
+            content_type='application/x-ndjson'
+        )
+
+    def stream_results(self, inputs, timeout=None):
+        completed = failed = 0
+        for index, result, error in generate_batch(INTERIOR_DESIGN_MODEL, inputs, roomdesign_key, timeout=timeout):
+            if error is None:
+                completed += 1
+                line = {
+                    'index': index, 'status': 'completed', 'url': result.urls[0],
+                    'srcset': variants.srcset(result.urls[0]), 'cache': result.cache
+                }
+            else:
+                failed += 1
+                logger.error(f"Error in room design variant {index}: {str(error)}")
+                message = 'Failed to upload generated image' if isinstance(error, UploadError) else str(error)
+                line = {'index': index, 'status': 'failed', 'error': message}
+                if isinstance(error, admission.Overloaded):
+                    line['retry_after'] = error.retry_after
+            yield json.dumps(line) + '\n'
+
+        yield json.dumps({
+            'done': True,
+            'completed': completed,
+            'failed': failed,
+            'message': 'Room designs generated' if not failed else 'Some room designs failed'
+        }) + '\n'
+
+
 class Generate3DLayoutView(APIView):
+    @metrics.instrumented('generate-3d-layout', CONTROLNET_MODEL)
     def post(self, request):
         try:
-            # Configure Replicate client with API token
-            replicate.Client(api_token=os.getenv('REPLICATE_API_TOKEN'))
-            base = "Use this exact floor plan of **THE GIVEN ROOM** to generate a realistic 3D interior layout **ONLY FOR ONE GIVEN ROOM. DON'T ADD ANY OTHER ROOM**"
             serializer = Generate3DLayoutRequestSerializer(data=request.data)
-            if serializer.is_valid():
-                input_data = {
-                "image": serializer.validated_data['image'],
-                "prompt": serializer.validated_data['prompt'] + base,
-                "structure": "hed",
-                "image_resolution": 512,
-                "num_outputs": 1,
-                "scale": 15,
-                "steps": 20,
-                "negative_prompt": "empty room, no furniture, missing objects, blank space, extra rooms",
-            }
+            with metrics.stage('validation'):
+                valid = serializer.is_valid()
+            if valid:
+                input_data = build_layout_input(serializer.validated_data)
+                timeout = cancellation.request_timeout(request, serializer.validated_data)
+
+                if wants_async(request):
+                    design = submit_generation(CONTROLNET_MODEL, input_data, layout_key, timeout=timeout)
+                    return job_accepted(request, design)
 
                 try:
                     logger.info(f"Sending request to Replicate API with image: {input_data['image'][:100]}...")
-                    output = replicate.run(
-                        "rossjillian/controlnet:795433b19458d0f4fa172a7ccf93178d2adb1cb8ab2ad6c8fdc33fdbcd49f477",
-                        input=input_data
-                    )
+                    try:
+                        result = generate_recorded(CONTROLNET_MODEL, input_data, layout_key, timeout=timeout)
+                    except UploadError as e:
+                        logger.error(f"Error uploading to S3: {str(e)}")
+                        raise Exception("Failed to upload generated image to S3")
 
-                    image_urls = []
-                    for index, item in enumerate(output):
-                        # Generate a unique filename using UUID
-                        filename = f"generated_layouts/{uuid.uuid4()}.png"
-                        
-                        # Upload to S3
-                        try:
-                            s3_client.put_object(
-                                Bucket=AWS_BUCKET_NAME,
-                                Key=filename,
-                                Body=item.read(),
-                                ContentType='image/png'
-                            )
-                            
-                            # Generate the S3 URL
-                            s3_url = f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{filename}"
-                            image_urls.append(s3_url)
-                            
-                        except Exception as e:
-                            logger.error(f"Error uploading to S3: {str(e)}")
-                            raise Exception("Failed to upload generated image to S3")
-
-                    return Response({"message": "3D layout generated successfully", "image_urls": image_urls}, status=status.HTTP_200_OK)
+                    return Response(
+                        {
+                            "message": "3D layout generated successfully",
+                            "image_urls": result.urls,
+                            "srcsets": [variants.srcset(url) for url in result.urls],
+                            "failed_outputs": result.failed,
+                            "cache": result.cache
+                        },
+                        status=status.HTTP_200_OK,
+                        headers={'X-Cache': result.cache.upper()}
+                    )
 
+                except admission.Overloaded as e:
+                    return overloaded(e)
+                except cancellation.DeadlineExceeded as e:
+                    return deadline_exceeded(e)
                 except Exception as e:
-                    print(str(e))
-                    print(f"Error generating 3D layout: {str(e)}")
+                    logger.error(f"Error generating 3D layout: {str(e)}")
                     return Response({"error": "Failed to generate 3D layout"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            print("Invalid data received")
+            logger.debug(f"Invalid 3D layout request: {serializer.errors}")
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+        except admission.Overloaded as e:
+            return overloaded(e)
         except Exception as e:
-            print(str(e))
-            print(f"Error handling request: {str(e)}")
+            logger.error(f"Error handling 3D layout request: {str(e)}")
             return Response({"error": "An unexpected error occurred"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 class DesignStyleViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    The style list is served from the in-process catalog with a strong ETag
+    and Last-Modified, so clients can revalidate and get 304s.
+    """
     queryset = DesignStyle.objects.all()
     serializer_class = DesignStyleSerializer
 
+    def list(self, request, *args, **kwargs):
+        catalog = style_catalog.get()
+        response = Response(catalog.styles, headers={
+            'ETag': catalog.etag,
+            'Last-Modified': http_date(catalog.last_modified),
+            # Cacheable, but revalidated on every use
+            'Cache-Control': 'no-cache',
+        })
+        return get_conditional_response(
+            request._request, etag=catalog.etag, last_modified=catalog.last_modified, response=response
+        )
+
 class InteriorDesignViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Generated designs, newest first and cursor paginated. Filter with
+    ?status= and ?room_type=; ?fields= picks the fields to return.
+    """
     queryset = InteriorDesign.objects.all()
     serializer_class = InteriorDesignSerializer
+    pagination_class = DesignCursorPagination
+    # Left out of lists unless asked for with ?fields=
+    list_excluded_fields = ['prompt_used']
+
+    def rendered_fields(self):
+        """The fields to render for list and detail views."""
+        all_fields = InteriorDesignSerializer.Meta.fields
+        requested = self.request.query_params.get('fields')
+        if requested:
+            fields = [name.strip() for name in requested.split(',') if name.strip()]
+            unknown = sorted(set(fields) - set(all_fields))
+            if unknown:
+                raise ValidationError({'fields': [f"Unknown fields: {', '.join(unknown)}"]})
+            return fields
+        if self.action == 'list':
+            return [name for name in all_fields if name not in self.list_excluded_fields]
+        return list(all_fields)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        for param, lookup, choices in [
+            ('status', 'status', InteriorDesign._meta.get_field('status').choices),
+            ('room_type', 'floor_plan__room_type', FloorPlan._meta.get_field('room_type').choices),
+        ]:
+            value = self.request.query_params.get(param)
+            if value is None:
+                continue
+            if value not in dict(choices):
+                raise ValidationError({param: [f"Must be one of: {', '.join(dict(choices))}"]})
+            queryset = queryset.filter(**{lookup: value})
+
+        if self.action not in ('list', 'retrieve'):
+            return queryset
+
+        # Related rows come in the same query; columns that aren't rendered aren't read
+        fields = self.rendered_fields()
+        related = [name for name in ('floor_plan', 'preferences') if name in fields]
+        unrendered = [name for name in ('prompt_used', 'output_urls', 'error') if name not in fields]
+        return queryset.select_related(*related).defer(*unrendered)
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action in ('list', 'retrieve'):
+            kwargs['fields'] = self.rendered_fields()
+        return super().get_serializer(*args, **kwargs)
+
+    @action(detail=True, methods=['get'], url_path='status', url_name='job-status')
+    def job_status(self, request, pk=None):
+        """Poll the state of a submitted generation job."""
+        design = self.get_object()
+        return Response(DesignJobStatusSerializer(design).data)
+
+    @action(detail=True, methods=['get'], url_path='events', renderer_classes=[EventStreamRenderer])
+    def events(self, request, pk=None):
+        """Follow a generation job's stage and progress as Server-Sent Events."""
+        design = self.get_object()
+        # Under ASGI the stream waits in the event loop; under WSGI it holds a worker thread
+        stream = progress.aevents if isinstance(request._request, ASGIRequest) else progress.events
+        response = StreamingHttpResponse(stream(design.pk), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Sent as they're produced, not buffered by nginx
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 @api_view(['POST'])
+@metrics.instrumented('generate', INTERIOR_DESIGN_MODEL)
 def generate_design(request):
     try:
         serializer = DesignGenerationRequestSerializer(data=request.data)
-        if serializer.is_valid():
-            # Configure Replicate client with API token
-            replicate.Client(api_token=os.getenv('REPLICATE_API_TOKEN'))
-            
-            # Format the prompt
-            prompt = f"""A high quality resolution image of a {serializer.validated_data['theme']}-themed {serializer.validated_data['room_type']} with a {serializer.validated_data['color']} 
-                    color design with the following instructions: {serializer.validated_data['additional_notes']}"""
-            
-            input_data = {
-                "image": serializer.validated_data['image'],
-                "prompt": prompt,
-            }
-            
-            # Run the model
-            output = replicate.run(
-                "adirik/interior-design:76604baddc85b1b4616e1c6475eca080da339c8875bd4996705440484a6eac38",
-                input=input_data
-            )
-            
-            # Generate unique filename
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            unique_id = uuid.uuid4().hex[:8]
-            filename = f"roomdesign_{timestamp}_{unique_id}.png"
-            file_path = os.path.join('roomdesign', filename)
-            
-            # Upload to S3
+        with metrics.stage('validation'):
+            valid = serializer.is_valid()
+        if valid:
+            input_data = build_design_input(serializer.validated_data)
+
+            timeout = cancellation.request_timeout(request, serializer.validated_data)
+
+            if wants_async(request):
+                design = submit_generation(
+                    INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                    room_type=serializer.validated_data['room_type'], timeout=timeout
+                )
+                return job_accepted(request, design)
+
+            # Run the model and upload to S3
             try:
-                s3_client.put_object(
-                    Bucket=AWS_BUCKET_NAME,
-                    Key=file_path,
-                    Body=output.read(),
-                    ContentType='image/png'
+                result = generate_recorded(
+                    INTERIOR_DESIGN_MODEL, input_data, roomdesign_key,
+                    room_type=serializer.validated_data['room_type'], timeout=timeout
                 )
-                
-                file_url = f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{file_path}"
-                return Response({
-                    'url': file_url,
-                    'message': 'Room design generated successfully'
-                }, status=status.HTTP_200_OK)
-                
-            except Exception as e:
+            except UploadError as e:
                 logger.error(f"Error uploading to S3: {str(e)}")
                 return Response(
                     {'error': 'Failed to upload generated image'}, 
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
+
+            return Response({
+                'url': result.urls[0],
+                'srcset': variants.srcset(result.urls[0]),
+                'message': 'Room design generated successfully',
+                'cache': result.cache
+            }, status=status.HTTP_200_OK, headers={'X-Cache': result.cache.upper()})
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
+    except admission.Overloaded as e:
+        return overloaded(e)
+    except cancellation.DeadlineExceeded as e:
+        return deadline_exceeded(e)
     except Exception as e:
         logger.error(f"Error in room design generation: {str(e)}")
         return Response(
             {'error': str(e)}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
\ No newline at end of file
+        )
+
+
+@api_view(['GET'])
+def client_stats(request):
+    """Connection reuse of the shared Replicate and S3 clients."""
+    return Response(connection_stats())
+
+
+@csrf_exempt
+@require_POST
+def replicate_webhook(request):
+    """Replicate reporting that a job's prediction (created in webhook mode) has finished."""
+    try:
+        webhooks.verify(request.headers, request.body)
+    except Exception as e:
+        logger.warning(f"Rejected Replicate webhook: {str(e)}")
+        return JsonResponse({'error': 'Invalid webhook signature'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+    handled = webhooks.handle_webhook(request.GET.get('token', ''), payload)
+    return JsonResponse({'handled': handled})
+
+
+def metrics_view(request):
+    """Request and per-stage latency metrics in the Prometheus text format."""
+    return HttpResponse(metrics.exposition(), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
+@api_view(['GET'])
+def ready(request):
+    """Readiness probe; the first call creates the shared clients."""
+    try:
+        timings = warm_up()
+    except Exception as e:
+        logger.error(f"Warm-up failed: {str(e)}")
+        return Response({'ready': False, 'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response({'ready': True, 'warm_up': timings})
@@ -0,0 +1,45 @@
+import time
+import logging
+import threading
+from django.db import connection
+from . import clients, storage
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up():
+    """
+    Import the SDKs, create the shared clients and check the database, so
+    the first real request doesn't pay for it. Returns seconds per step.
+    Cheap once the clients exist, so a readiness probe can call it freely.
+    """
+    steps = [
+        ('database', _check_database),
+        ('replicate', clients.replicate_client),
+        ('s3', lambda: storage.s3_client.meta),
+    ]
+    timings = {}
+    for name, step in steps:
+        started = time.perf_counter()
+        step()
+        timings[name] = round(time.perf_counter() - started, 4)
+    return timings
+
+
+def _check_database():
+    # A query rather than ensure_connection, which trusts a persistent connection that has gone away
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+def warm_up_in_background():
+    def run():
+        try:
+            timings = warm_up()
+            logger.info(f"Warm-up finished: {timings}")
+        except Exception as e:
+            logger.error(f"Warm-up failed: {str(e)}")
+        finally:
+            connection.close()
+
+    threading.Thread(target=run, name='warm-up', daemon=True).start()
@@ -0,0 +1,343 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from datetime import timedelta
+from types import SimpleNamespace
+from django.db.models import Q
+from django.urls import reverse
+from django.utils import timezone
+from . import admission, cancellation, metrics, prediction_cache, progress, single_flight
+from .clients import replicate_client
+from .generation import (
+    INTERIOR_DESIGN_MODEL, CONTROLNET_MODEL, GenerationResult,
+    normalized_input, as_outputs, upload_outputs, outcome_fields, roomdesign_key, layout_key
+)
+from .db import worker_connection
+from .models import InteriorDesign, PendingPrediction
+
+logger = logging.getLogger(__name__)
+
+
+# Webhook mode for generation jobs: the prediction is created with a
+# webhook and the job returns, instead of a worker thread waiting on it.
+# The receiver view finishes the job when Replicate calls back.
+# Public base URL of this API that Replicate can reach, e.g. https://api.example.com;
+# unset keeps jobs waiting on their prediction
+REPLICATE_WEBHOOK_BASE_URL = os.getenv("REPLICATE_WEBHOOK_BASE_URL")
+# Signing secret (whsec_...); fetched from Replicate when unset
+REPLICATE_WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET")
+# Deliveries signed longer ago than this many seconds are refused, against replays
+REPLICATE_WEBHOOK_TOLERANCE = int(os.getenv("REPLICATE_WEBHOOK_TOLERANCE", "300"))
+# Jobs whose webhook hasn't finished them after this many seconds are looked up
+# on Replicate instead, in case it never arrives
+REPLICATE_WEBHOOK_TIMEOUT = int(os.getenv("REPLICATE_WEBHOOK_TIMEOUT", "900"))
+# Seconds between those lookups, in every process that creates webhook predictions
+REPLICATE_WEBHOOK_REAP_INTERVAL = int(os.getenv("REPLICATE_WEBHOOK_REAP_INTERVAL", "60"))
+
+KEY_FUNCS = {
+    INTERIOR_DESIGN_MODEL: roomdesign_key,
+    CONTROLNET_MODEL: layout_key,
+}
+
+
+def enabled():
+    return bool(REPLICATE_WEBHOOK_BASE_URL)
+
+
+def webhook_url(token):
+    return f"{REPLICATE_WEBHOOK_BASE_URL.rstrip('/')}{reverse('replicate-webhook')}?token={token}"
+
+
+_secret = None
+_secret_lock = threading.Lock()
+
+
+def signing_secret():
+    global _secret
+    from replicate.webhook import WebhookSigningSecret
+
+    with _secret_lock:
+        if _secret is None:
+            if REPLICATE_WEBHOOK_SECRET:
+                _secret = WebhookSigningSecret(key=REPLICATE_WEBHOOK_SECRET)
+            else:
+                _secret = replicate_client().webhooks.default.secret()
+        return _secret
+
+
+def verify(headers, body):
+    """Raise replicate.webhook.WebhookValidationError unless the delivery is signed by Replicate."""
+    from replicate.webhook import Webhooks
+
+    Webhooks.validate(
+        headers=dict(headers), body=body.decode('utf-8'), secret=signing_secret(),
+        tolerance=REPLICATE_WEBHOOK_TOLERANCE
+    )
+
+
+def create_prediction(design_id, model, input_data, digest=None, cache_key=None):
+    """
+    Start a job's prediction with a webhook; handle_webhook() finishes the job.
+    A job identical to one whose prediction is still running joins that
+    prediction instead of paying for another; single_flight keeps identical
+    jobs from starting theirs at the same time. A new prediction holds an
+    admission slot until its jobs are finished. Returns the prediction's id.
+    Raises admission.Overloaded if no slot comes free in time.
+    """
+    flight = single_flight.flight_key(model, input_data)
+    fields = {
+        'design_id': design_id, 'model': model, 'digest': digest or '',
+        'cache_key': cache_key or '', 'flight_key': flight,
+    }
+
+    def start():
+        with metrics.stage('normalize'):
+            model_input = normalized_input(model, input_data, digest)
+
+        client = admission.limiter.acquire()
+        started = time.monotonic()
+        token = uuid.uuid4().hex
+        pending = PendingPrediction.objects.create(token=token, **fields)
+        try:
+            prediction = replicate_client().predictions.create(
+                version=model.split(':', 1)[1], input=model_input,
+                webhook=webhook_url(token), webhook_events_filter=['start', 'logs', 'completed']
+            )
+        except Exception:
+            pending.delete()
+            admission.limiter.release(client)
+            raise
+        # The webhook may already have been handled, and the row deleted
+        PendingPrediction.objects.filter(pk=pending.pk).update(prediction_id=prediction.id)
+        with _slots_lock:
+            _slots[prediction.id] = (client, started)
+        _start_reaper()
+        return prediction.id
+
+    prediction_id = _running(flight)
+    if prediction_id is None:
+        prediction_id, shared = single_flight.run(flight, start, lambda: _running(flight))
+        if not shared:
+            return prediction_id
+
+    joined = PendingPrediction.objects.create(token=uuid.uuid4().hex, prediction_id=prediction_id, **fields)
+    if not PendingPrediction.objects.filter(prediction_id=prediction_id).exclude(pk=joined.pk).exists():
+        # Its jobs were finished before this one joined; nothing will finish it
+        joined.delete()
+        return start()
+    _start_reaper()
+    return prediction_id
+
+
+# Admission slots held by the predictions this process created, by prediction
+# id. A prediction's slot is released once none of its jobs is pending: by
+# handle_webhook() here, or by the reaper when another process finished them.
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def _release_finished(prediction_ids=None):
+    with _slots_lock:
+        if prediction_ids is None:
+            prediction_ids = list(_slots)
+        held = [prediction_id for prediction_id in prediction_ids if prediction_id in _slots]
+    if not held:
+        return
+    pending = set(PendingPrediction.objects.filter(prediction_id__in=held).values_list('prediction_id', flat=True))
+    for prediction_id in held:
+        if prediction_id in pending:
+            continue
+        with _slots_lock:
+            slot = _slots.pop(prediction_id, None)
+        if slot is not None:
+            client, started = slot
+            admission.limiter.release(client, time.monotonic() - started)
+
+
+def _running(flight):
+    """Id of the running prediction of an identical job, if there is one."""
+    return (
+        PendingPrediction.objects.filter(flight_key=flight).exclude(prediction_id='')
+        .values_list('prediction_id', flat=True).first()
+    )
+
+
+def reap():
+    """
+    Finish the jobs whose webhook hasn't come within REPLICATE_WEBHOOK_TIMEOUT
+    seconds, from their prediction fetched from Replicate, as if it had been
+    delivered. Running predictions are looked at again next time; jobs whose
+    prediction was never created, or is gone, fail. Returns how many jobs
+    were finished.
+    """
+    from replicate.exceptions import ReplicateError
+
+    cutoff = timezone.now() - timedelta(seconds=REPLICATE_WEBHOOK_TIMEOUT)
+    finished = 0
+    for pending in PendingPrediction.objects.filter(created_at__lt=cutoff):
+        if not pending.prediction_id:
+            payload = {'status': 'failed', 'error': 'Prediction was never created'}
+        else:
+            try:
+                payload = _payload(replicate_client().predictions.get(pending.prediction_id))
+            except ReplicateError as e:
+                if e.status != 404:
+                    logger.warning(f"Could not look up prediction {pending.prediction_id}: {str(e)}")
+                    continue
+                payload = {'id': pending.prediction_id, 'status': 'failed', 'error': 'Prediction not found'}
+            except Exception as e:
+                logger.warning(f"Could not look up prediction {pending.prediction_id}: {str(e)}")
+                continue
+        handle_webhook(pending.token, payload)
+        # Or finished along with another job of the same prediction
+        if not PendingPrediction.objects.filter(pk=pending.pk).exists():
+            finished += 1
+    _release_finished()
+    return finished
+
+
+def _payload(prediction):
+    """A fetched prediction as a webhook delivers it."""
+    fields = ('id', 'status', 'output', 'error', 'logs', 'created_at', 'started_at', 'completed_at', 'metrics')
+    return {field: getattr(prediction, field, None) for field in fields}
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def _start_reaper():
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap_periodically, name='webhook-reaper', daemon=True)
+            _reaper.start()
+
+
+def _reap_periodically():
+    while True:
+        time.sleep(REPLICATE_WEBHOOK_REAP_INTERVAL)
+        with worker_connection():
+            try:
+                reaped = reap()
+                if reaped:
+                    logger.info(f"Finished {reaped} generation job(s) whose webhook never came")
+            except Exception as e:
+                logger.error(f"Reaping webhook jobs failed: {str(e)}")
+
+
+def _prediction(payload):
+    """The timing fields of a webhook payload, for metrics.observe_prediction."""
+    return SimpleNamespace(
+        created_at=payload.get('created_at'), started_at=payload.get('started_at'),
+        completed_at=payload.get('completed_at'), metrics=payload.get('metrics')
+    )
+
+
+def _step_progress(logs):
+    from replicate.prediction import Prediction
+
+    step = Prediction.Progress.parse(logs or '')
+    return step.percentage if step else None
+
+
+def handle_webhook(token, payload):
+    """
+    Finish the jobs waiting on a completed prediction: store its outputs in
+    S3 once and record the outcome of each. Deliveries for a running
+    prediction report its progress; jobs whose client stopped waiting fail,
+    and the prediction is cancelled once none is left waiting. Returns False
+    for deliveries there is nothing to do for: unknown or already handled.
+    """
+    try:
+        return _handle_webhook(token, payload)
+    finally:
+        if payload.get('id'):
+            _release_finished([payload['id']])
+
+
+def _handle_webhook(token, payload):
+    from replicate.helpers import transform_output
+
+    prediction_id = payload.get('id')
+    pending = PendingPrediction.objects.filter(token=token).first()
+    if pending is not None and pending.prediction_id not in ('', prediction_id):
+        return False
+    if pending is None:
+        # The job that started the prediction may be done with it, but not the jobs that joined it
+        pending = PendingPrediction.objects.filter(prediction_id=prediction_id).first() if prediction_id else None
+        if pending is None:
+            return False
+    jobs = list(PendingPrediction.objects.select_related('design').filter(
+        Q(pk=pending.pk) | Q(prediction_id=prediction_id) if prediction_id else Q(pk=pending.pk)
+    ))
+
+    completed = payload.get('status') in ('succeeded', 'failed', 'canceled')
+    stopped = {job.pk: cancellation.stopped(job.design) for job in jobs}
+    waiting = [job for job in jobs if stopped[job.pk] is None]
+    handled = False
+    with metrics.labels('replicate-webhook', pending.model):
+        for job in jobs:
+            # Claimed first, so a repeated delivery doesn't finish it twice
+            if stopped[job.pk] is not None and _claim(job):
+                metrics.cancelled(stopped[job.pk].reason)
+                _finish(job, error=stopped[job.pk])
+                handled = True
+
+        if not completed:
+            if waiting:
+                step = _step_progress(payload.get('logs'))
+                for job in waiting:
+                    progress.report(progress.RUNNING, step, design_id=job.design_id)
+            else:
+                # Nobody waits for the outputs; don't let the prediction run on or store them
+                cancellation.cancel_prediction(replicate_client(), prediction_id)
+            return True
+
+        claimed = [job for job in waiting if _claim(job)]
+        if not claimed:
+            return handled
+
+        metrics.observe_prediction(_prediction(payload), _elapsed(claimed[0]))
+        try:
+            if payload['status'] != 'succeeded':
+                raise RuntimeError(payload.get('error') or f"Prediction {payload['status']}")
+            for job in claimed:
+                progress.report(progress.UPLOADING, design_id=job.design_id)
+            output = transform_output(payload.get('output'), replicate_client())
+            if isinstance(output, str):
+                # A single output that the SDK left as a URL
+                output = [output]
+            urls, failed = upload_outputs(as_outputs(output), KEY_FUNCS[pending.model])
+        except Exception as e:
+            for job in claimed:
+                logger.error(f"Generation job {job.design_id} failed: {str(e)}")
+                _finish(job, error=e)
+            return True
+
+    if not failed:
+        prediction_cache.store(pending.cache_key or None, pending.model, urls)
+    for index, job in enumerate(claimed):
+        # Jobs that joined the prediction share the first one's outputs
+        _finish(job, GenerationResult(urls, 'miss' if index == 0 else 'coalesced', failed))
+    return True
+
+
+def _claim(job):
+    return PendingPrediction.objects.filter(pk=job.pk).delete()[0] > 0
+
+
+def _elapsed(job):
+    """Seconds since the job started, when its design was created."""
+    return (timezone.now() - job.design.created_at).total_seconds()
+
+
+def _finish(job, result=None, error=None):
+    # outcome_fields() times from a monotonic start
+    started = time.monotonic() - _elapsed(job)
+    InteriorDesign.objects.filter(pk=job.design_id).update(
+        **outcome_fields(job.model, started, result, error=error, digest=job.digest or None)
+    )
+    progress.finished(job.design_id)
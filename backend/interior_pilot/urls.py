@@ -3,10 +3,12 @@ from django.views.generic import TemplateView
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
+from api.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
+    path('metrics', metrics_view, name='metrics'),
     # Serve index.html for all other routes
     re_path(r'^(?!static/|media/|api/).*$', TemplateView.as_view(template_name='index.html')),
 ]
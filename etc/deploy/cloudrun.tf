@@ -72,6 +72,15 @@ resource "google_cloud_run_service" "default" {
           container_port = 8000
         }
 
+        # Traffic is routed once the SDKs are loaded and the clients exist
+        startup_probe {
+          http_get {
+            path = "/api/ready/"
+          }
+          period_seconds    = 2
+          failure_threshold = 30
+        }
+
       }
 
       container_concurrency = 80
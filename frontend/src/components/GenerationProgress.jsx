@@ -0,0 +1,23 @@
+const STAGE_LABELS = {
+  queued: 'Waiting for a free slot...',
+  running: 'Generating your design...',
+  uploading: 'Saving your design...',
+};
+
+const GenerationProgress = ({ job }) => {
+  const percent = job?.stage === 'running' && job.progress != null ? Math.round(job.progress * 100) : null;
+
+  return (
+    <div className="flex flex-col items-center justify-center h-64 space-y-4">
+      <div className="animate-spin rounded-full h-16 w-16 border-t-4 border-b-4 border-[#DAA520]"></div>
+      <p className="text-[#6B4423] font-medium">{STAGE_LABELS[job?.stage] || 'Starting...'}</p>
+      {percent != null && (
+        <div className="w-2/3 h-2 bg-[#DAA520]/20 rounded-full overflow-hidden">
+          <div className="h-full bg-[#DAA520] transition-all duration-500" style={{ width: `${percent}%` }}></div>
+        </div>
+      )}
+    </div>
+  );
+};
+
+export default GenerationProgress;
@@ -1,12 +1,15 @@
 import React, { useState, useRef } from 'react';
 import axios from 'axios';
 import { motion, AnimatePresence } from 'framer-motion';
+import { generateWithProgress } from '../services/api';
+import GenerationProgress from '../components/GenerationProgress';
 
 const GenerateLayout = () => {
     const fileInputRef = useRef(null);
     const [image, setImage] = useState(null);
     const [prompt, setPrompt] = useState('');
     const [loading, setLoading] = useState(false);
+    const [job, setJob] = useState(null);
     const [message, setMessage] = useState('');
     const [generatedImages, setGeneratedImages] = useState(null); // Initialize as null
     const [error, setError] = useState(null);
@@ -37,22 +40,21 @@ const GenerateLayout = () => {
 
             const imageUrl = uploadResponse.data.url;
 
-            const response = await axios.post(`${import.meta.env.VITE_API_BASE_URL}/generate-3d-layout/`, {
+            const result = await generateWithProgress('generate-3d-layout', {
                 image: imageUrl,
                 prompt: prompt,
-            }, {
-                headers: { 'Content-Type': 'application/json' },
-            });
+            }, setJob);
 
-            if (response.data.image_urls) {
-                setGeneratedImages(response.data.image_urls);
+            if (result.output_urls.length) {
+                setGeneratedImages(result.output_urls);
             }
-            setMessage(response.data.message || 'Layout generated successfully!');
+            setMessage(result.error || 'Layout generated successfully!');
         } catch (error) {
             console.error(error);
-            setError('Error: ' + (error.response?.data?.error || 'Something went wrong'));
+            setError('Error: ' + (error.response?.data?.error || error.message || 'Something went wrong'));
         } finally {
             setLoading(false);
+            setJob(null);
         }
     };
 
@@ -208,11 +210,7 @@ const GenerateLayout = () => {
                         </div>
                     )}
 
-                    {loading && (
-                        <div className="flex items-center justify-center h-64">
-                            <div className="animate-spin rounded-full h-16 w-16 border-t-4 border-b-4 border-[#DAA520]"></div>
-                        </div>
-                    )}
+                    {loading && <GenerationProgress job={job} />}
 
                     {generatedImages && (
                         <div className="space-y-6">
@@ -1,11 +1,14 @@
 import React, { useState, useRef } from 'react';
 import axios from 'axios';
 import { motion, AnimatePresence } from 'framer-motion';
+import { generateWithProgress } from '../services/api';
+import GenerationProgress from '../components/GenerationProgress';
 
 const RoomDesign = () => {
     const fileInputRef = useRef(null);
     const [image, setImage] = useState(null);
     const [loading, setLoading] = useState(false);
+    const [job, setJob] = useState(null);
     const [message, setMessage] = useState('');
     const [generatedImage, setGeneratedImage] = useState(null);
     const [error, setError] = useState(null);
@@ -74,20 +77,21 @@ const RoomDesign = () => {
             const imageUrl = uploadResponse.data.url;
 
             // Then generate the room design
-            const response = await axios.post(`${import.meta.env.VITE_API_BASE_URL}/generate/`, {
+            const result = await generateWithProgress('generate', {
                 ...formData,
                 image: imageUrl
-            });
+            }, setJob);
 
-            if (response.data.url) {
-                setGeneratedImage(response.data.url);
+            if (result.output_urls.length) {
+                setGeneratedImage(result.output_urls[0]);
             }
-            setMessage(response.data.message || 'Room design generated successfully!');
+            setMessage(result.error || 'Room design generated successfully!');
         } catch (error) {
             console.error(error);
-            setError('Error: ' + (error.response?.data?.error || 'Something went wrong'));
+            setError('Error: ' + (error.response?.data?.error || error.message || 'Something went wrong'));
         } finally {
             setLoading(false);
+            setJob(null);
         }
     };
 
@@ -307,11 +311,7 @@ const RoomDesign = () => {
                             </div>
                         )}
 
-                        {loading && (
-                            <div className="flex items-center justify-center h-64">
-                                <div className="animate-spin rounded-full h-16 w-16 border-t-4 border-b-4 border-[#DAA520]"></div>
-                            </div>
-                        )}
+                        {loading && <GenerationProgress job={job} />}
                     </div>
                 </motion.div>
             </div>
@@ -33,3 +33,64 @@ export const getDesigns = async () => {
   const response = await fetch(`${API_URL}/designs/`);
   return response.json();
 };
+
+// Submits a generation job and follows its progress over Server-Sent Events.
+// onProgress gets the job's status ({ stage, progress, ... }) as it changes;
+// resolves with the finished job, whose output_urls hold the results.
+export const generateWithProgress = async (path, body, onProgress) => {
+  const response = await fetch(`${API_URL}/${path}/?async=true`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body),
+  });
+  const job = await response.json();
+  if (!response.ok) {
+    throw new Error(job.error || 'Failed to generate design');
+  }
+
+  if (typeof EventSource === 'undefined') {
+    return pollJob(job.job_id, onProgress);
+  }
+
+  return new Promise((resolve, reject) => {
+    // Built from the API base rather than job.events_url, so it has the page's scheme
+    const events = new EventSource(`${API_URL}/designs/${job.job_id}/events/`);
+    const finish = (settle, value) => {
+      events.close();
+      settle(value);
+    };
+
+    events.addEventListener('progress', (e) => onProgress?.(JSON.parse(e.data)));
+    events.addEventListener('done', (e) => finish(resolve, JSON.parse(e.data)));
+    events.addEventListener('failed', (e) => {
+      finish(reject, new Error(JSON.parse(e.data).error || 'Failed to generate design'));
+    });
+    // Dropped connections are retried by the browser; once it stops, poll instead
+    events.onerror = () => {
+      if (events.readyState === EventSource.CLOSED) {
+        pollJob(job.job_id, onProgress).then(resolve, reject);
+      }
+    };
+  });
+};
+
+const JOB_POLL_INTERVAL = 2000;
+
+// Follows a job through its status endpoint, for when an event stream can't be held open
+const pollJob = async (jobId, onProgress) => {
+  for (;;) {
+    const response = await fetch(`${API_URL}/designs/${jobId}/status/`);
+    const job = await response.json();
+    if (!response.ok) {
+      throw new Error(job.error || 'Lost track of the generation job');
+    }
+    if (job.status === 'completed') {
+      return job;
+    }
+    if (job.status === 'failed') {
+      throw new Error(job.error || 'Failed to generate design');
+    }
+    onProgress?.(job);
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL));
+  }
+};